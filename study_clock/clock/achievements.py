@@ -0,0 +1,199 @@
+import datetime
+
+from django.db import transaction
+from django.db.models import Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from .models import Achievement, AchievementProgress, Activity, StudySession
+import logging
+
+logger = logging.getLogger(__name__)
+
+# code, measure, threshold, title. A rule is earned once, when its measure
+# first reaches the threshold. Measures:
+#   activities        activities created
+#   total_minutes     minutes studied over all activities
+#   activity_minutes  minutes studied on a single activity
+#   streak            local days in a row with study time (the longest run)
+RULES = (
+    ('first-activity', 'activities', 1, 'Created a first activity'),
+    ('five-activities', 'activities', 5, 'Created five activities'),
+    ('first-minutes', 'total_minutes', 1, 'Studied for the first time'),
+    ('total-10h', 'total_minutes', 10 * 60, '10 hours of study'),
+    ('total-100h', 'total_minutes', 100 * 60, '100 hours of study'),
+    ('total-1000h', 'total_minutes', 1000 * 60, '1000 hours of study'),
+    ('activity-10h', 'activity_minutes', 10 * 60, '10 hours on one activity'),
+    ('activity-100h', 'activity_minutes', 100 * 60, '100 hours on one activity'),
+    ('streak-3', 'streak', 3, 'Studied 3 days in a row'),
+    ('streak-7', 'streak', 7, 'Studied 7 days in a row'),
+    ('streak-30', 'streak', 30, 'Studied 30 days in a row'),
+    ('streak-100', 'streak', 100, 'Studied 100 days in a row'),
+)
+MEASURES = ('activities', 'total_minutes', 'activity_minutes', 'streak')
+
+_thresholds = {measure: [(threshold, code) for code, rule_measure, threshold, _ in RULES if rule_measure == measure]
+               for measure in MEASURES}
+
+
+def reached(measure, before, after):
+    # Codes of the rules a measure passes on its way from `before` to `after`.
+    return [code for threshold, code in _thresholds[measure] if before < threshold <= after]
+
+
+def award(user_id, earned):
+    # `earned` holds (code, activity name) pairs. One that is already held,
+    # e.g. a per-activity milestone reached again on another activity, stays
+    # as it was.
+    if not earned:
+        return
+    Achievement.objects.bulk_create(
+        [Achievement(user_id=user_id, code=code, activity_name=activity_name) for code, activity_name in earned],
+        ignore_conflicts=True,
+    )
+    logger.info('User %s reached %s', user_id, ', '.join(code for code, _ in earned))
+
+
+def locked_progress(user_id):
+    # The user's running state, or None when there was none: it is then built
+    # from the history, which already includes the event being recorded.
+    try:
+        return AchievementProgress.objects.select_for_update().get(user_id=user_id)
+    except AchievementProgress.DoesNotExist:
+        save(*replay([user_id]))
+        return None
+
+
+def record_session(session):
+    # A timer write moves the totals, the streak and the milestones of its
+    # activity, from the stored state alone.
+    with transaction.atomic():
+        progress = locked_progress(session.user_id)
+        if progress is None:
+            return
+        earned = [(code, '') for code in reached('total_minutes', progress.total_minutes,
+                                                   progress.total_minutes + session.minutes)]
+        progress.total_minutes += session.minutes
+
+        day = timezone.localdate(session.ended_at)
+        if progress.last_study_day is None or day > progress.last_study_day:
+            if progress.last_study_day == day - datetime.timedelta(days=1):
+                progress.current_streak += 1
+            else:
+                progress.current_streak = 1
+            progress.last_study_day = day
+            if progress.current_streak > progress.longest_streak:
+                earned += [(code, '') for code in reached('streak', progress.longest_streak, progress.current_streak)]
+                progress.longest_streak = progress.current_streak
+
+        activity = session.activity
+        if activity is not None:
+            after = activity.minutes_spent_in_total
+            earned += [(code, activity.name) for code in reached('activity_minutes', after - session.minutes, after)]
+        progress.save()
+        award(session.user_id, earned)
+
+
+def record_activity(activity):
+    with transaction.atomic():
+        progress = locked_progress(activity.user_id)
+        if progress is None:
+            return
+        earned = [(code, '') for code in reached('activities', progress.activities_created,
+                                                   progress.activities_created + 1)]
+        progress.activities_created += 1
+        progress.save(update_fields=['activities_created'])
+        award(activity.user_id, earned)
+
+
+def replay(user_ids):
+    # The running state and the achievements of the users as computed from
+    # their history, for users who have no state yet. Unsaved instances.
+    # Deleted activities are no longer counted, and sessions only exist
+    # since timer writes were recorded, so the larger of the two totals is
+    # taken.
+    progress = {user_id: AchievementProgress(user_id=user_id) for user_id in user_ids}
+    best = {}
+    for user_id, name, minutes in Activity.objects.filter(user_id__in=user_ids) \
+            .values_list('user_id', 'name', 'minutes_spent_in_total'):
+        state = progress[user_id]
+        state.activities_created += 1
+        state.total_minutes += minutes
+        if minutes > best.get(user_id, (0, ''))[0]:
+            best[user_id] = (minutes, name)
+
+    for user_id, minutes in StudySession.objects.filter(user_id__in=user_ids).values('user_id') \
+            .annotate(minutes=Sum('minutes')).values_list('user_id', 'minutes').order_by():
+        progress[user_id].total_minutes = max(progress[user_id].total_minutes, minutes)
+
+    days = StudySession.objects.filter(user_id__in=user_ids).annotate(day=TruncDate('ended_at')) \
+        .values_list('user_id', 'day').distinct().order_by('user_id', 'day')
+    for user_id, day in days:
+        state = progress[user_id]
+        if state.last_study_day == day - datetime.timedelta(days=1):
+            state.current_streak += 1
+        else:
+            state.current_streak = 1
+        state.last_study_day = day
+        state.longest_streak = max(state.longest_streak, state.current_streak)
+
+    earned = []
+    for user_id, state in progress.items():
+        activity_minutes, activity_name = best.get(user_id, (0, ''))
+        measures = {
+            'activities': (state.activities_created, ''),
+            'total_minutes': (state.total_minutes, ''),
+            'activity_minutes': (activity_minutes, activity_name),
+            'streak': (state.longest_streak, ''),
+        }
+        for measure, (value, name) in measures.items():
+            earned += [Achievement(user_id=user_id, code=code, activity_name=name)
+                       for code in reached(measure, 0, value)]
+    return list(progress.values()), earned
+
+
+def save(progress, earned, replace=False):
+    # Stores replayed state. Without `replace`, users who have gained state
+    # in the meantime keep it.
+    with transaction.atomic():
+        if replace:
+            AchievementProgress.objects.bulk_create(
+                progress, update_conflicts=True, unique_fields=['user'],
+                update_fields=['total_minutes', 'activities_created', 'current_streak', 'longest_streak',
+                               'last_study_day'],
+            )
+        else:
+            AchievementProgress.objects.bulk_create(progress, ignore_conflicts=True)
+        Achievement.objects.bulk_create(earned, ignore_conflicts=True)
+
+
+def summary(user_id, today=None):
+    # Progress and every rule, earned or not. Users without state yet are
+    # shown their replayed history, without storing it.
+    progress = AchievementProgress.objects.filter(user_id=user_id).first()
+    if progress is None:
+        (progress,), replayed = replay([user_id])
+        earned = {achievement.code: achievement for achievement in replayed}
+    else:
+        earned = {achievement.code: achievement for achievement in Achievement.objects.filter(user_id=user_id)}
+
+    today = today or timezone.localdate()
+    streak_alive = progress.last_study_day is not None and progress.last_study_day >= today - datetime.timedelta(days=1)
+    return {
+        'total_minutes': progress.total_minutes,
+        'activities_created': progress.activities_created,
+        'current_streak': progress.current_streak if streak_alive else 0,
+        'longest_streak': progress.longest_streak,
+        'last_study_day': progress.last_study_day,
+        'achievements': [
+            {
+                'code': code,
+                'title': title,
+                'measure': measure,
+                'threshold': threshold,
+                'earned_at': earned[code].earned_at if code in earned else None,
+                'activity': (earned[code].activity_name or None) if code in earned else None,
+            }
+            for code, measure, threshold, title in RULES
+        ],
+    }
@@ -0,0 +1,145 @@
+import hashlib
+import os
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.files.uploadhandler import FileUploadHandler, SkipFile
+from django.db import connection, transaction
+import logging
+
+logger = logging.getLogger(__name__)
+
+RENDITION_FORMATS = {'webp': 'WEBP', 'jpg': 'JPEG'}
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+class AvatarUploadHandler(FileUploadHandler):
+    # Sits in front of Django's default handlers: hashes the avatar while it
+    # streams in and skips the file as soon as it grows past the size cap, so
+    # an oversized upload is never buffered in full.
+    def __init__(self, request=None, field_name='avatar'):
+        super().__init__(request)
+        self.target_field = field_name
+        self.max_size = settings.AVATAR_PIPELINE['MAX_UPLOAD_SIZE']
+        self.too_large = False
+        self.digest = None
+        self._hash = None
+        self._received = 0
+
+    def new_file(self, field_name, *args, **kwargs):
+        super().new_file(field_name, *args, **kwargs)
+        if field_name == self.target_field:
+            self._hash = hashlib.sha256()
+            self._received = 0
+
+    def receive_data_chunk(self, raw_data, start):
+        if self.field_name != self.target_field:
+            return raw_data
+        self._received += len(raw_data)
+        if self._received > self.max_size:
+            self.too_large = True
+            raise SkipFile()
+        self._hash.update(raw_data)
+        return raw_data
+
+    def file_complete(self, file_size):
+        if self.field_name == self.target_field and not self.too_large:
+            self.digest = self._hash.hexdigest()
+        return None
+
+
+def rendition_name(digest, size, extension):
+    return f'avatars/{digest}/{size}.{extension}'
+
+
+def stage_original(uploaded_file, digest):
+    # One copy per upload: process_avatar deletes it when done, which must
+    # not pull it from under a concurrent upload of the same image.
+    extension = os.path.splitext(uploaded_file.name)[1].lower()[:10]
+    return default_storage.save(f'avatars/originals/{digest}-{uuid.uuid4().hex}{extension}', uploaded_file)
+
+
+def _render(image, size, pil_format):
+    from PIL import Image
+
+    width, height = image.size
+    side = min(width, height)
+    left, top = (width - side) // 2, (height - side) // 2
+    square = image.crop((left, top, left + side, top + side))
+    square = square.resize((size, size), Image.Resampling.LANCZOS)
+
+    buffer = BytesIO()
+    # A freshly built image carries no EXIF, ICC or XMP blocks, so nothing
+    # from the original upload leaks into the renditions.
+    square.save(buffer, pil_format, quality=settings.AVATAR_PIPELINE['QUALITY'])
+    return buffer.getvalue()
+
+
+def render_renditions(original_name, digest):
+    from PIL import Image, ImageOps
+
+    sizes = settings.AVATAR_PIPELINE['SIZES']
+    if all(default_storage.exists(rendition_name(digest, size, ext)) for size in sizes for ext in RENDITION_FORMATS):
+        logger.debug('Avatar %s already rendered, reusing it', digest)
+        return
+
+    with default_storage.open(original_name, 'rb') as file:
+        image = Image.open(file)
+        image.draft('RGB', (max(sizes) * 2, max(sizes) * 2))
+        image = ImageOps.exif_transpose(image).convert('RGB')
+
+    for size in sizes:
+        for extension, pil_format in RENDITION_FORMATS.items():
+            name = rendition_name(digest, size, extension)
+            if not default_storage.exists(name):
+                default_storage.save(name, ContentFile(_render(image, size, pil_format)))
+
+
+def process_avatar(user_id, digest, original_name):
+    from .models import User
+
+    try:
+        render_renditions(original_name, digest)
+    except Exception:
+        logger.exception('Processing avatar %s for user %s failed', digest, user_id)
+        return
+    finally:
+        default_storage.delete(original_name)
+
+    user = User.objects.filter(pk=user_id).first()
+    if user is None:
+        return
+    user.avatar = rendition_name(digest, max(settings.AVATAR_PIPELINE['SIZES']), 'jpg')
+    user.avatar_hash = digest
+    user.save(update_fields=['avatar', 'avatar_hash'])
+    logger.info('Avatar %s processed for user %s', digest, user_id)
+
+
+def _process_in_worker(user_id, digest, original_name):
+    try:
+        process_avatar(user_id, digest, original_name)
+    finally:
+        connection.close()
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=settings.AVATAR_PIPELINE['WORKERS'],
+                                           thread_name_prefix='avatar')
+        return _executor
+
+
+def schedule_avatar_processing(user_id, digest, original_name):
+    if not settings.AVATAR_PIPELINE['ASYNC']:
+        process_avatar(user_id, digest, original_name)
+        return
+    transaction.on_commit(lambda: _get_executor().submit(_process_in_worker, user_id, digest, original_name))
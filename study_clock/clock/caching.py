@@ -0,0 +1,159 @@
+import functools
+import threading
+import uuid
+from collections import Counter
+
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from rest_framework import status
+from rest_framework.response import Response
+from .authentication import DataResponse
+import logging
+
+logger = logging.getLogger(__name__)
+
+USER_READ = 'user-read'
+ACTIVITIES = 'activities'
+MESSAGE_HISTORY = 'message-history'
+STUDY_HEATMAP = 'study-heatmap'
+
+
+class CacheStats:
+    # Hit/miss counters of this process, per endpoint.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hits = Counter()
+        self.misses = Counter()
+
+    def record(self, endpoint, hit):
+        with self._lock:
+            (self.hits if hit else self.misses)[endpoint] += 1
+
+    def snapshot(self):
+        with self._lock:
+            endpoints = sorted(set(self.hits) | set(self.misses))
+            return {
+                endpoint: {'hits': self.hits[endpoint], 'misses': self.misses[endpoint]}
+                for endpoint in endpoints
+            }
+
+    def reset(self):
+        with self._lock:
+            self.hits.clear()
+            self.misses.clear()
+
+
+cache_stats = CacheStats()
+
+
+def get_cache():
+    return caches[settings.RESPONSE_CACHE['ALIAS']]
+
+
+def make_key(endpoint, user_id, *parts):
+    return ':'.join(['response', endpoint, str(user_id), *map(str, parts)])
+
+
+def cached_response(endpoint, key_kwargs=()):
+    # Caches the data of a successful GET per user and endpoint. Entries are
+    # dropped by the signal receivers in clock.signals when the rows behind
+    # them change; the timeout only bounds how long an entry written by a
+    # request racing a concurrent update can survive.
+    def decorator(method):
+        if iscoroutinefunction(method):
+            return _cached_async_response(method, endpoint, key_kwargs)
+
+        @functools.wraps(method)
+        def wrapper(self, request, *args, **kwargs):
+            if not request.user.is_authenticated:
+                return method(self, request, *args, **kwargs)
+            cache = get_cache()
+            key = make_key(endpoint, request.user.pk, *(kwargs[name] for name in key_kwargs))
+            data = cache.get(key)
+            if data is not None:
+                cache_stats.record(endpoint, hit=True)
+                return Response(data, status=status.HTTP_200_OK, headers={'X-Cache': 'HIT'})
+
+            cache_stats.record(endpoint, hit=False)
+            response = method(self, request, *args, **kwargs)
+            if response.status_code == status.HTTP_200_OK:
+                cache.set(key, response.data, settings.RESPONSE_CACHE['TIMEOUT'])
+                response['X-Cache'] = 'MISS'
+            return response
+        return wrapper
+    return decorator
+
+
+def _cached_async_response(method, endpoint, key_kwargs):
+    # Same entries as the sync views, so both flavours of an endpoint share
+    # hits and invalidation.
+    @functools.wraps(method)
+    async def wrapper(self, request, *args, **kwargs):
+        cache = get_cache()
+        key = make_key(endpoint, request.user.pk, *(kwargs[name] for name in key_kwargs))
+        data = await cache.aget(key)
+        if data is not None:
+            cache_stats.record(endpoint, hit=True)
+            return DataResponse(data, headers={'X-Cache': 'HIT'})
+
+        cache_stats.record(endpoint, hit=False)
+        response = await method(self, request, *args, **kwargs)
+        if response.status_code == status.HTTP_200_OK:
+            await cache.aset(key, response.data, settings.RESPONSE_CACHE['TIMEOUT'])
+            response['X-Cache'] = 'MISS'
+        return response
+    return wrapper
+
+
+def invalidate(*keys):
+    # Drop the entries now so this request's own follow-up reads are fresh,
+    # and again once the transaction commits so that a concurrent read that
+    # cached the old rows in between is not kept either.
+    keys = list(keys)
+    get_cache().delete_many(keys)
+    transaction.on_commit(lambda: get_cache().delete_many(keys))
+    logger.debug('Response cache invalidated: %s', keys)
+
+
+def generation(endpoint, user_id):
+    # For entries keyed by arbitrary parameters, such as a date range, which
+    # cannot be listed for deletion: their keys include the user's current
+    # generation, and invalidating moves it on so they are never read again
+    # and age out with their timeout. A random token rather than a counter,
+    # so that an evicted generation cannot come back as an old value. Like
+    # the entries, the token only reaches every worker through a shared
+    # cache, which `manage.py serve` insists on.
+    cache = get_cache()
+    key = make_key(endpoint, user_id, 'generation')
+    token = cache.get(key)
+    if token is None:
+        cache.add(key, uuid.uuid4().hex, None)
+        token = cache.get(key)
+    return token
+
+
+def invalidate_generation(endpoint, user_id):
+    key = make_key(endpoint, user_id, 'generation')
+    get_cache().set(key, uuid.uuid4().hex, None)
+    transaction.on_commit(lambda: get_cache().set(key, uuid.uuid4().hex, None))
+    logger.debug('Response cache generation moved on: %s', key)
+
+
+def invalidate_user(user_id):
+    # The activities list embeds the username, so it goes along with the
+    # profile.
+    invalidate(make_key(USER_READ, user_id), make_key(ACTIVITIES, user_id))
+
+
+def invalidate_activities(user_id):
+    invalidate(make_key(ACTIVITIES, user_id))
+
+
+def invalidate_conversation(first_id, second_id):
+    invalidate(make_key(MESSAGE_HISTORY, first_id, second_id), make_key(MESSAGE_HISTORY, second_id, first_id))
+
+
+def invalidate_study_time(user_id):
+    invalidate_generation(STUDY_HEATMAP, user_id)
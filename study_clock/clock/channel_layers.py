@@ -0,0 +1,619 @@
+import asyncio
+import hashlib
+import itertools
+import os
+import re
+import socket
+import struct
+import time
+import uuid
+import weakref
+from collections import deque
+from copy import deepcopy
+
+import msgpack
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+from django.utils.module_loading import import_string
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Frames on the socket are a 4-byte big-endian length followed by a msgpack
+# list: requests are [id, op, *args] and replies [id, status, value].
+HEADER = struct.Struct('>I')
+OK, FULL, ERROR = 0, 1, 2
+
+
+async def read_frame(reader):
+    header = await reader.readexactly(HEADER.size)
+    return msgpack.unpackb(await reader.readexactly(HEADER.unpack(header)[0]))
+
+
+def write_frame(writer, payload):
+    data = msgpack.packb(payload, use_bin_type=True)
+    writer.write(HEADER.pack(len(data)) + data)
+
+
+def broker_running(path):
+    # Whether something accepts connections on the broker socket.
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+        try:
+            probe.connect(str(path))
+        except OSError:
+            return False
+    return True
+
+
+def transport_settings(layer):
+    # The settings of the layer that carries the messages, under any
+    # LocalFanOutChannelLayer wrapped around it.
+    while layer.get('BACKEND') == f'{__name__}.LocalFanOutChannelLayer':
+        layer = layer['CONFIG']['layer']
+    return layer
+
+
+class BrokerSession:
+    # One connected layer, with the expiry and capacity settings it sent on
+    # connecting; they apply to the messages it sends.
+    def __init__(self, writer):
+        self.writer = writer
+        self.expiry = 60
+        self.group_expiry = 86400
+        self.capacity = 100
+        self.channel_capacity = []
+        self.receives = {}
+        self.closed = False
+
+    def configure(self, config):
+        self.expiry = config['expiry']
+        self.group_expiry = config['group_expiry']
+        self.capacity = config['capacity']
+        self.channel_capacity = [(re.compile(pattern), capacity) for pattern, capacity in config['channel_capacity']]
+
+    def get_capacity(self, channel):
+        for pattern, capacity in self.channel_capacity:
+            if pattern.match(channel):
+                return capacity
+        return self.capacity
+
+    def reply(self, request_id, status, value=None):
+        if not self.closed:
+            write_frame(self.writer, [request_id, status, value])
+
+
+class ChannelBroker:
+    # The state behind UnixSocketChannelLayer: one process per host keeps
+    # every channel queue and group, and the worker processes reach it over
+    # a Unix socket. Messages stay the msgpack bytes the sender produced, so
+    # the broker never decodes them and a group send queues one bytes object
+    # on every member channel.
+    SWEEP_INTERVAL = 1.0
+
+    def __init__(self):
+        # channel -> deque of (expires_at, payload)
+        self.channels = {}
+        # group -> {channel: expires_at}, and channel -> groups it is in
+        self.groups = {}
+        self.memberships = {}
+        # channel -> deque of (session, request_id) waiting in receive
+        self.waiters = {}
+        self.sessions = set()
+
+    async def serve(self, path):
+        # Runs until cancelled.
+        server = await asyncio.start_unix_server(self.handle, str(path))
+        os.chmod(path, 0o660)
+        logger.info('Channel broker listening on %s', path)
+        try:
+            async with server:
+                await asyncio.gather(server.serve_forever(), self.sweep_forever())
+        finally:
+            for session in list(self.sessions):
+                session.writer.close()
+            if os.path.exists(path):
+                os.unlink(path)
+
+    async def handle(self, reader, writer):
+        session = BrokerSession(writer)
+        self.sessions.add(session)
+        try:
+            while True:
+                request_id, op, *args = await read_frame(reader)
+                handler = getattr(self, f'op_{op}', None)
+                if handler is None:
+                    session.reply(request_id, ERROR, f'Unknown operation {op!r}')
+                else:
+                    handler(session, request_id, *args)
+                # Only the connection that floods the broker waits for it.
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            # Cancelled when the broker shuts down.
+            pass
+        finally:
+            session.closed = True
+            self.sessions.discard(session)
+            writer.close()
+
+    def op_hello(self, session, request_id, config):
+        session.configure(config)
+
+    def op_send(self, session, request_id, channel, payload):
+        session.reply(request_id, OK if self.deliver(session, channel, payload) else FULL)
+
+    def op_receive(self, session, request_id, channel):
+        queue = self.channels.get(channel)
+        if queue:
+            self.drop_expired(channel, queue)
+        if queue:
+            _, payload = queue.popleft()
+            session.reply(request_id, OK, payload)
+        else:
+            session.receives[request_id] = channel
+            self.waiters.setdefault(channel, deque()).append((session, request_id))
+
+    def op_cancel(self, session, request_id, receive_id):
+        # Answered only if the receive was still waiting; otherwise its
+        # message is already on the way and the layer keeps it.
+        if session.receives.pop(receive_id, None) is not None:
+            session.reply(receive_id, OK, None)
+
+    def op_group_add(self, session, request_id, group, channel):
+        self.groups.setdefault(group, {})[channel] = time.time() + session.group_expiry
+        self.memberships.setdefault(channel, set()).add(group)
+        session.reply(request_id, OK)
+
+    def op_group_discard(self, session, request_id, group, channel):
+        self.leave(group, channel)
+        session.reply(request_id, OK)
+
+    def op_group_send(self, session, request_id, group, payload):
+        now = time.time()
+        delivered = 0
+        for channel, expires_at in list(self.groups.get(group, {}).items()):
+            if expires_at < now:
+                self.leave(group, channel)
+            elif self.deliver(session, channel, payload):
+                delivered += 1
+        session.reply(request_id, OK, delivered)
+
+    def op_flush(self, session, request_id):
+        self.channels.clear()
+        self.groups.clear()
+        self.memberships.clear()
+        session.reply(request_id, OK)
+
+    def deliver(self, session, channel, payload):
+        waiters = self.waiters.get(channel)
+        while waiters:
+            waiter, receive_id = waiters.popleft()
+            if not waiter.closed and waiter.receives.pop(receive_id, None) is not None:
+                waiter.reply(receive_id, OK, payload)
+                return True
+        queue = self.channels.setdefault(channel, deque())
+        self.drop_expired(channel, queue)
+        if len(queue) >= session.get_capacity(channel):
+            return False
+        queue.append((time.time() + session.expiry, payload))
+        return True
+
+    def drop_expired(self, channel, queue):
+        # Like the in-memory layer, a channel that let a message expire is
+        # taken to be gone and leaves all its groups.
+        now = time.time()
+        expired = False
+        while queue and queue[0][0] < now:
+            queue.popleft()
+            expired = True
+        if expired:
+            for group in list(self.memberships.get(channel, ())):
+                self.leave(group, channel)
+
+    def leave(self, group, channel):
+        members = self.groups.get(group)
+        if members is not None:
+            members.pop(channel, None)
+            if not members:
+                del self.groups[group]
+        groups = self.memberships.get(channel)
+        if groups is not None:
+            groups.discard(group)
+            if not groups:
+                del self.memberships[channel]
+
+    def sweep(self):
+        for channel, queue in list(self.channels.items()):
+            self.drop_expired(channel, queue)
+            if not queue:
+                del self.channels[channel]
+        now = time.time()
+        for group, members in list(self.groups.items()):
+            for channel, expires_at in list(members.items()):
+                if expires_at < now:
+                    self.leave(group, channel)
+        for channel, waiters in list(self.waiters.items()):
+            live = deque((session, receive_id) for session, receive_id in waiters
+                         if not session.closed and receive_id in session.receives)
+            if live:
+                self.waiters[channel] = live
+            else:
+                del self.waiters[channel]
+
+    async def sweep_forever(self):
+        while True:
+            await asyncio.sleep(self.SWEEP_INTERVAL)
+            self.sweep()
+
+
+class BrokerConnection:
+    # The layer's connection to the broker from one event loop. Requests are
+    # pipelined; a reader task matches replies to them by id.
+    def __init__(self, layer):
+        self.layer = layer
+        self.ids = itertools.count()
+        self.pending = {}
+        self.writer = None
+        self.closed = False
+        self.opened = asyncio.ensure_future(self.open())
+
+    async def open(self):
+        reader, self.writer = await asyncio.open_unix_connection(self.layer.path)
+        self.write([next(self.ids), 'hello', {
+            'expiry': self.layer.expiry,
+            'group_expiry': self.layer.group_expiry,
+            'capacity': self.layer.capacity,
+            'channel_capacity': [(pattern.pattern, capacity) for pattern, capacity in self.layer.channel_capacity],
+        }])
+        self.reader = asyncio.ensure_future(self.read_replies(reader))
+
+    def write(self, payload):
+        write_frame(self.writer, payload)
+
+    async def call(self, op, *args, receive_channel=None):
+        await self.opened
+        if self.closed:
+            raise ConnectionError('Lost the connection to the channel broker')
+        request_id = next(self.ids)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = (future, receive_channel)
+        self.write([request_id, op, *args])
+        try:
+            status, value = await future
+        except asyncio.CancelledError:
+            if receive_channel is not None and not self.closed:
+                self.write([next(self.ids), 'cancel', request_id])
+            else:
+                self.pending.pop(request_id, None)
+            raise
+        if status == ERROR:
+            raise RuntimeError(value)
+        return status, value
+
+    async def read_replies(self, reader):
+        try:
+            while True:
+                request_id, status, value = await read_frame(reader)
+                future, receive_channel = self.pending.pop(request_id, (None, None))
+                if future is None:
+                    continue
+                if not future.done():
+                    future.set_result((status, value))
+                elif receive_channel is not None and value is not None:
+                    # The receive was cancelled after the broker handed it
+                    # a message; keep it for the next receive.
+                    self.layer.stash.setdefault(receive_channel, deque()).append(value)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            logger.warning('Lost the connection to the channel broker at %s', self.layer.path)
+        finally:
+            self.close()
+
+    def close(self):
+        self.closed = True
+        for future, _ in self.pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError('Lost the connection to the channel broker'))
+        self.pending.clear()
+        if self.writer is not None:
+            self.writer.close()
+
+
+class UnixSocketChannelLayer(BaseChannelLayer):
+    # Channel layer shared by the worker processes of one host through the
+    # broker of `manage.py channel_broker`, so groups work across workers
+    # without Redis. Configured like the in-memory layer, plus the socket
+    # path.
+    extensions = ['groups', 'flush']
+
+    def __init__(self, path, expiry=60, group_expiry=86400, capacity=100, channel_capacity=None, **kwargs):
+        super().__init__(expiry=expiry, capacity=capacity, **kwargs)
+        self.path = str(path)
+        self.group_expiry = group_expiry
+        self.channel_capacity = self.compile_capacities(channel_capacity or {})
+        self.connections = weakref.WeakKeyDictionary()
+        self.stash = {}
+
+    async def connection(self):
+        loop = asyncio.get_running_loop()
+        connection = self.connections.get(loop)
+        if connection is None or connection.closed or (connection.opened.done() and
+                                                       connection.opened.exception() is not None):
+            connection = self.connections[loop] = BrokerConnection(self)
+        return connection
+
+    async def call(self, op, *args, **kwargs):
+        return await (await self.connection()).call(op, *args, **kwargs)
+
+    def serialize(self, message):
+        return msgpack.packb(message, use_bin_type=True)
+
+    def deserialize(self, payload):
+        return msgpack.unpackb(payload)
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), 'message is not a dict'
+        assert self.valid_channel_name(channel), 'Channel name not valid'
+        assert '__asgi_channel__' not in message
+
+        status, _ = await self.call('send', channel, self.serialize(message))
+        if status == FULL:
+            raise ChannelFull(channel)
+
+    async def receive(self, channel):
+        assert self.valid_channel_name(channel)
+
+        stashed = self.stash.get(channel)
+        if stashed:
+            payload = stashed.popleft()
+            if not stashed:
+                del self.stash[channel]
+        else:
+            _, payload = await self.call('receive', channel, receive_channel=channel)
+        return self.deserialize(payload)
+
+    async def new_channel(self, prefix='specific.'):
+        return f'{prefix}.unix!{uuid.uuid4().hex}'
+
+    # Groups extension
+
+    async def group_add(self, group, channel):
+        assert self.valid_group_name(group), 'Group name not valid'
+        assert self.valid_channel_name(channel), 'Channel name not valid'
+        await self.call('group_add', group, channel)
+
+    async def group_discard(self, group, channel):
+        assert self.valid_channel_name(channel), 'Invalid channel name'
+        assert self.valid_group_name(group), 'Invalid group name'
+        await self.call('group_discard', group, channel)
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), 'Message is not a dict'
+        assert self.valid_group_name(group), 'Invalid group name'
+        # Members that are full miss the message, as with the other layers.
+        await self.call('group_send', group, self.serialize(message))
+
+    # Flush extension
+
+    async def flush(self):
+        self.stash.clear()
+        await self.call('flush')
+
+    async def close(self):
+        connection = self.connections.pop(asyncio.get_running_loop(), None)
+        if connection is not None:
+            connection.close()
+
+
+class FanOutProcess:
+    # What LocalFanOutChannelLayer keeps for one worker process (one event
+    # loop): its subscription channel on the inner layer, the queues of its
+    # member channels and which of them are in which group.
+    def __init__(self):
+        self.channel = None
+        self.ids = itertools.count()
+        # member channel -> asyncio.Queue of (expires_at, message)
+        self.queues = {}
+        # group -> {member channel: joined_at}
+        self.groups = {}
+        self.started = None
+        self.tasks = []
+
+
+class LocalFanOutChannelLayer(BaseChannelLayer):
+    # Wraps another channel layer so that a group send reaches every worker
+    # process once rather than every member channel: each process joins
+    # the inner group once, with a subscription channel of its own, and
+    # hands group messages to its local members itself. Channels from
+    # new_channel() belong to the process; sends to them from elsewhere go
+    # through its subscription channel. Consumers need no change, as long as
+    # they add their own channels to groups, as consumers do.
+    SUBSCRIPTION_PREFIX = 'fanout'
+
+    def __init__(self, layer, refresh_interval=None):
+        # `layer` is the inner layer's settings, as in CHANNEL_LAYERS, or a
+        # layer instance.
+        if isinstance(layer, dict):
+            layer = import_string(layer['BACKEND'])(**layer.get('CONFIG', {}))
+        self.inner = layer
+        super().__init__(expiry=layer.expiry, capacity=layer.capacity)
+        self.group_expiry = getattr(layer, 'group_expiry', 86400)
+        # Subscriptions are renewed well before the inner layer lets them
+        # lapse, which also undoes an eviction after a stalled event loop.
+        self.refresh_interval = refresh_interval or min(self.expiry, self.group_expiry) / 2
+        self.extensions = layer.extensions
+        self.processes = weakref.WeakKeyDictionary()
+
+    def get_capacity(self, channel):
+        return self.inner.get_capacity(channel)
+
+    async def process(self):
+        loop = asyncio.get_running_loop()
+        process = self.processes.get(loop)
+        if process is None or (process.started.done() and process.started.exception() is not None):
+            process = self.processes[loop] = FanOutProcess()
+            process.started = asyncio.ensure_future(self.start(process))
+        await process.started
+        return process
+
+    async def start(self, process):
+        process.channel = await self.inner.new_channel(self.SUBSCRIPTION_PREFIX)
+        process.tasks = [asyncio.ensure_future(self.pump(process)),
+                         asyncio.ensure_future(self.maintain(process))]
+
+    def process_of(self, channel):
+        # The subscription channel a member channel belongs to, or None for
+        # channels that new_channel() did not make.
+        head, _, tail = channel.rpartition('.')
+        if channel.startswith(self.SUBSCRIPTION_PREFIX) and '!' in head and tail.isdigit():
+            return head
+        return None
+
+    def subscription(self, group):
+        name = f'{self.SUBSCRIPTION_PREFIX}.{group}'
+        if len(name) >= self.MAX_NAME_LENGTH:
+            name = f'{self.SUBSCRIPTION_PREFIX}.{hashlib.sha1(group.encode()).hexdigest()}'
+        return name
+
+    def deliver(self, process, channel, message):
+        queue = process.queues.setdefault(channel, asyncio.Queue())
+        if queue.qsize() >= self.get_capacity(channel):
+            return False
+        queue.put_nowait((time.time() + self.expiry, message))
+        return True
+
+    async def pump(self, process):
+        while True:
+            try:
+                message = await self.inner.receive(process.channel)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # Typically the inner layer's server went away; whatever
+                # comes back up has lost the subscriptions.
+                logger.exception('Fan-out receive on %s failed', process.channel)
+                await asyncio.sleep(1)
+                await self.subscribe_all(process)
+                continue
+            if message['type'] == 'fanout.group':
+                # Members that are full miss the message, as with group_send.
+                for channel in list(process.groups.get(message['group'], ())):
+                    self.deliver(process, channel, deepcopy(message['message']))
+            elif message['type'] == 'fanout.direct':
+                self.deliver(process, message['channel'], message['message'])
+
+    async def maintain(self, process):
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            now = time.time()
+            for channel, queue in list(process.queues.items()):
+                # Like the in-memory layer, a member that let a message
+                # expire is taken to be gone and leaves its groups.
+                while not queue.empty() and queue._queue[0][0] < now:
+                    queue.get_nowait()
+                    for group in list(process.groups):
+                        await self.leave(process, group, channel)
+                if queue.empty() and process.queues.get(channel) is queue and not queue._getters:
+                    del process.queues[channel]
+            for group, members in list(process.groups.items()):
+                for channel, joined_at in list(members.items()):
+                    if joined_at < now - self.group_expiry:
+                        await self.leave(process, group, channel)
+            try:
+                await self.subscribe_all(process)
+            except Exception:
+                logger.exception('Renewing fan-out subscriptions of %s failed', process.channel)
+
+    async def subscribe_all(self, process):
+        for group in list(process.groups):
+            await self.inner.group_add(self.subscription(group), process.channel)
+
+    async def leave(self, process, group, channel):
+        members = process.groups.get(group)
+        if members is None or members.pop(channel, None) is None or members:
+            return
+        del process.groups[group]
+        await self.inner.group_discard(self.subscription(group), process.channel)
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), 'message is not a dict'
+        assert self.valid_channel_name(channel), 'Channel name not valid'
+
+        owner = self.process_of(channel)
+        if owner is None:
+            return await self.inner.send(channel, message)
+        process = await self.process()
+        if owner == process.channel:
+            if not self.deliver(process, channel, deepcopy(message)):
+                raise ChannelFull(channel)
+        else:
+            await self.inner.send(owner, {'type': 'fanout.direct', 'channel': channel, 'message': message})
+
+    async def receive(self, channel):
+        assert self.valid_channel_name(channel)
+
+        if self.process_of(channel) is None:
+            return await self.inner.receive(channel)
+        process = await self.process()
+        queue = process.queues.setdefault(channel, asyncio.Queue())
+        try:
+            while True:
+                expires_at, message = await queue.get()
+                if expires_at >= time.time():
+                    return message
+        finally:
+            if queue.empty() and process.queues.get(channel) is queue:
+                del process.queues[channel]
+
+    async def new_channel(self, prefix='specific.'):
+        # The prefix is dropped: the name has to lead to this process.
+        process = await self.process()
+        return f'{process.channel}.{next(process.ids)}'
+
+    # Groups extension
+
+    async def group_add(self, group, channel):
+        assert self.valid_group_name(group), 'Group name not valid'
+        assert self.valid_channel_name(channel), 'Channel name not valid'
+
+        process = await self.process()
+        if self.process_of(channel) != process.channel:
+            return await self.inner.group_add(group, channel)
+        members = process.groups.setdefault(group, {})
+        members[channel] = time.time()
+        if len(members) == 1:
+            await self.inner.group_add(self.subscription(group), process.channel)
+
+    async def group_discard(self, group, channel):
+        assert self.valid_channel_name(channel), 'Invalid channel name'
+        assert self.valid_group_name(group), 'Invalid group name'
+
+        process = await self.process()
+        if self.process_of(channel) != process.channel:
+            return await self.inner.group_discard(group, channel)
+        await self.leave(process, group, channel)
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), 'Message is not a dict'
+        assert self.valid_group_name(group), 'Invalid group name'
+
+        # One message per subscribed process, plus whatever channels were
+        # added to the group without going through new_channel().
+        await self.inner.group_send(self.subscription(group),
+                                    {'type': 'fanout.group', 'group': group, 'message': message})
+        await self.inner.group_send(group, message)
+
+    # Flush extension
+
+    async def flush(self):
+        process = self.processes.get(asyncio.get_running_loop())
+        if process is not None:
+            process.queues.clear()
+            process.groups.clear()
+        await self.inner.flush()
+
+    async def close(self):
+        process = self.processes.pop(asyncio.get_running_loop(), None)
+        if process is not None:
+            for task in process.tasks:
+                task.cancel()
+        if hasattr(self.inner, 'close'):
+            await self.inner.close()
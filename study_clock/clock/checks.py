@@ -0,0 +1,26 @@
+from django.conf import settings
+from django.core.checks import Error, register
+import logging
+
+logger = logging.getLogger(__name__)
+
+LOCMEM_CACHE = 'django.core.cache.backends.locmem.LocMemCache'
+
+
+@register()
+def check_replica_pin_cache(app_configs, **kwargs):
+    # Read-your-writes pins (clock.routers) are only seen by the workers that
+    # can read them: in a per-process cache, a user who wrote through one
+    # worker is read from a lagging replica by the others.
+    routing = getattr(settings, 'DATABASE_ROUTING', {})
+    if not routing.get('REPLICAS'):
+        return []
+    alias = routing['CACHE']
+    if settings.CACHES.get(alias, {}).get('BACKEND') != LOCMEM_CACHE:
+        return []
+    return [Error(
+        f'DATABASE_ROUTING["CACHE"] is the per-process "{alias}" LocMemCache, but replicas are configured.',
+        hint='Point the pins at a cache shared by every worker, e.g. RESPONSE_CACHE_BACKEND=redis or file.',
+        obj='DATABASE_ROUTING',
+        id='clock.E001',
+    )]
@@ -1,16 +1,12 @@
 import json
 import logging
-import os
+from channels.db import database_sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
-import django
-
-logger = logging.getLogger(__name__)
-
-os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'study_clock.settings')
-django.setup()
-
 from .serializers import PrivateMessageSerializer
 from .models import PrivateMessage
+from .pomodoro import user_group
+
+logger = logging.getLogger(__name__)
 
 
 class ChatConsumer(AsyncWebsocketConsumer):
@@ -34,22 +30,25 @@ class ChatConsumer(AsyncWebsocketConsumer):
         content = data.get('content')
 
         if self.user.is_authenticated and content:
-            message = PrivateMessage.objects.create(
-                sender=self.user,
-                receiver_id=self.chat_user_id,
-                content=content,
-            )
-
-            serializer = PrivateMessageSerializer(instance=message)
+            message = await self.save_message(content)
 
             await self.channel_layer.group_send(
                 self.chat_room,
                 {
                     'type': 'chat_message',
-                    'message': serializer.data
+                    'message': message
                 }
             )
 
+    @database_sync_to_async
+    def save_message(self, content):
+        message = PrivateMessage.objects.create(
+            sender=self.user,
+            receiver_id=self.chat_user_id,
+            content=content,
+        )
+        return PrivateMessageSerializer(instance=message).data
+
     async def chat_message(self, event):
         message = event['message']
         await self.send(text_data=json.dumps(message))
@@ -94,3 +93,27 @@ class ChatConsumerSupport(AsyncWebsocketConsumer):
             'message': message,
             'username': username
         }))
+
+
+class PomodoroConsumer(AsyncWebsocketConsumer):
+    # Receives the events clock.pomodoro pushes to every connection of the
+    # user.
+    async def connect(self):
+        self.user = self.scope['user']
+        if not self.user.is_authenticated:
+            await self.close()
+            return
+        self.group_name = user_group(self.user.id)
+        await self.channel_layer.group_add(self.group_name, self.channel_name)
+        await self.accept()
+
+    async def disconnect(self, close_code):
+        if self.user.is_authenticated:
+            await self.channel_layer.group_discard(self.group_name, self.channel_name)
+
+    async def pomodoro_event(self, event):
+        await self.send(text_data=json.dumps({
+            'event': event['event'],
+            'message': event['message'],
+            'at': event['at'],
+        }))
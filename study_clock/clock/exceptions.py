@@ -0,0 +1,12 @@
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+
+class ConcurrentUpdateError(Exception):
+    pass
+
+
+class Conflict(APIException):
+    status_code = status.HTTP_409_CONFLICT
+    default_detail = 'The resource was modified by another request. Reload it and try again.'
+    default_code = 'conflict'
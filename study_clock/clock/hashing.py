@@ -0,0 +1,97 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.contrib.auth import authenticate, get_user_model
+from django.contrib.auth.hashers import make_password, verify_password
+from django.contrib.auth.signals import user_login_failed
+from django.db import connections
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class PoolSaturated(Exception):
+    pass
+
+
+class BoundedHasherPool:
+    # PBKDF2 in hashlib releases the GIL, so a thread pool spreads password
+    # hashing across cores without leaving the event loop blocked. At most
+    # `workers + queue_size` jobs are admitted; anything beyond that is
+    # refused immediately instead of piling up behind the workers.
+    def __init__(self, workers, queue_size):
+        self.workers = workers
+        self.queue_size = queue_size
+        self._slots = threading.BoundedSemaphore(workers + queue_size)
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='hasher')
+            return self._executor
+
+    async def run(self, func, *args):
+        if not self._slots.acquire(blocking=False):
+            logger.warning('Password hashing pool is saturated')
+            raise PoolSaturated()
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._get_executor(), func, *args)
+        finally:
+            self._slots.release()
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+                self._executor = None
+
+
+hasher_pool = BoundedHasherPool(settings.LOGIN_HASHER['WORKERS'], settings.LOGIN_HASHER['QUEUE_SIZE'])
+
+
+MODEL_BACKEND = 'django.contrib.auth.backends.ModelBackend'
+
+
+async def aauthenticate(request, username, password):
+    # authenticate() with the password hashing in the pool. For ModelBackend
+    # alone the user is looked up and saved on the caller's connection and
+    # only the hashing leaves it; the outcome is the same: inactive users are
+    # refused, an outdated hash is upgraded and failures send
+    # user_login_failed. Other backends run through authenticate() itself.
+    if settings.AUTHENTICATION_BACKENDS != [MODEL_BACKEND]:
+        return await hasher_pool.run(_authenticate, request, username, password)
+
+    user = await get_user_model()._default_manager.by_username(username).afirst()
+    if user is None:
+        # Hash anyway so that the response time does not reveal which
+        # usernames are registered.
+        await hasher_pool.run(make_password, password)
+        valid = False
+    else:
+        valid, must_update = await hasher_pool.run(verify_password, password, user.password)
+        if valid and must_update:
+            user.password = await hasher_pool.run(make_password, password)
+            await user.asave(update_fields=['password'])
+            logger.info('Password hash of user %s upgraded', user.username)
+        valid = valid and user.is_active
+
+    if not valid:
+        await user_login_failed.asend(sender='django.contrib.auth', request=request,
+                                      credentials={'username': username, 'password': '********************'})
+        return None
+    user.backend = MODEL_BACKEND
+    return user
+
+
+def _authenticate(request, username, password):
+    try:
+        return authenticate(request, username=username, password=password)
+    finally:
+        # The pool's threads are not request threads, so nothing else would
+        # close the connections they open.
+        connections.close_all()
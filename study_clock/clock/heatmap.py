@@ -0,0 +1,154 @@
+import datetime
+
+from django.conf import settings
+from django.db.models import BigIntegerField, Func
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+
+from .caching import STUDY_HEATMAP, cache_stats, generation, get_cache, make_key
+from .models import StudySession
+import logging
+
+logger = logging.getLogger(__name__)
+
+WEEKDAYS = ('Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday')
+EPOCH = datetime.date(1970, 1, 1)
+DEFAULT_DAYS = 365
+
+
+def parse_range(start, end, today=None):
+    # Inclusive local dates; the last DEFAULT_DAYS days when not given.
+    today = today or timezone.localdate()
+    try:
+        end = parse_date(end) if end else today
+        start = parse_date(start) if start else end - datetime.timedelta(days=DEFAULT_DAYS - 1)
+    except ValueError:
+        end = start = None
+    if start is None or end is None:
+        raise ValueError('start and end must be dates in the YYYY-MM-DD format')
+    if start > end:
+        raise ValueError('start must not be after end')
+    if (end - start).days >= settings.STUDY_HEATMAP['MAX_DAYS']:
+        raise ValueError(f'The range cannot be longer than {settings.STUDY_HEATMAP["MAX_DAYS"]} days')
+    return start, end
+
+
+class Epoch(Func):
+    # A datetime column as whole seconds since the epoch, so rows come back
+    # as ints for NumPy rather than datetimes parsed one by one.
+    output_field = BigIntegerField()
+
+    def as_sqlite(self, compiler, connection, **extra_context):
+        return self.as_sql(compiler, connection, template="CAST(strftime('%%%%s', %(expressions)s) AS INTEGER)",
+                           **extra_context)
+
+    def as_postgresql(self, compiler, connection, **extra_context):
+        return self.as_sql(compiler, connection, template='CAST(EXTRACT(EPOCH FROM %(expressions)s) AS BIGINT)',
+                           **extra_context)
+
+
+def utc_offsets(moments, tz):
+    # The zone's UTC offset in seconds at each moment. The zone is asked once
+    # per day of the span, plus a bisection to the second for each day on
+    # which the offset changes, instead of once per moment.
+    import numpy as np
+
+    if not moments.size:
+        return np.zeros(0, dtype=np.int64)
+
+    def offset(seconds):
+        return int(datetime.datetime.fromtimestamp(seconds, tz).utcoffset().total_seconds())
+
+    days = range(int(moments.min()) // 86400 * 86400, int(moments.max()) + 86400, 86400)
+    starts, offsets = [days[0]], [offset(days[0])]
+    for day in days[1:]:
+        current = offset(day)
+        if current == offsets[-1]:
+            continue
+        low, high = day - 86400, day
+        while high - low > 1:
+            middle = (low + high) // 2
+            if offset(middle) == offsets[-1]:
+                low = middle
+            else:
+                high = middle
+        starts.append(high)
+        offsets.append(current)
+    return np.array(offsets, dtype=np.int64)[np.searchsorted(starts, moments, side='right') - 1]
+
+
+def load_sessions(user_id, start, end, tz):
+    # Session ends in local time, as seconds since the epoch, and their
+    # lengths in minutes. A session counts where it overlaps the range, so
+    # one ending on the day after the range is loaded too.
+    import numpy as np
+
+    begin = timezone.make_aware(datetime.datetime.combine(start, datetime.time.min), tz)
+    finish = timezone.make_aware(datetime.datetime.combine(end + datetime.timedelta(days=2), datetime.time.min), tz)
+    rows = StudySession.objects.filter(user_id=user_id, ended_at__gte=begin, ended_at__lt=finish) \
+        .values_list(Epoch('ended_at'), 'minutes')
+    sessions = np.array(list(rows), dtype=np.int64).reshape(-1, 2)
+    ends, minutes = sessions[:, 0], sessions[:, 1]
+    return ends + utc_offsets(ends, tz), minutes
+
+
+def seconds_per_hour(ends, minutes, start, end):
+    # Seconds studied in each local hour of the range, splitting sessions
+    # across the hours they cover, with no Python loop over the sessions.
+    import numpy as np
+
+    hours = ((end - start).days + 1) * 24
+    origin = (start - EPOCH).days * 86400
+    stop = np.clip(ends - origin, 0, hours * 3600)
+    begin = np.clip(ends - minutes * 60 - origin, 0, hours * 3600)
+    covered = stop > begin
+    begin, stop = begin[covered], stop[covered]
+    first, last = begin // 3600, (stop - 1) // 3600
+
+    same = first == last
+    totals = np.zeros(hours)
+    totals += np.bincount(first[same], weights=stop[same] - begin[same], minlength=hours)
+    first, last, begin, stop = first[~same], last[~same], begin[~same], stop[~same]
+    totals += np.bincount(first, weights=(first + 1) * 3600 - begin, minlength=hours)
+    totals += np.bincount(last, weights=stop - last * 3600, minlength=hours)
+    # Whole hours in between: +1 from the hour after the first, -1 from the
+    # last, summed up.
+    steps = np.bincount(first + 1, minlength=hours + 1) - np.bincount(last, minlength=hours + 1)
+    totals += np.cumsum(steps)[:hours] * 3600
+    return totals
+
+
+def build_heatmap(ends, minutes, start, end):
+    import numpy as np
+
+    totals = seconds_per_hour(ends, minutes, start, end) / 60
+    hour = np.arange(totals.size)
+    weekday = (start.weekday() + hour // 24) % 7
+    heatmap = np.bincount(weekday * 24 + hour % 24, weights=totals, minlength=7 * 24).reshape(7, 24)
+    return {
+        'start': start.isoformat(),
+        'end': end.isoformat(),
+        'timezone': timezone.get_current_timezone_name(),
+        'total_minutes': round(float(totals.sum()), 2),
+        'weekdays': WEEKDAYS,
+        'heatmap': np.round(heatmap, 2).tolist(),
+        'daily': np.round(totals.reshape(-1, 24).sum(axis=1), 2).tolist(),
+    }
+
+
+def study_heatmap(user_id, start, end):
+    # Minutes studied per weekday and hour (7 rows of 24, Monday first) and
+    # per day of the range, cached per user and range until the user's next
+    # timer write. Returns the data and whether it came from the cache.
+    cache = get_cache()
+    key = make_key(STUDY_HEATMAP, user_id, generation(STUDY_HEATMAP, user_id), start, end)
+    data = cache.get(key)
+    if data is not None:
+        cache_stats.record(STUDY_HEATMAP, hit=True)
+        return data, True
+
+    cache_stats.record(STUDY_HEATMAP, hit=False)
+    ends, minutes = load_sessions(user_id, start, end, timezone.get_current_timezone())
+    data = build_heatmap(ends, minutes, start, end)
+    cache.set(key, data, settings.STUDY_HEATMAP['CACHE_TIMEOUT'])
+    return data, False
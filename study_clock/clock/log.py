@@ -0,0 +1,134 @@
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import queue
+import threading
+from datetime import datetime, timezone
+
+from django.utils.module_loading import import_string
+
+# Attributes every LogRecord has; anything else was passed through `extra`.
+RECORD_ATTRIBUTES = frozenset(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'module': record.module,
+            'line': record.lineno,
+            'process': record.process,
+            'thread': record.threadName,
+        }
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRIBUTES and key not in entry:
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        if record.stack_info:
+            entry['stack'] = self.formatStack(record.stack_info)
+        return json.dumps(entry, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    # Keeps one in every N records at or below `max_level` for the loggers in
+    # `rates` ({'clock': 10} samples clock and clock.*). Kept records carry
+    # `sampled_1_in` so that counts can be scaled back up.
+    def __init__(self, rates=None, max_level='DEBUG'):
+        super().__init__()
+        self.rates = dict(rates or {})
+        self.max_level = max_level if isinstance(max_level, int) else logging.getLevelName(max_level)
+        self._seen = {}
+        self._lock = threading.Lock()
+
+    def rate_for(self, name):
+        while name:
+            if name in self.rates:
+                return self.rates[name]
+            name = name.rpartition('.')[0]
+        return 1
+
+    def filter(self, record):
+        if record.levelno > self.max_level:
+            return True
+        rate = self.rate_for(record.name)
+        if rate <= 1:
+            return True
+        with self._lock:
+            seen = self._seen.get(record.name, 0)
+            self._seen[record.name] = seen + 1
+        if seen % rate:
+            return False
+        record.sampled_1_in = rate
+        return True
+
+
+_exception_formatter = logging.Formatter()
+
+
+def build_handler(config):
+    # A handler config in dictConfig form, e.g. {'class': ..., 'formatter': 'json', 'filename': ...};
+    # `formatter` names an entry of FORMATTERS.
+    config = dict(config)
+    handler_class = import_string(config.pop('class'))
+    level = config.pop('level', logging.NOTSET)
+    formatter = config.pop('formatter', None)
+    handler = handler_class(**config)
+    handler.setLevel(level)
+    if formatter is not None:
+        handler.setFormatter(FORMATTERS[formatter]())
+    return handler
+
+
+class QueueListenerHandler(logging.handlers.QueueHandler):
+    # Request threads only put records on a bounded queue; one listener
+    # thread per process formats them and owns the target handler (and its
+    # file lock). When the queue is full the record is dropped and counted
+    # instead of blocking the request.
+    def __init__(self, target, queue_size=10000):
+        super().__init__(queue.Queue(queue_size))
+        self.target = build_handler(target)
+        self.dropped = 0
+        self.listener = logging.handlers.QueueListener(self.queue, self.target, respect_handler_level=True)
+        self.listener.start()
+        atexit.register(self.close)
+
+    def prepare(self, record):
+        # Like QueueHandler.prepare, but the traceback is kept apart from the
+        # message so the listener's formatter can still place it.
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            record.exc_text = _exception_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        if self.listener is not None:
+            # Flushes whatever is still queued before the target is closed.
+            self.listener.stop()
+            self.listener = None
+            self.target.close()
+        super().close()
+
+
+FORMATTERS = {
+    'json': JsonFormatter,
+    'standard': lambda: logging.Formatter('[%(asctime)s] %(levelname)s [%(name)s:%(lineno)s] %(message)s',
+                                          '%Y-%m-%d %H:%M:%S'),
+}
@@ -0,0 +1,76 @@
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from multiprocessing import get_context
+
+import django
+from django.apps import apps
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+# Models are only imported inside the functions: a spawned worker imports
+# this module to unpickle them, before _init_worker has set Django up.
+
+
+def _init_worker(database_name):
+    if not apps.ready:
+        django.setup()
+    # The parent's database, which differs from the settings under the test
+    # runner.
+    connection.settings_dict['NAME'] = database_name
+
+
+def _replay(user_ids):
+    from clock import achievements
+
+    return achievements.replay(user_ids)
+
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+class Command(BaseCommand):
+    help = ('Computes the achievement progress and achievements of users who have none yet from their activities '
+            'and study sessions, reading the history in a process pool')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500, help='Users per worker task')
+        parser.add_argument('--workers', type=int, default=None,
+                            help='Reading processes; 0 reads in this process (default: CPU count)')
+        parser.add_argument('--all', action='store_true',
+                            help='Also recompute users who already have progress, replacing it')
+
+    def handle(self, *args, **options):
+        from clock import achievements
+        from clock.models import User
+
+        users = User.objects.order_by('pk')
+        if not options['all']:
+            users = users.filter(achievement_progress__isnull=True)
+        chunks = list(_chunks(users.values_list('pk', flat=True), options['chunk_size']))
+
+        pool = None
+        if options['workers'] != 0:
+            # Spawned rather than forked: a fork would copy this process's
+            # connections and threads, such as the logging queue listener,
+            # into a child that cannot use them.
+            pool = ProcessPoolExecutor(max_workers=options['workers'], mp_context=get_context('spawn'),
+                                       initializer=_init_worker, initargs=(connection.settings_dict['NAME'],))
+
+        backfilled = reached = 0
+        try:
+            # The workers only read; the results are written here, one chunk
+            # per transaction, so writers never contend with each other.
+            results = map(_replay, chunks) if pool is None else pool.map(_replay, chunks)
+            for progress, earned in results:
+                achievements.save(progress, earned, replace=options['all'])
+                backfilled += len(progress)
+                reached += len(earned)
+                self.stdout.write(f'{backfilled} users backfilled, {reached} achievements reached')
+        finally:
+            if pool is not None:
+                pool.shutdown()
+
+        self.stdout.write(self.style.SUCCESS(f'Done: {backfilled} users backfilled, {reached} achievements reached'))
@@ -0,0 +1,297 @@
+import asyncio
+import json
+import platform
+import random
+import time
+import uuid
+from datetime import date
+
+import django
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from clock import stats
+from clock.models import Activity, OutgoingEmail, PrivateMessage, User
+
+BENCH_PREFIX = 'bench_'
+BENCH_PASSWORD = 'bench-password'
+BENCH_HOST = 'localhost'
+# Endpoints with a native async version are benchmarked in both flavours;
+# ASYNC_SUFFIX marks the async one.
+ASYNC_SUFFIX = '-async'
+SCENARIOS = ('register', 'login', 'add-time', 'add-time-async', 'activities', 'activities-async', 'message-history',
+             'message-history-async', 'user-read', 'user-read-async', 'user-search')
+PERCENTILES = (50, 90, 95, 99)
+
+
+def percentile(ordered, p):
+    if not ordered:
+        return None
+    index = max(int(round(p / 100 * len(ordered))) - 1, 0)
+    return ordered[min(index, len(ordered) - 1)]
+
+
+def number(value, width):
+    # Results of a run too short to time hold None.
+    return f'{value:{width}.1f}' if value is not None else f'{"-":>{width}}'
+
+
+def comparable(result, reference):
+    # Ratios need both numbers, and a reference that is not zero.
+    return (result['throughput'] is not None and result['latency_ms']['p95'] is not None
+            and bool(reference['throughput']) and bool(reference['latency_ms']['p95']))
+
+
+class AsgiDriver:
+    # Calls the project's ASGI application directly with HTTP scopes, so the
+    # requests take the same path as under daphne minus the socket.
+    def __init__(self, application):
+        self.application = application
+
+    async def request(self, method, path, body=None, token=None, query=''):
+        payload = json.dumps(body).encode() if body is not None else b''
+        headers = [(b'host', BENCH_HOST.encode()), (b'content-type', b'application/json'),
+                   (b'content-length', str(len(payload)).encode())]
+        if token:
+            headers.append((b'authorization', f'Bearer {token}'.encode()))
+        scope = {
+            'type': 'http',
+            'asgi': {'version': '3.0'},
+            'http_version': '1.1',
+            'method': method,
+            'scheme': 'http',
+            'path': path,
+            'raw_path': path.encode(),
+            'query_string': query.encode(),
+            'root_path': '',
+            'headers': headers,
+            'client': ('127.0.0.1', 0),
+            'server': (BENCH_HOST, 80),
+        }
+        incoming = [{'type': 'http.request', 'body': payload, 'more_body': False}]
+        status = None
+
+        async def receive():
+            if incoming:
+                return incoming.pop()
+            # The client never disconnects; Django cancels this wait itself.
+            await asyncio.Future()
+
+        async def send(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+
+        await self.application(scope, receive, send)
+        return status
+
+
+class Command(BaseCommand):
+    help = ('Seeds a synthetic dataset, drives the main endpoints through the ASGI application and writes '
+            'throughput and latency percentiles as JSON, optionally comparing them with a saved baseline. '
+            'Seeded rows are prefixed with "bench_" and deleted afterwards.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000, help='Users to seed')
+        parser.add_argument('--activities', type=int, default=20, help='Activities per seeded user')
+        parser.add_argument('--messages', type=int, default=100, help='Messages per seeded user')
+        parser.add_argument('--requests', type=int, default=200, help='Requests per scenario')
+        parser.add_argument('--concurrency', type=int, default=16, help='Requests in flight at once')
+        parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                            help=f'Comma-separated subset of: {", ".join(SCENARIOS)}')
+        parser.add_argument('--output', default='bench.json', help='Where to write the results')
+        parser.add_argument('--baseline', help='Results file of an earlier run to compare against')
+        parser.add_argument('--tolerance', type=float, default=0.1,
+                            help='Allowed relative loss in throughput or p95 latency before a regression is reported')
+        parser.add_argument('--seed', type=int, default=0, help='Random seed for picking users')
+
+    def handle(self, *args, **options):
+        scenarios = [name.strip() for name in options['scenarios'].split(',') if name.strip()]
+        unknown = set(scenarios) - set(SCENARIOS)
+        if unknown:
+            raise CommandError(f'Unknown scenarios: {", ".join(sorted(unknown))}')
+        if options['users'] < 2:
+            raise CommandError('At least 2 users are needed')
+        if options['requests'] < 1 or options['concurrency'] < 1:
+            raise CommandError('--requests and --concurrency must be at least 1')
+        if settings.DEBUG:
+            self.stderr.write('DEBUG is on: every query is recorded in memory and the numbers will be pessimistic.')
+
+        from study_clock.asgi import application
+
+        self.random = random.Random(options['seed'])
+        self.run_id = uuid.uuid4().hex[:8]
+        self.prefix = f'{BENCH_PREFIX}{self.run_id}_'
+        try:
+            self.seed(options)
+            driver = AsgiDriver(application)
+            results = {}
+            for name in scenarios:
+                results[name] = asyncio.run(self.run_scenario(driver, name, options))
+                self.report(name, results[name])
+        finally:
+            self.cleanup()
+        self.compare_flavours(results)
+
+        document = {
+            'meta': {
+                'created_at': timezone.now().isoformat(),
+                'users': options['users'],
+                'activities_per_user': options['activities'],
+                'messages_per_user': options['messages'],
+                'requests': options['requests'],
+                'concurrency': options['concurrency'],
+                'database': connection.vendor,
+                'python': platform.python_version(),
+                'django': django.get_version(),
+            },
+            'scenarios': results,
+        }
+        with open(options['output'], 'w') as file:
+            json.dump(document, file, indent=2)
+        self.stdout.write(f'Results written to {options["output"]}')
+
+        if options['baseline']:
+            self.compare(document, options['baseline'], options['tolerance'])
+
+    def seed(self, options):
+        started = time.perf_counter()
+        password = make_password(BENCH_PASSWORD)
+        users = [
+            User(username=f'{self.prefix}{i}', email=f'{self.prefix}{i}@example.com', password=password,
+                 date_of_birth=date(1970 + i % 35, 1 + i % 12, 1 + i % 28), country=('US', 'BY', 'DE', 'PL')[i % 4])
+            for i in range(options['users'])
+        ]
+        with transaction.atomic():
+            User.objects.bulk_create(users, batch_size=1000)
+            stats.record_created(users)
+            self.users = list(User.objects.filter(username__startswith=self.prefix).order_by('pk'))
+            Activity.objects.bulk_create([
+                Activity(user=user, name=f'Activity {n}') for user in self.users for n in range(options['activities'])
+            ], batch_size=5000)
+            # Each user writes --messages messages to the next one.
+            PrivateMessage.objects.bulk_create([
+                PrivateMessage(sender=user, receiver=self.users[(i + 1) % len(self.users)], content=f'Message {n}')
+                for i, user in enumerate(self.users) for n in range(options['messages'])
+            ], batch_size=5000)
+        self.admin = User.objects.create_superuser(
+            username=f'{self.prefix}admin', email=f'{self.prefix}admin@example.com', password=BENCH_PASSWORD,
+            date_of_birth='1990-01-01', country='US'
+        )
+        self.tokens = {user.pk: str(RefreshToken.for_user(user).access_token) for user in [*self.users, self.admin]}
+        self.stdout.write(f'Seeded {len(self.users)} users in {time.perf_counter() - started:.1f}s')
+
+    def cleanup(self):
+        deleted, _ = User.objects.filter(username__startswith=self.prefix).delete()
+        # Confirmation emails queued by the register scenario must not go out.
+        OutgoingEmail.objects.filter(to__startswith=self.prefix).delete()
+        self.stdout.write(f'Removed {deleted} seeded rows')
+
+    def build_requests(self, name, options):
+        for i in range(options['requests']):
+            index = self.random.randrange(len(self.users))
+            user = self.users[index]
+            token = self.tokens[user.pk]
+            if name == 'register':
+                username = f'{self.prefix}reg_{i}'
+                yield 'POST', reverse('register'), {
+                    'first_name': 'Bench', 'last_name': 'User', 'username': username,
+                    'email': f'{username}@example.com', 'password': BENCH_PASSWORD,
+                    'date_of_birth': '1995-05-05', 'country': 'US',
+                }, None, ''
+            elif name == 'login':
+                yield 'POST', reverse('login'), {'username': user.username, 'password': BENCH_PASSWORD}, None, ''
+            elif name in ('add-time', 'add-time-async'):
+                activity = f'Activity {self.random.randrange(max(options["activities"], 1))}'
+                yield 'POST', reverse(name), {'name': activity, 'time': 5}, token, ''
+            elif name in ('activities', 'activities-async'):
+                yield 'GET', reverse(name.replace('activities', 'all-activities')), None, token, ''
+            elif name in ('message-history', 'message-history-async'):
+                peer = self.users[(index + 1) % len(self.users)]
+                yield 'GET', reverse(name, args=[peer.pk]), None, token, ''
+            elif name in ('user-read', 'user-read-async'):
+                yield 'GET', reverse(name), None, token, ''
+            elif name == 'user-search':
+                yield 'GET', reverse('user-list'), None, self.tokens[self.admin.pk], f'search={user.username}'
+
+    async def run_scenario(self, driver, name, options):
+        pending = list(self.build_requests(name, options))
+        latencies = []
+        statuses = {}
+        semaphore = asyncio.Semaphore(options['concurrency'])
+
+        async def send(method, path, body, token, query):
+            async with semaphore:
+                started = time.perf_counter()
+                status = await driver.request(method, path, body, token, query)
+                latencies.append(time.perf_counter() - started)
+                statuses[str(status)] = statuses.get(str(status), 0) + 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(send(*request) for request in pending))
+        elapsed = time.perf_counter() - started
+
+        latencies.sort()
+        errors = sum(count for status, count in statuses.items() if not status.startswith('2'))
+        return {
+            'requests': len(latencies),
+            'errors': errors,
+            'statuses': statuses,
+            'seconds': round(elapsed, 4),
+            'throughput': round(len(latencies) / elapsed, 2) if elapsed else None,
+            'latency_ms': {
+                'mean': round(sum(latencies) / len(latencies) * 1000, 3) if latencies else None,
+                **{f'p{p}': round(percentile(latencies, p) * 1000, 3) if latencies else None for p in PERCENTILES},
+                'max': round(latencies[-1] * 1000, 3) if latencies else None,
+            },
+        }
+
+    def report(self, name, result):
+        latency = result['latency_ms']
+        self.stdout.write(
+            f'{name:<24} {number(result["throughput"], 9)} req/s  p50 {number(latency["p50"], 8)} ms  '
+            f'p95 {number(latency["p95"], 8)} ms  p99 {number(latency["p99"], 8)} ms  errors {result["errors"]}'
+        )
+
+    def compare_flavours(self, results):
+        for name, result in results.items():
+            sync_result = results.get(name.removesuffix(ASYNC_SUFFIX))
+            if not name.endswith(ASYNC_SUFFIX) or sync_result is None:
+                continue
+            if not comparable(result, sync_result):
+                self.stdout.write(f'{name:<24} no throughput or p95 to compare with the sync flavour')
+                continue
+            self.stdout.write(
+                f'{name:<24} async/sync throughput {result["throughput"] / sync_result["throughput"]:5.2f}x  '
+                f'p95 {result["latency_ms"]["p95"] / sync_result["latency_ms"]["p95"]:5.2f}x'
+            )
+
+    def compare(self, document, baseline_path, tolerance):
+        with open(baseline_path) as file:
+            baseline = json.load(file)
+
+        regressions = []
+        for name, current in document['scenarios'].items():
+            previous = baseline.get('scenarios', {}).get(name)
+            if previous is None:
+                self.stdout.write(f'{name:<24} not in the baseline')
+                continue
+            if not comparable(current, previous):
+                self.stdout.write(f'{name:<24} no throughput or p95 to compare with the baseline')
+                continue
+            throughput = current['throughput'] / previous['throughput'] - 1
+            p95 = current['latency_ms']['p95'] / previous['latency_ms']['p95'] - 1
+            regressed = throughput < -tolerance or p95 > tolerance
+            self.stdout.write(
+                f'{name:<24} throughput {throughput:+7.1%}  p95 {p95:+7.1%}  {"REGRESSION" if regressed else "ok"}'
+            )
+            if regressed:
+                regressions.append(name)
+
+        if regressions:
+            raise CommandError(f'Regressed beyond {tolerance:.0%}: {", ".join(regressions)}')
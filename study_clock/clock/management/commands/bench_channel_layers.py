@@ -0,0 +1,184 @@
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from channels.layers import InMemoryChannelLayer
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from clock.channel_layers import LocalFanOutChannelLayer, UnixSocketChannelLayer, broker_running
+
+# A "+fanout" suffix wraps the layer in LocalFanOutChannelLayer.
+FAN_OUT_SUFFIX = '+fanout'
+LAYERS = ('memory', 'unix', f'unix{FAN_OUT_SUFFIX}', 'redis', f'redis{FAN_OUT_SUFFIX}')
+
+
+class Command(BaseCommand):
+    help = ('Measures channel layer throughput: point-to-point messages between two coroutines and group fan-out '
+            'to many member channels, for the in-memory layer, the unix socket layer (with its broker in its own '
+            'process) and Redis when one is reachable, each also with process-local group fan-out (where '
+            'point-to-point messages between channels of one process never leave it).')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=5000, help='Point-to-point messages')
+        parser.add_argument('--members', type=int, default=100, help='Channels in the fan-out group')
+        parser.add_argument('--broadcasts', type=int, default=50, help='Group sends in the fan-out run')
+        parser.add_argument('--layers', default=','.join(LAYERS),
+                            help=f'Comma-separated subset of: {", ".join(LAYERS)}')
+        parser.add_argument('--redis-host', default=os.environ.get('REDIS_HOST', 'localhost'), help='Redis host')
+        parser.add_argument('--redis-port', type=int, default=int(os.environ.get('REDIS_PORT', '6379')),
+                            help='Redis port')
+        parser.add_argument('--output', help='Also write the results as JSON to this file')
+
+    def handle(self, *args, **options):
+        names = [name.strip() for name in options['layers'].split(',') if name.strip()]
+        unknown = set(names) - set(LAYERS)
+        if unknown:
+            raise CommandError(f'Unknown layers: {", ".join(sorted(unknown))}')
+        # Large enough that neither run ever hits ChannelFull.
+        capacity = max(options['messages'], options['broadcasts']) + 1
+
+        results = {}
+        for name in names:
+            with self.layer(name.removesuffix(FAN_OUT_SUFFIX), capacity, options) as layer:
+                if layer is None:
+                    continue
+                if name.endswith(FAN_OUT_SUFFIX):
+                    layer = LocalFanOutChannelLayer(layer)
+                results[name] = {
+                    'point_to_point': asyncio.run(self.point_to_point(layer, options['messages'])),
+                    'fan_out': asyncio.run(self.fan_out(layer, options['members'], options['broadcasts'])),
+                }
+            self.report(name, results[name], results.get('memory'))
+
+        if options['output']:
+            with open(options['output'], 'w') as file:
+                json.dump({'options': {key: options[key] for key in ('messages', 'members', 'broadcasts')},
+                           'layers': results}, file, indent=2)
+            self.stdout.write(f'Results written to {options["output"]}')
+
+    def layer(self, name, capacity, options):
+        if name == 'memory':
+            return LayerContext(InMemoryChannelLayer(capacity=capacity))
+        if name == 'unix':
+            return BrokerContext(capacity)
+        return RedisContext(self, capacity, options['redis_host'], options['redis_port'])
+
+    async def point_to_point(self, layer, total):
+        channel = await layer.new_channel()
+
+        async def produce():
+            for number in range(total):
+                await layer.send(channel, {'type': 'bench.message', 'number': number})
+
+        async def consume():
+            for _ in range(total):
+                await layer.receive(channel)
+
+        started = time.perf_counter()
+        await asyncio.gather(produce(), consume())
+        elapsed = time.perf_counter() - started
+        await layer.flush()
+        await layer.close()
+        return {'messages': total, 'seconds': round(elapsed, 4), 'per_second': round(total / elapsed, 1)}
+
+    async def fan_out(self, layer, members, broadcasts):
+        group = 'bench_fan_out'
+        channels = [await layer.new_channel() for _ in range(members)]
+        for channel in channels:
+            await layer.group_add(group, channel)
+
+        async def consume(channel):
+            for _ in range(broadcasts):
+                await layer.receive(channel)
+
+        async def produce():
+            for number in range(broadcasts):
+                await layer.group_send(group, {'type': 'bench.message', 'number': number})
+
+        started = time.perf_counter()
+        await asyncio.gather(produce(), *(consume(channel) for channel in channels))
+        elapsed = time.perf_counter() - started
+        await layer.flush()
+        await layer.close()
+        deliveries = members * broadcasts
+        return {'deliveries': deliveries, 'seconds': round(elapsed, 4),
+                'broadcasts_per_second': round(broadcasts / elapsed, 1),
+                'deliveries_per_second': round(deliveries / elapsed, 1)}
+
+    def report(self, name, result, memory):
+        point, fan = result['point_to_point'], result['fan_out']
+        line = (f'{name:<14} point-to-point {point["per_second"]:10.1f} msg/s   '
+                f'fan-out {fan["deliveries_per_second"]:10.1f} deliveries/s ({fan["broadcasts_per_second"]:.1f} '
+                f'group sends/s)')
+        if memory is not None and name != 'memory':
+            line += (f'   vs memory {point["per_second"] / memory["point_to_point"]["per_second"]:.2f}x / '
+                     f'{fan["deliveries_per_second"] / memory["fan_out"]["deliveries_per_second"]:.2f}x')
+        self.stdout.write(line)
+
+
+class LayerContext:
+    def __init__(self, layer):
+        self.layer = layer
+
+    def __enter__(self):
+        return self.layer
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+class BrokerContext:
+    # Starts a broker on a temporary socket, in its own process as in a
+    # deployment, so every message crosses the socket.
+    def __init__(self, capacity):
+        self.capacity = capacity
+
+    def __enter__(self):
+        self.directory = tempfile.TemporaryDirectory()
+        path = os.path.join(self.directory.name, 'channels.sock')
+        self.broker = subprocess.Popen([sys.executable, os.path.join(settings.BASE_DIR, 'manage.py'),
+                                        'channel_broker', '--socket', path], stdout=subprocess.DEVNULL)
+        deadline = time.monotonic() + 30
+        while not broker_running(path):
+            if self.broker.poll() is not None or time.monotonic() > deadline:
+                self.__exit__()
+                raise CommandError('The channel broker failed to start')
+            time.sleep(0.05)
+        return UnixSocketChannelLayer(path, capacity=self.capacity)
+
+    def __exit__(self, *exc_info):
+        self.broker.terminate()
+        self.broker.wait()
+        self.directory.cleanup()
+        return False
+
+
+class RedisContext:
+    def __init__(self, command, capacity, host, port):
+        self.command = command
+        self.capacity = capacity
+        self.address = (host, port)
+
+    def __enter__(self):
+        try:
+            from channels_redis.core import RedisChannelLayer
+            from redis.exceptions import RedisError
+        except ImportError:
+            self.command.stderr.write('channels_redis is not installed; skipping redis')
+            return None
+        layer = RedisChannelLayer(hosts=[self.address], capacity=self.capacity)
+        try:
+            asyncio.run(asyncio.wait_for(layer.flush(), 2))
+        except (RedisError, OSError, asyncio.TimeoutError) as exc:
+            self.command.stderr.write(f'Redis at {self.address[0]}:{self.address[1]} is not reachable ({exc}); '
+                                      f'skipping redis')
+            return None
+        return layer
+
+    def __exit__(self, *exc_info):
+        return False
@@ -0,0 +1,88 @@
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from clock.log import QueueListenerHandler, SamplingFilter, build_handler
+
+BENCH_LOGGER = 'clock.bench'
+
+
+class Command(BaseCommand):
+    help = 'Measures the time request threads spend logging with the file and queue logging modes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=2000, help='Simulated requests per thread')
+        parser.add_argument('--threads', type=int, default=4, help='Request threads logging at once')
+        parser.add_argument('--debug-lines', type=int, default=3, help='DEBUG records per request')
+        parser.add_argument('--info-lines', type=int, default=1, help='INFO records per request')
+
+    def handle(self, *args, **options):
+        directory = tempfile.mkdtemp(prefix='bench_logging_')
+        try:
+            modes = {
+                'none': lambda: logging.NullHandler(),
+                'file': lambda: self.file_mode(directory),
+                'queue': lambda: self.queue_mode(directory, sampling=False),
+                'queue+sampling': lambda: self.queue_mode(directory, sampling=True),
+            }
+            baseline = None
+            for name, make_handler in modes.items():
+                per_request, drain = self.run_mode(make_handler(), options)
+                if baseline is None:
+                    baseline = per_request
+                self.stdout.write(
+                    f'{name:<15} {per_request:8.1f} us/request  '
+                    f'(+{per_request - baseline:.1f} us over no logging, listener drained in {drain * 1000:.0f} ms)'
+                )
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def file_mode(self, directory):
+        config = {**settings.LOG_FILE_HANDLER, 'filename': os.path.join(directory, 'file.log'), 'formatter': 'standard'}
+        return build_handler(config)
+
+    def queue_mode(self, directory, sampling):
+        name = 'queue-sampled.log' if sampling else 'queue.log'
+        target = {**settings.LOG_FILE_HANDLER, 'filename': os.path.join(directory, name), 'formatter': 'json'}
+        handler = QueueListenerHandler(target, queue_size=1_000_000)
+        if sampling:
+            handler.addFilter(SamplingFilter({BENCH_LOGGER: settings.LOG_SAMPLING.get('clock', 10)}))
+        return handler
+
+    def run_mode(self, handler, options):
+        logger = logging.getLogger(BENCH_LOGGER)
+        previous = logger.handlers[:], logger.level, logger.propagate
+        logger.handlers = [handler]
+        logger.setLevel(logging.DEBUG)
+        logger.propagate = False
+
+        def simulate_requests():
+            for request in range(options['requests']):
+                for line in range(options['debug_lines']):
+                    logger.debug('Request %d step %d for user %s', request, line, 'bench')
+                for line in range(options['info_lines']):
+                    logger.info('Request %d finished', request, extra={'user_id': request})
+
+        threads = [threading.Thread(target=simulate_requests) for _ in range(options['threads'])]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        # The time the listener needs to catch up is reported separately: it
+        # is spent off the request threads.
+        drain_started = time.perf_counter()
+        handler.close()
+        drain = time.perf_counter() - drain_started
+
+        logger.handlers, level, logger.propagate = previous
+        logger.setLevel(level)
+        return elapsed / (options['requests'] * options['threads']) * 1e6, drain
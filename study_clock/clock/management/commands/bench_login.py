@@ -0,0 +1,55 @@
+import asyncio
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.test import AsyncClient, override_settings
+from django.urls import reverse
+
+from clock.models import User
+
+BENCH_USERNAME = 'bench_login_user'
+BENCH_PASSWORD = 'bench-login-password'
+
+
+class Command(BaseCommand):
+    help = 'Measures login throughput of one worker for the sync and async login endpoints'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=200, help='Logins per endpoint')
+        parser.add_argument('--concurrency', type=int, default=16, help='Logins in flight at once')
+
+    def handle(self, *args, **options):
+        user = User.objects.create_user(
+            username=BENCH_USERNAME,
+            email=f'{BENCH_USERNAME}@example.com',
+            password=BENCH_PASSWORD,
+            date_of_birth='2000-01-01',
+            country='US'
+        )
+        try:
+            with override_settings(ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver']):
+                for url_name in ('login', 'login-async'):
+                    elapsed, codes = asyncio.run(self.run_endpoint(reverse(url_name), options['requests'],
+                                                                   options['concurrency']))
+                    self.stdout.write(
+                        f'{url_name:<12} {options["requests"] / elapsed:8.1f} logins/s  '
+                        f'({elapsed:.2f}s, concurrency {options["concurrency"]}, statuses {dict(codes)})'
+                    )
+        finally:
+            user.delete()
+
+    async def run_endpoint(self, url, total, concurrency):
+        client = AsyncClient()
+        semaphore = asyncio.Semaphore(concurrency)
+        codes = {}
+
+        async def login():
+            async with semaphore:
+                response = await client.post(url, {'username': BENCH_USERNAME, 'password': BENCH_PASSWORD},
+                                             content_type='application/json')
+                codes[response.status_code] = codes.get(response.status_code, 0) + 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*(login() for _ in range(total)))
+        return time.perf_counter() - start, sorted(codes.items())
@@ -0,0 +1,46 @@
+import asyncio
+import os
+import signal
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from clock.channel_layers import ChannelBroker, broker_running, transport_settings
+
+
+def default_socket():
+    return transport_settings(settings.CHANNEL_LAYERS.get('default', {})).get('CONFIG', {}).get('path')
+
+
+class Command(BaseCommand):
+    help = ('Runs the broker behind clock.channel_layers.UnixSocketChannelLayer, which holds the channels and '
+            'groups shared by the worker processes of this host. `manage.py serve` starts one by itself.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--socket', default=default_socket(),
+                            help='Path of the Unix socket (default: the path of the default channel layer)')
+
+    def handle(self, *args, **options):
+        path = options['socket']
+        if not path:
+            raise CommandError('No socket path given and the default channel layer has none')
+        if broker_running(path):
+            raise CommandError(f'A broker is already listening on {path}')
+        if os.path.exists(path):
+            # Left behind by a broker that did not exit cleanly.
+            os.unlink(path)
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        asyncio.run(self.run(path))
+
+    async def run(self, path):
+        task = asyncio.create_task(ChannelBroker().serve(path))
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, task.cancel)
+        self.stdout.write(f'Channel broker listening on {path} (pid {os.getpid()})')
+        self.stdout.flush()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        self.stdout.write('Channel broker stopped')
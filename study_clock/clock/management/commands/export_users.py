@@ -0,0 +1,46 @@
+import csv
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.core.serializers.json import DjangoJSONEncoder
+
+from clock.models import User
+
+EXPORT_FIELDS = ('username', 'email', 'first_name', 'last_name', 'date_of_birth', 'country', 'is_premium',
+                 'email_confirmed', 'date_joined')
+
+
+class Command(BaseCommand):
+    help = 'Streams the user table to CSV or JSONL without loading it into memory'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', default='-', help="Output file, or '-' for stdout")
+        parser.add_argument('--format', choices=('csv', 'jsonl'), default='csv')
+        parser.add_argument('--chunk-size', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        if options['output'] == '-':
+            stream = self.stdout
+        else:
+            try:
+                stream = open(options['output'], 'w', newline='', encoding='utf-8')
+            except OSError as e:
+                raise CommandError(e)
+
+        rows = User.objects.order_by('pk').values_list(*EXPORT_FIELDS).iterator(chunk_size=options['chunk_size'])
+        count = 0
+        try:
+            if options['format'] == 'csv':
+                writer = csv.writer(stream)
+                writer.writerow(EXPORT_FIELDS)
+                for row in rows:
+                    writer.writerow(row)
+                    count += 1
+            else:
+                for row in rows:
+                    stream.write(json.dumps(dict(zip(EXPORT_FIELDS, row)), cls=DjangoJSONEncoder) + '\n')
+                    count += 1
+        finally:
+            if stream is not self.stdout:
+                stream.close()
+        self.stderr.write(f'{count} users exported')
@@ -0,0 +1,18 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = 'Pre-renders the OpenAPI schema into API_SCHEMA["DIR"] so workers serve it without generating it.'
+
+    def handle(self, *args, **options):
+        if not settings.API_DOCS:
+            raise CommandError('API documentation is disabled (API_DOCS=0)')
+        from clock.schema import FORMATS, render_schema, schema_file
+
+        rendered = render_schema()
+        for extension in FORMATS:
+            path = schema_file(extension)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_bytes(rendered[extension])
+            self.stdout.write(f'Wrote {path} ({len(rendered[extension])} bytes)')
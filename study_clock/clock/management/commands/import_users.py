@@ -0,0 +1,129 @@
+import csv
+import json
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+import django
+from django.apps import apps
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from clock import stats
+from clock.models import User
+from clock.serializers import UserImportSerializer
+
+
+def _init_worker():
+    if not apps.ready:
+        django.setup()
+
+
+def _read_rows(stream, fmt):
+    if fmt == 'csv':
+        for line_number, row in enumerate(csv.DictReader(stream), start=2):
+            yield line_number, row
+    else:
+        for line_number, line in enumerate(stream, start=1):
+            if not line.strip():
+                continue
+            try:
+                yield line_number, json.loads(line)
+            except ValueError as e:
+                yield line_number, e
+
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+class Command(BaseCommand):
+    help = 'Imports users from a CSV or JSONL file in chunks, hashing passwords in a process pool'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="Input file, or '-' for stdin")
+        parser.add_argument('--format', choices=('csv', 'jsonl'), help='Defaults to the file extension')
+        parser.add_argument('--chunk-size', type=int, default=1000)
+        parser.add_argument('--workers', type=int, default=None,
+                            help='Hashing processes; 0 hashes in this process (default: CPU count)')
+
+    def handle(self, *args, **options):
+        fmt = options['format'] or ('jsonl' if options['path'].endswith(('.jsonl', '.json')) else 'csv')
+        if options['path'] == '-':
+            stream = sys.stdin
+        else:
+            try:
+                stream = open(options['path'], newline='', encoding='utf-8')
+            except OSError as e:
+                raise CommandError(e)
+
+        pool = None
+        if options['workers'] != 0:
+            pool = ProcessPoolExecutor(max_workers=options['workers'], initializer=_init_worker)
+
+        created = failed = 0
+        try:
+            for chunk in _chunks(_read_rows(stream, fmt), options['chunk_size']):
+                valid, errors = self.validate_chunk(chunk)
+                for line_number, error in errors:
+                    self.stderr.write(f'line {line_number}: {error}')
+                failed += len(errors)
+                created += self.create_chunk(valid, pool)
+                self.stdout.write(f'{created} users imported, {failed} rows rejected')
+        finally:
+            if pool is not None:
+                pool.shutdown()
+            if stream is not sys.stdin:
+                stream.close()
+
+        self.stdout.write(self.style.SUCCESS(f'Done: {created} users imported, {failed} rows rejected'))
+
+    def validate_chunk(self, chunk):
+        valid, errors = [], []
+        for line_number, row in chunk:
+            if isinstance(row, Exception):
+                errors.append((line_number, f'malformed JSON: {row}'))
+                continue
+            serializer = UserImportSerializer(data=row)
+            if serializer.is_valid():
+                valid.append((line_number, serializer.validated_data))
+            else:
+                errors.append((line_number, json.dumps(serializer.errors)))
+
+        # Uniqueness is checked for the whole chunk at once instead of with
+        # two queries per row, case-insensitively to match the unique indexes.
+        usernames = {data['username'] for _, data in valid}
+        emails = {data['email'] for _, data in valid}
+        taken_usernames = {name.lower() for name in User.objects.by_usernames(usernames).values_list('username', flat=True)}
+        taken_emails = {email.lower() for email in User.objects.by_emails(emails).values_list('email', flat=True)}
+
+        unique = []
+        for line_number, data in valid:
+            if data['username'].lower() in taken_usernames:
+                errors.append((line_number, f'username {data["username"]!r} already exists'))
+            elif data['email'].lower() in taken_emails:
+                errors.append((line_number, f'email {data["email"]!r} already exists'))
+            else:
+                taken_usernames.add(data['username'].lower())
+                taken_emails.add(data['email'].lower())
+                unique.append(data)
+        return unique, errors
+
+    def create_chunk(self, rows, pool):
+        if not rows:
+            return 0
+        passwords = [data.pop('password') for data in rows]
+        if pool is None:
+            hashes = [make_password(password) for password in passwords]
+        else:
+            hashes = list(pool.map(make_password, passwords, chunksize=max(len(passwords) // 32, 1)))
+
+        users = [User(password=password_hash, **data) for data, password_hash in zip(rows, hashes)]
+        with transaction.atomic():
+            User.objects.bulk_create(users)
+            # bulk_create sends no post_save, so count the chunk explicitly.
+            stats.record_created(users)
+        return len(users)
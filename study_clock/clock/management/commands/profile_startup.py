@@ -0,0 +1,106 @@
+import json
+import os
+import subprocess
+import sys
+import time
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.urls import reverse
+
+STARTUP_DONE = '-- startup done --'
+
+# Runs in a fresh interpreter under -X importtime, so nothing is imported yet.
+CHILD = '''
+import asyncio, json, sys, time
+started = time.perf_counter()
+from study_clock.asgi import application
+imported = time.perf_counter()
+sys.stderr.write({marker!r} + '\\n')
+sys.stderr.flush()
+from clock.management.commands.bench import AsgiDriver
+requested = time.perf_counter()
+status = asyncio.run(AsgiDriver(application).request('GET', {path!r}))
+print(json.dumps({{'import': imported - started, 'first_request': time.perf_counter() - requested,
+                  'status': status}}))
+'''
+
+
+def parse_importtime(lines):
+    # Lines look like "import time:  self [us] | cumulative | indented.name".
+    modules = []
+    for line in lines:
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        own, cumulative, name = line[len('import time:'):].split('|')
+        modules.append((name.strip(), int(own) / 1e6, int(cumulative) / 1e6))
+    return modules
+
+
+class Command(BaseCommand):
+    help = ('Starts the ASGI application in a fresh interpreter and reports import time per module and package, '
+            'the time to import the application and the time to serve its first request.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', help='Path of the first request (default: the user-read endpoint)')
+        parser.add_argument('--top', type=int, default=20, help='Modules to list, slowest first')
+        parser.add_argument('--output', help='Also write the report as JSON to this file')
+        parser.add_argument('--budget', type=float,
+                            help='Fail if importing the application and serving its first request take longer '
+                                 'than this many seconds')
+
+    def handle(self, *args, **options):
+        code = CHILD.format(marker=STARTUP_DONE, path=options['path'] or reverse('user-read'))
+        started = time.perf_counter()
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], capture_output=True, text=True,
+                                cwd=settings.BASE_DIR)
+        wall = time.perf_counter() - started
+        if result.returncode:
+            raise CommandError(f'The application failed to start:\n{result.stderr}')
+
+        stderr = result.stderr.splitlines()
+        if STARTUP_DONE not in stderr:
+            raise CommandError(f'The application failed to start:\n{result.stderr}')
+        modules = parse_importtime(stderr[:stderr.index(STARTUP_DONE)])
+        timings = json.loads(result.stdout.strip().splitlines()[-1])
+
+        packages = defaultdict(float)
+        for name, own, _ in modules:
+            packages[name.split('.')[0]] += own
+
+        report = {
+            'python': sys.version.split()[0],
+            'settings': os.environ['DJANGO_SETTINGS_MODULE'],
+            'modules_imported': len(modules),
+            'import_seconds': round(timings['import'], 4),
+            'first_request_seconds': round(timings['first_request'], 4),
+            'first_request_status': timings['status'],
+            'wall_seconds': round(wall, 4),
+            'packages': {name: round(seconds, 4) for name, seconds in
+                         sorted(packages.items(), key=lambda item: item[1], reverse=True)},
+            'modules': [{'name': name, 'self': round(own, 4), 'cumulative': round(cumulative, 4)} for
+                        name, own, cumulative in sorted(modules, key=lambda module: module[1],
+                                                        reverse=True)[:options['top']]],
+        }
+
+        self.stdout.write(f'{len(modules)} modules imported')
+        self.stdout.write(f'{"package":<32} {"self ms":>9}')
+        for name, seconds in list(report['packages'].items())[:options['top']]:
+            self.stdout.write(f'{name:<32} {seconds * 1000:9.1f}')
+        self.stdout.write(f'\n{"module":<48} {"self ms":>9} {"cumul. ms":>10}')
+        for module in report['modules']:
+            self.stdout.write(f'{module["name"]:<48} {module["self"] * 1000:9.1f} {module["cumulative"] * 1000:10.1f}')
+        self.stdout.write(
+            f'\nimport {timings["import"] * 1000:.1f} ms, first request {timings["first_request"] * 1000:.1f} ms '
+            f'(status {timings["status"]}), process start to exit {wall * 1000:.1f} ms'
+        )
+
+        if options['output']:
+            with open(options['output'], 'w') as file:
+                json.dump(report, file, indent=2)
+            self.stdout.write(f'Report written to {options["output"]}')
+
+        startup = timings['import'] + timings['first_request']
+        if options['budget'] is not None and startup > options['budget']:
+            raise CommandError(f'Startup took {startup:.2f}s, over the {options["budget"]:.2f}s budget')
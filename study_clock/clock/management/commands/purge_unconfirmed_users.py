@@ -0,0 +1,53 @@
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from clock.models import User
+
+
+class Command(BaseCommand):
+    help = 'Deletes accounts whose email was never confirmed, in short chunked transactions'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=settings.UNCONFIRMED_ACCOUNT_MAX_AGE_DAYS,
+                            help='Only delete accounts that joined more than this many days ago')
+        parser.add_argument('--chunk-size', type=int, default=500)
+        parser.add_argument('--pause', type=float, default=0.0, help='Seconds to sleep between chunks')
+        parser.add_argument('--dry-run', action='store_true')
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(days=options['days'])
+        candidates = User.objects.filter(
+            email_confirmed=False,
+            # An account that confirmed once and has since changed its
+            # address is not abandoned.
+            email_first_confirmed_at__isnull=True,
+            date_joined__lt=cutoff,
+            is_staff=False,
+            is_superuser=False,
+        )
+        if options['dry_run']:
+            self.stdout.write(f'{candidates.count()} unconfirmed users would be deleted')
+            return
+
+        # Each chunk is its own short transaction, so row locks are held only
+        # for the duration of one small delete.
+        deleted = 0
+        last_pk = 0
+        while True:
+            pks = list(candidates.filter(pk__gt=last_pk).order_by('pk').values_list('pk', flat=True)[:options['chunk_size']])
+            if not pks:
+                break
+            with transaction.atomic():
+                _, per_model = candidates.filter(pk__in=pks).delete()
+            deleted += per_model.get(User._meta.label, 0)
+            last_pk = pks[-1]
+            self.stdout.write(f'{deleted} unconfirmed users deleted')
+            if options['pause']:
+                time.sleep(options['pause'])
+
+        self.stdout.write(self.style.SUCCESS(f'Done: {deleted} unconfirmed users deleted'))
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from clock import stats
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the demographic counters behind /api/stats/users/ from the user table'
+
+    def handle(self, *args, **options):
+        stats.rebuild()
+        summary = stats.summary()
+        self.stdout.write(self.style.SUCCESS(f'Demographic counters rebuilt for {summary["total_users"]} users'))
@@ -0,0 +1,34 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+
+def copy_database(source_alias, target_alias):
+    source, target = connections[source_alias], connections[target_alias]
+    if source.vendor != 'sqlite' or target.vendor != 'sqlite':
+        raise CommandError('Both databases must be SQLite')
+    source.ensure_connection()
+    target.ensure_connection()
+    source.connection.backup(target.connection)
+
+
+class Command(BaseCommand):
+    help = ('Stands in for streaming replication between two local SQLite databases: copies the source database '
+            'over the replica every --lag seconds, so the replica is always up to that much behind.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--source', default='default', help='Primary database alias')
+        parser.add_argument('--target', default='replica', help='Replica database alias')
+        parser.add_argument('--lag', type=float, default=2.0, help='Seconds between copies')
+        parser.add_argument('--once', action='store_true', help='Copy once and exit')
+
+    def handle(self, *args, **options):
+        if options['target'] not in connections:
+            raise CommandError(f'Unknown database alias: {options["target"]}')
+        while True:
+            copy_database(options['source'], options['target'])
+            self.stdout.write(f'Replicated {options["source"]} to {options["target"]}')
+            if options['once']:
+                return
+            time.sleep(options['lag'])
@@ -0,0 +1,24 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from clock.utils import deliver_queued_emails
+
+
+class Command(BaseCommand):
+    help = 'Sends queued emails from the outbox in batches over a single connection'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=None)
+        parser.add_argument('--loop', action='store_true', help='Keep polling the outbox instead of exiting')
+        parser.add_argument('--interval', type=float, default=5.0, help='Seconds between polls when idle')
+
+    def handle(self, *args, **options):
+        while True:
+            sent = deliver_queued_emails(options['batch_size'])
+            if sent:
+                self.stdout.write(f'{sent} emails sent')
+            if not options['loop']:
+                break
+            if not sent:
+                time.sleep(options['interval'])
@@ -0,0 +1,342 @@
+import argparse
+import os
+import select
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from clock import metrics, pomodoro
+from clock.channel_layers import broker_running, transport_settings
+from clock.checks import LOCMEM_CACHE
+import logging
+
+logger = logging.getLogger(__name__)
+
+IN_MEMORY_LAYER = 'channels.layers.InMemoryChannelLayer'
+UNIX_SOCKET_LAYER = 'clock.channel_layers.UnixSocketChannelLayer'
+
+
+def resident_memory(pid):
+    # Resident set size in bytes, or None where /proc is not available.
+    try:
+        with open(f'/proc/{pid}/statm') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class Worker:
+    def __init__(self, process, ready_fd):
+        self.process = process
+        self.ready_fd = ready_fd
+        self.ready = False
+        self.retiring = False
+
+    @property
+    def pid(self):
+        return self.process.pid
+
+    def close_ready_fd(self):
+        if self.ready_fd is not None:
+            os.close(self.ready_fd)
+            self.ready_fd = None
+
+
+class Arbiter:
+    # Keeps `workers` daphne processes accepting on one inherited listening
+    # socket. Workers are started with exec rather than plain fork, so that
+    # a SIGHUP reload picks up new code, and are replaced one at a time:
+    # the new worker has to be accepting before the old one is told to
+    # drain.
+    def __init__(self, listener, options, stdout):
+        self.listener = listener
+        self.options = options
+        self._stdout = stdout
+        self.workers = {}
+        self.broker = None
+        self.reload_requested = False
+        self.stop_requested = False
+        self.last_memory_check = 0.0
+
+    def say(self, message):
+        # Flushed right away: the arbiter mostly sleeps, and its output is
+        # usually a pipe to a log collector.
+        self._stdout.write(message)
+        self._stdout.flush()
+
+    def worker_command(self, ready_fd):
+        return [
+            sys.executable, os.path.join(settings.BASE_DIR, 'manage.py'), 'serve',
+            '--worker-fd', str(self.listener.fileno()), '--ready-fd', str(ready_fd),
+            '--graceful-timeout', str(self.options['graceful_timeout']),
+        ]
+
+    def start_broker(self, path):
+        # The unix channel layer needs its broker up before any worker
+        # connects. One that is already running, say from an earlier
+        # arbiter, is used as is.
+        if broker_running(path):
+            self.say(f'Using the channel broker on {path}')
+            return
+        self.broker = subprocess.Popen([sys.executable, os.path.join(settings.BASE_DIR, 'manage.py'),
+                                        'channel_broker', '--socket', path], process_group=0)
+        deadline = time.monotonic() + self.options['startup_timeout']
+        while not broker_running(path):
+            if self.broker.poll() is not None or time.monotonic() > deadline:
+                self.stop_broker()
+                raise CommandError(f'The channel broker failed to start on {path}')
+            time.sleep(0.05)
+        self.say(f'Channel broker {self.broker.pid} listening on {path}')
+
+    def stop_broker(self):
+        if self.broker is None:
+            return
+        self.broker.send_signal(signal.SIGTERM)
+        try:
+            self.broker.wait(5)
+        except subprocess.TimeoutExpired:
+            self.broker.kill()
+            self.broker.wait()
+        self.broker = None
+
+    def spawn(self):
+        ready_read, ready_write = os.pipe()
+        # In their own process group, so that Ctrl-C only reaches the arbiter,
+        # which then drains the workers itself.
+        environment = dict(os.environ)
+        if self.options.get('metrics_directory'):
+            environment['REQUEST_METRICS_DIR'] = str(self.options['metrics_directory'])
+        process = subprocess.Popen(self.worker_command(ready_write), env=environment,
+                                   pass_fds=(self.listener.fileno(), ready_write), process_group=0)
+        os.close(ready_write)
+        worker = Worker(process, ready_read)
+        self.workers[worker.pid] = worker
+        return worker
+
+    def wait_ready(self, worker):
+        # The worker writes one byte once it accepts connections, or exits.
+        deadline = time.monotonic() + self.options['startup_timeout']
+        while time.monotonic() < deadline and not self.stop_requested:
+            if worker.process.poll() is not None:
+                break
+            readable, _, _ = select.select([worker.ready_fd], [], [], 0.1)
+            if readable:
+                worker.ready = os.read(worker.ready_fd, 1) == b'1'
+                break
+        worker.close_ready_fd()
+        if worker.ready:
+            self.say(f'Worker {worker.pid} ready')
+        return worker.ready
+
+    def retire(self, worker, reason):
+        worker.retiring = True
+        self.say(f'Worker {worker.pid} draining ({reason})')
+        worker.process.send_signal(signal.SIGTERM)
+
+    def replace(self, worker, reason):
+        replacement = self.spawn()
+        if self.wait_ready(replacement):
+            self.retire(worker, reason)
+        else:
+            self.say(f'Worker {replacement.pid} failed to start; keeping {worker.pid}')
+            self.kill(replacement)
+
+    def kill(self, worker):
+        if worker.process.poll() is None:
+            worker.process.kill()
+        worker.process.wait()
+        worker.close_ready_fd()
+        self.workers.pop(worker.pid, None)
+
+    def reap(self):
+        if self.broker is not None and self.broker.poll() is not None and not self.stop_requested:
+            # Channels and groups held by the broker are lost with it;
+            # consumers join their groups again when clients reconnect.
+            self.say(f'Channel broker exited with {self.broker.returncode}; starting a new one')
+            self.broker = None
+            self.start_broker(self.options['broker_socket'])
+        for worker in list(self.workers.values()):
+            code = worker.process.poll()
+            if code is None:
+                continue
+            del self.workers[worker.pid]
+            worker.close_ready_fd()
+            if not worker.retiring and not self.stop_requested:
+                self.say(f'Worker {worker.pid} exited with {code}; starting a new one')
+                self.wait_ready(self.spawn())
+
+    def check_memory(self):
+        limit = self.options['max_memory']
+        if not limit or time.monotonic() - self.last_memory_check < self.options['check_interval']:
+            return
+        self.last_memory_check = time.monotonic()
+        for worker in list(self.workers.values()):
+            rss = resident_memory(worker.pid)
+            if worker.ready and not worker.retiring and rss is not None and rss > limit * 1024 * 1024:
+                self.replace(worker, f'{rss // (1024 * 1024)} MB resident, over {limit} MB')
+
+    def reload(self):
+        self.say('Reloading workers')
+        for worker in [worker for worker in self.workers.values() if not worker.retiring]:
+            if self.stop_requested:
+                return
+            self.replace(worker, 'reload')
+
+    def stop(self):
+        for worker in self.workers.values():
+            if worker.process.poll() is None:
+                worker.process.send_signal(signal.SIGTERM)
+        deadline = time.monotonic() + self.options['graceful_timeout'] + 5
+        for worker in list(self.workers.values()):
+            try:
+                worker.process.wait(max(deadline - time.monotonic(), 0))
+            except subprocess.TimeoutExpired:
+                self.say(f'Worker {worker.pid} did not stop in time; killing it')
+            self.kill(worker)
+
+    def run(self):
+        signal.signal(signal.SIGHUP, lambda *args: setattr(self, 'reload_requested', True))
+        signal.signal(signal.SIGTERM, lambda *args: setattr(self, 'stop_requested', True))
+        signal.signal(signal.SIGINT, lambda *args: setattr(self, 'stop_requested', True))
+
+        if self.options['broker_socket']:
+            self.start_broker(self.options['broker_socket'])
+        for _ in range(self.options['workers']):
+            self.spawn()
+        for worker in list(self.workers.values()):
+            if not self.wait_ready(worker):
+                self.stop()
+                self.stop_broker()
+                raise CommandError(f'Worker {worker.pid} failed to start')
+
+        while not self.stop_requested:
+            if self.reload_requested:
+                self.reload_requested = False
+                self.reload()
+            self.reap()
+            self.check_memory()
+            time.sleep(0.2)
+
+        self.say('Stopping workers')
+        self.stop()
+        self.stop_broker()
+
+
+def run_worker(fd, ready_fd, graceful_timeout):
+    # Imported here: daphne installs Twisted's reactor on import, which must
+    # only happen in the worker process.
+    from daphne.server import Server
+    from daphne.ws_protocol import WebSocketProtocol
+    from twisted.internet import reactor
+    from twisted.internet.task import LoopingCall
+    from django.utils.module_loading import import_string
+
+    class DrainingServer(Server):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.ports = []
+
+        def listen_success(self, port):
+            super().listen_success(port)
+            self.ports.append(port)
+            os.write(ready_fd, b'1')
+            os.close(ready_fd)
+
+        def drain(self):
+            # Stop accepting, ask WebSocket clients to reconnect elsewhere and
+            # give in-flight requests until the deadline to finish.
+            for port in self.ports:
+                port.stopListening()
+            for protocol, details in list(self.connections.items()):
+                if isinstance(protocol, WebSocketProtocol) and 'disconnected' not in details:
+                    protocol.serverClose(code=1001)
+            deadline = time.monotonic() + graceful_timeout
+
+            def check():
+                busy = [protocol for protocol, details in self.connections.items() if 'disconnected' not in details]
+                if not busy or time.monotonic() > deadline:
+                    self.stop()
+                else:
+                    reactor.callLater(0.1, check)
+            check()
+
+    pomodoro.enable_scheduler()
+    # Started as soon as the reactor runs its asyncio loop, rather than with
+    # the worker's first request; callWhenRunning would be too early for
+    # the loop, a delayed call runs inside it.
+    reactor.callLater(0, pomodoro.ensure_scheduler)
+    application = import_string(settings.ASGI_APPLICATION.replace(':', '.'))
+    server = DrainingServer(application=application, endpoints=[f'fd:fileno={fd}'], signal_handlers=False)
+    signal.signal(signal.SIGTERM, lambda *args: reactor.callFromThread(server.drain))
+    if settings.REQUEST_METRICS['DIRECTORY']:
+        LoopingCall(metrics.metrics_registry.flush).start(settings.REQUEST_METRICS['FLUSH_INTERVAL'], now=False)
+    server.run()
+    metrics.metrics_registry.flush()
+
+
+class Command(BaseCommand):
+    help = ('Serves the ASGI application with several daphne workers sharing one listening socket. SIGHUP '
+            'replaces the workers one at a time, each draining its connections; workers over --max-memory are '
+            'replaced the same way.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--bind', default='127.0.0.1', help='Address to listen on')
+        parser.add_argument('--port', type=int, default=8000, help='Port to listen on (0 picks a free one)')
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='Worker processes')
+        parser.add_argument('--backlog', type=int, default=2048, help='Listen backlog of the shared socket')
+        parser.add_argument('--max-memory', type=int, default=0,
+                            help='Replace a worker whose resident memory exceeds this many MB (0 disables)')
+        parser.add_argument('--check-interval', type=float, default=10, help='Seconds between memory checks')
+        parser.add_argument('--graceful-timeout', type=float, default=30,
+                            help='Seconds a draining worker waits for in-flight requests')
+        parser.add_argument('--startup-timeout', type=float, default=30, help='Seconds a new worker has to start')
+        # Internal: how the arbiter starts each worker.
+        parser.add_argument('--worker-fd', type=int, help=argparse.SUPPRESS)
+        parser.add_argument('--ready-fd', type=int, help=argparse.SUPPRESS)
+
+    def handle(self, *args, **options):
+        if options['worker_fd'] is not None:
+            run_worker(options['worker_fd'], options['ready_fd'], options['graceful_timeout'])
+            return
+
+        if options['workers'] < 1:
+            raise CommandError('At least one worker is needed')
+        layer = transport_settings(settings.CHANNEL_LAYERS.get('default', {}))
+        if options['workers'] > 1 and layer.get('BACKEND') == IN_MEMORY_LAYER:
+            raise CommandError('InMemoryChannelLayer is private to each process, so WebSocket groups would not '
+                               'reach across workers. Configure a shared channel layer or use --workers 1.')
+        response_cache = settings.CACHES.get(settings.RESPONSE_CACHE['ALIAS'], {})
+        if options['workers'] > 1 and response_cache.get('BACKEND') == LOCMEM_CACHE:
+            raise CommandError('The response cache is a LocMemCache private to each process, so a write through one '
+                               'worker would neither invalidate the responses cached by the others nor move on '
+                               'their study heatmap generations. Set RESPONSE_CACHE_BACKEND to redis or file, or '
+                               'use --workers 1.')
+        options['broker_socket'] = layer['CONFIG']['path'] if layer.get('BACKEND') == UNIX_SOCKET_LAYER else None
+        # Where the workers write their request metrics, for /metrics/ to
+        # add up.
+        metrics_directory = settings.REQUEST_METRICS['DIRECTORY']
+        temporary_metrics = options['workers'] > 1 and not metrics_directory
+        if temporary_metrics:
+            metrics_directory = tempfile.mkdtemp(prefix='study-clock-metrics-')
+        if metrics_directory:
+            metrics.reset_directory(metrics_directory)
+        options['metrics_directory'] = metrics_directory
+
+        listener = socket.create_server((options['bind'], options['port']), backlog=options['backlog'])
+        listener.set_inheritable(True)
+        host, port = listener.getsockname()[:2]
+        arbiter = Arbiter(listener, options, self.stdout)
+        arbiter.say(f'Listening on {host}:{port} with {options["workers"]} workers (pid {os.getpid()})')
+        try:
+            arbiter.run()
+        finally:
+            listener.close()
+            if temporary_metrics:
+                shutil.rmtree(metrics_directory, ignore_errors=True)
@@ -1,10 +1,39 @@
 from django.contrib.auth.models import BaseUserManager
+from django.db import models
+from django.db.models.functions import Lower
 import logging
 
 logger = logging.getLogger(__name__)
 
 
-class UserManager(BaseUserManager):
+class UserQuerySet(models.QuerySet):
+    # These match the lower(username) / lower(email) unique indexes, so
+    # case-insensitive lookups stay index scans.
+    def by_username(self, username):
+        return self.alias(username_lower=Lower('username')).filter(username_lower=username.lower())
+
+    def by_email(self, email):
+        return self.alias(email_lower=Lower('email')).filter(email_lower=email.lower())
+
+    def by_usernames(self, usernames):
+        return self.alias(username_lower=Lower('username')).filter(
+            username_lower__in=[username.lower() for username in usernames])
+
+    def by_emails(self, emails):
+        return self.alias(email_lower=Lower('email')).filter(email_lower__in=[email.lower() for email in emails])
+
+    def delete(self):
+        from clock import stats
+
+        # One post_delete fires per user; batch their counter updates.
+        with stats.deferred():
+            return super().delete()
+
+
+class UserManager(BaseUserManager.from_queryset(UserQuerySet)):
+    def get_by_natural_key(self, username):
+        return self.by_username(username).get()
+
     def create_user(self, username, email, date_of_birth, country, password, **extra_fields):
         logger.debug('Creating a user with the name: %s', username)
         if not email:
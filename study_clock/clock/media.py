@@ -0,0 +1,115 @@
+import mimetypes
+import os
+import re
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseNotModified
+from django.utils._os import safe_join
+from django.utils.cache import patch_cache_control
+from django.utils.http import http_date, parse_etags
+
+# Files under a content-hash directory never change, so they can be cached
+# forever and validated by name alone.
+CONTENT_HASH_PATH = re.compile(r'^avatars/(?P<digest>[0-9a-f]{64})/(?P<name>[^/]+)$')
+RANGE_HEADER = re.compile(r'^bytes=(?P<start>\d*)-(?P<end>\d*)$')
+
+
+class RangedFile:
+    # File-like view of `length` bytes starting at `start`, read in blocks by
+    # FileResponse so the slice never has to be held in memory.
+    def __init__(self, file, start, length):
+        self.file = file
+        self.remaining = length
+        file.seek(start)
+
+    def read(self, size=-1):
+        if self.remaining <= 0:
+            return b''
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.file.close()
+
+
+def parse_range(header, size):
+    match = RANGE_HEADER.match(header or '')
+    if not match or (not match['start'] and not match['end']):
+        return None
+    if match['start']:
+        start = int(match['start'])
+        end = min(int(match['end']), size - 1) if match['end'] else size - 1
+    else:
+        start = max(size - int(match['end']), 0)
+        end = size - 1
+    if start > end or start >= size:
+        raise ValueError('Unsatisfiable range')
+    return start, end
+
+
+def file_etag(path, stat):
+    match = CONTENT_HASH_PATH.match(path)
+    if match:
+        return f'"{match["digest"][:32]}-{match["name"]}"'
+    return f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+
+
+def set_validators(response, path, stat, etag):
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(stat.st_mtime)
+    response['Accept-Ranges'] = 'bytes'
+    if CONTENT_HASH_PATH.match(path):
+        patch_cache_control(response, public=True, max_age=60 * 60 * 24 * 365, immutable=True)
+    else:
+        patch_cache_control(response, public=True, no_cache=True)
+
+
+def media_response(request, path):
+    try:
+        full_path = safe_join(settings.MEDIA_ROOT, path)
+        stat = os.stat(full_path)
+    except (OSError, SuspiciousFileOperation):
+        raise Http404('File not found')
+    if not os.path.isfile(full_path):
+        raise Http404('File not found')
+
+    etag = file_etag(path, stat)
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match and (if_none_match.strip() == '*' or etag in parse_etags(if_none_match)):
+        response = HttpResponseNotModified()
+        set_validators(response, path, stat, etag)
+        return response
+
+    content_type = mimetypes.guess_type(full_path)[0] or 'application/octet-stream'
+    accel_prefix = getattr(settings, 'MEDIA_ACCEL_REDIRECT_PREFIX', None)
+    if accel_prefix:
+        # nginx sends the bytes (and handles Range) straight from disk.
+        response = HttpResponse(content_type=content_type)
+        response['X-Accel-Redirect'] = accel_prefix.rstrip('/') + '/' + path
+        set_validators(response, path, stat, etag)
+        return response
+
+    byte_range = None
+    if_range = request.headers.get('If-Range')
+    if 'Range' in request.headers and (not if_range or if_range == etag):
+        try:
+            byte_range = parse_range(request.headers['Range'], stat.st_size)
+        except ValueError:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{stat.st_size}'
+            return response
+
+    file = open(full_path, 'rb')
+    if byte_range is None:
+        response = FileResponse(file, content_type=content_type)
+    else:
+        start, end = byte_range
+        response = FileResponse(RangedFile(file, start, end - start + 1), status=206, content_type=content_type)
+        response['Content-Length'] = str(end - start + 1)
+        response['Content-Range'] = f'bytes {start}-{end}/{stat.st_size}'
+    set_validators(response, path, stat, etag)
+    return response
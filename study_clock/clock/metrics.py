@@ -0,0 +1,267 @@
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from .caching import cache_stats
+import logging
+
+logger = logging.getLogger(__name__)
+
+UNMATCHED = 'unmatched'
+# Anything else is reported as OTHER to keep the label set bounded.
+METHODS = frozenset({'GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS'})
+
+_current = ContextVar('clock_request_stats', default=None)
+
+
+class RequestStats:
+    __slots__ = ('started', 'queries', 'db_time')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+
+
+def time_query(execute, sql, params, many, context):
+    # Installed on every database connection. Queries run outside a request
+    # (management commands, the avatar workers) are not counted.
+    stats = _current.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        stats.db_time += time.perf_counter() - started
+        stats.queries += 1
+
+
+def install_query_timer(connection):
+    if time_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(time_query)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class EndpointMetrics:
+    def __init__(self, buckets):
+        self.duration = Histogram(buckets)
+        self.statuses = defaultdict(int)
+        self.queries = 0
+        self.db_time = 0.0
+
+    def state(self):
+        return {'counts': list(self.duration.counts), 'sum': self.duration.sum, 'statuses': dict(self.statuses),
+                'queries': self.queries, 'db_time': self.db_time}
+
+    def add(self, state):
+        histogram = self.duration
+        for index, count in enumerate(state['counts']):
+            histogram.counts[index] += count
+        histogram.count += sum(state['counts'])
+        histogram.sum += state['sum']
+        # JSON turns the status codes into strings.
+        for status_code, count in state['statuses'].items():
+            self.statuses[int(status_code)] += count
+        self.queries += state['queries']
+        self.db_time += state['db_time']
+
+
+def reset_directory(directory):
+    # Called by `manage.py serve` before it starts workers, so totals left by
+    # an earlier run are not added in.
+    os.makedirs(directory, exist_ok=True)
+    for name in os.listdir(directory):
+        if name.endswith('.json'):
+            os.remove(os.path.join(directory, name))
+
+
+class MetricsRegistry:
+    # Aggregates of this process, keyed by (URL name, method). When
+    # REQUEST_METRICS['DIRECTORY'] is set, each worker also writes them to
+    # <worker_id>.json there, and render() adds up every worker's file. The
+    # files of workers that have exited are kept, so the totals do not drop
+    # when a worker is replaced.
+    def __init__(self, worker_id=None):
+        self._lock = threading.Lock()
+        self._endpoints = {}
+        self.worker_id = worker_id or os.getpid()
+
+    def record(self, endpoint, method, status_code, duration, stats):
+        with self._lock:
+            metrics = self._endpoints.get((endpoint, method))
+            if metrics is None:
+                metrics = self._endpoints[endpoint, method] = EndpointMetrics(settings.REQUEST_METRICS['BUCKETS'])
+            metrics.duration.observe(duration)
+            metrics.statuses[status_code] += 1
+            metrics.queries += stats.queries
+            metrics.db_time += stats.db_time
+
+    def reset(self):
+        with self._lock:
+            self._endpoints.clear()
+
+    def state(self):
+        with self._lock:
+            endpoints = [[endpoint, method, metrics.state()] for (endpoint, method), metrics in self._endpoints.items()]
+        return {'endpoints': endpoints, 'cache': cache_stats.snapshot()}
+
+    def flush(self):
+        directory = settings.REQUEST_METRICS['DIRECTORY']
+        if not directory:
+            return
+        path = os.path.join(directory, f'{self.worker_id}.json')
+        # Written aside and renamed, so readers never see a partial file.
+        temporary = f'{path}.{threading.get_ident()}.tmp'
+        try:
+            with open(temporary, 'w') as file:
+                json.dump(self.state(), file)
+            os.replace(temporary, path)
+        except OSError:
+            logger.warning('Could not write request metrics to %s', path, exc_info=True)
+
+    def collect(self):
+        # This process's totals, and with a DIRECTORY those of every worker:
+        # its own file is rewritten first, the others are as of their last
+        # flush.
+        directory = settings.REQUEST_METRICS['DIRECTORY']
+        if not directory:
+            return [self.state()]
+        self.flush()
+        states = []
+        for name in sorted(os.listdir(directory)):
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(directory, name)) as file:
+                    states.append(json.load(file))
+            except (OSError, ValueError):
+                logger.warning('Skipping unreadable request metrics file %s', name, exc_info=True)
+        return states
+
+    def render(self):
+        endpoints = {}
+        cache = defaultdict(lambda: {'hits': 0, 'misses': 0})
+        for state in self.collect():
+            for endpoint, method, endpoint_state in state['endpoints']:
+                metrics = endpoints.get((endpoint, method))
+                if metrics is None:
+                    metrics = endpoints[endpoint, method] = EndpointMetrics(settings.REQUEST_METRICS['BUCKETS'])
+                metrics.add(endpoint_state)
+            for endpoint, counts in state['cache'].items():
+                cache[endpoint]['hits'] += counts['hits']
+                cache[endpoint]['misses'] += counts['misses']
+
+        lines = [
+            '# HELP clock_requests_total Requests served, by endpoint, method and status.',
+            '# TYPE clock_requests_total counter',
+        ]
+        durations = [
+            '# HELP clock_request_duration_seconds Wall time spent in Django per request.',
+            '# TYPE clock_request_duration_seconds histogram',
+        ]
+        queries = [
+            '# HELP clock_request_db_queries_total Database queries run while serving requests.',
+            '# TYPE clock_request_db_queries_total counter',
+        ]
+        db_time = [
+            '# HELP clock_request_db_seconds_total Time spent in database queries while serving requests.',
+            '# TYPE clock_request_db_seconds_total counter',
+        ]
+        for (endpoint, method), metrics in sorted(endpoints.items()):
+            labels = f'endpoint="{_escape(endpoint)}",method="{method}"'
+            for status_code, count in sorted(metrics.statuses.items()):
+                lines.append(f'clock_requests_total{{{labels},status="{status_code}"}} {count}')
+            cumulative = 0
+            histogram = metrics.duration
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                durations.append(f'clock_request_duration_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            durations.append(f'clock_request_duration_seconds_bucket{{{labels},le="+Inf"}} {histogram.count}')
+            durations.append(f'clock_request_duration_seconds_sum{{{labels}}} {histogram.sum:.6f}')
+            durations.append(f'clock_request_duration_seconds_count{{{labels}}} {histogram.count}')
+            queries.append(f'clock_request_db_queries_total{{{labels}}} {metrics.queries}')
+            db_time.append(f'clock_request_db_seconds_total{{{labels}}} {metrics.db_time:.6f}')
+
+        cache_lines = [
+            '# HELP clock_response_cache_requests_total Response cache lookups, by endpoint and result.',
+            '# TYPE clock_response_cache_requests_total counter',
+        ]
+        for endpoint, counts in sorted(cache.items()):
+            cache_lines.append(f'clock_response_cache_requests_total{{endpoint="{endpoint}",result="hit"}} '
+                               f'{counts["hits"]}')
+            cache_lines.append(f'clock_response_cache_requests_total{{endpoint="{endpoint}",result="miss"}} '
+                               f'{counts["misses"]}')
+        return '\n'.join(lines + durations + queries + db_time + cache_lines) + '\n'
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"')
+
+
+metrics_registry = MetricsRegistry()
+
+
+class RequestTimingMiddleware:
+    # Times each request and the database queries it runs, adds a
+    # Server-Timing header and feeds the per-endpoint histograms behind
+    # /metrics/. Streamed bodies are not included in the wall time.
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        stats = RequestStats()
+        token = _current.set(stats)
+        try:
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.finish(request, response, stats)
+
+    async def __acall__(self, request):
+        stats = RequestStats()
+        token = _current.set(stats)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.finish(request, response, stats)
+
+    def finish(self, request, response, stats):
+        duration = time.perf_counter() - stats.started
+        match = getattr(request, 'resolver_match', None)
+        endpoint = (match.view_name if match else None) or UNMATCHED
+        method = request.method if request.method in METHODS else 'OTHER'
+        metrics_registry.record(endpoint, method, response.status_code, duration, stats)
+        if settings.REQUEST_METRICS['SERVER_TIMING']:
+            response['Server-Timing'] = (
+                f'app;dur={(duration - stats.db_time) * 1000:.1f}, '
+                f'db;dur={stats.db_time * 1000:.1f};desc="{stats.queries} queries", '
+                f'total;dur={duration * 1000:.1f}'
+            )
+        return response
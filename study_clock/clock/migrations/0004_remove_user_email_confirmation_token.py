@@ -0,0 +1,17 @@
+# Generated by Django 5.1.2 on 2026-10-18 23:08
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clock', '0003_outgoingemail'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='user',
+            name='email_confirmation_token',
+        ),
+    ]
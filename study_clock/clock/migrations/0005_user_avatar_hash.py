@@ -0,0 +1,18 @@
+# Generated by Django 5.1.2 on 2026-10-18 23:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clock', '0004_remove_user_email_confirmation_token'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='avatar_hash',
+            field=models.CharField(blank=True, max_length=64, verbose_name='Avatar Content Hash'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.2 on 2026-10-18 23:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clock', '0005_user_avatar_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='version',
+            field=models.PositiveIntegerField(default=0, verbose_name='Version'),
+        ),
+    ]
@@ -0,0 +1,50 @@
+# Generated by Django 5.1.2 on 2026-10-18 23:17
+
+from django.db import migrations, models
+from django.db.models import Count
+from django.db.models.functions import ExtractYear
+
+
+def populate_counters(apps, schema_editor):
+    # The counters clock.stats kept when this migration was written, computed
+    # here so that later changes to the module cannot alter this step.
+    User = apps.get_model('clock', 'User')
+    DemographicCounter = apps.get_model('clock', 'DemographicCounter')
+
+    counts = {('total', ''): User.objects.count()}
+    for field, dimension in (('country', 'country'), ('is_premium', 'premium'), ('email_confirmed', 'email_confirmed')):
+        for value, n in User.objects.values_list(field).annotate(n=Count('pk')).order_by():
+            key = ('1' if value else '0') if isinstance(value, bool) else value
+            counts[(dimension, key)] = n
+    for year, n in User.objects.values_list(ExtractYear('date_of_birth')).annotate(n=Count('pk')).order_by():
+        counts[('birth_year', str(year) if year else '')] = n
+
+    DemographicCounter.objects.bulk_create(
+        DemographicCounter(dimension=dimension, key=key, count=count) for (dimension, key), count in counts.items()
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clock', '0006_user_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DemographicCounter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('dimension', models.CharField(max_length=20, verbose_name='Dimension')),
+                ('key', models.CharField(blank=True, max_length=20, verbose_name='Key')),
+                ('count', models.IntegerField(default=0, verbose_name='Count')),
+            ],
+            options={
+                'verbose_name': 'Demographic Counter',
+                'verbose_name_plural': 'Demographic Counters',
+                'db_table': 'demographic_counter',
+                'constraints': [models.UniqueConstraint(fields=('dimension', 'key'), name='demographic_counter_unique')],
+            },
+        ),
+        migrations.RunPython(populate_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.1.2 on 2026-10-19 00:27
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clock', '0008_user_case_insensitive_unique'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StudySession',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ended_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Ended At')),
+                ('minutes', models.PositiveIntegerField(verbose_name='Minutes')),
+                ('activity', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='study_sessions', to='clock.activity')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='study_sessions', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Study Session',
+                'verbose_name_plural': 'Study Sessions',
+                'db_table': 'study_session',
+                'indexes': [models.Index(fields=['user', 'ended_at'], name='study_sessi_user_id_b4c588_idx')],
+            },
+        ),
+    ]
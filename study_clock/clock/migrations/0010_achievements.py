@@ -0,0 +1,48 @@
+# Generated by Django 5.1.2 on 2026-10-19 00:38
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clock', '0009_studysession'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AchievementProgress',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='achievement_progress', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('total_minutes', models.PositiveIntegerField(default=0, verbose_name='Total Minutes')),
+                ('activities_created', models.PositiveIntegerField(default=0, verbose_name='Activities Created')),
+                ('current_streak', models.PositiveIntegerField(default=0, verbose_name='Current Streak')),
+                ('longest_streak', models.PositiveIntegerField(default=0, verbose_name='Longest Streak')),
+                ('last_study_day', models.DateField(blank=True, null=True, verbose_name='Last Study Day')),
+            ],
+            options={
+                'verbose_name': 'Achievement Progress',
+                'verbose_name_plural': 'Achievement Progress',
+                'db_table': 'achievement_progress',
+            },
+        ),
+        migrations.CreateModel(
+            name='Achievement',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('code', models.CharField(max_length=50, verbose_name='Code')),
+                ('activity_name', models.CharField(blank=True, max_length=50, verbose_name='Activity Name')),
+                ('earned_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Earned At')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='achievements', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Achievement',
+                'verbose_name_plural': 'Achievements',
+                'db_table': 'achievement',
+                'constraints': [models.UniqueConstraint(fields=('user', 'code'), name='achievement_user_code_unique')],
+            },
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.1.2 on 2026-10-19 00:47
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clock', '0010_achievements'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PendingTimer',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('break', 'Break time'), ('work', 'Back to work')], max_length=10, verbose_name='Kind')),
+                ('fires_at', models.DateTimeField(verbose_name='Fires At')),
+                ('created_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now, verbose_name='Created At')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='pending_timers', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Pending Timer',
+                'verbose_name_plural': 'Pending Timers',
+                'db_table': 'pending_timer',
+            },
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.1.2 on 2026-10-19 01:36
+
+from django.db import migrations
+from django.db.models import Count
+
+
+def populate_birth_dates(apps, schema_editor):
+    User = apps.get_model('clock', 'User')
+    DemographicCounter = apps.get_model('clock', 'DemographicCounter')
+
+    DemographicCounter.objects.filter(dimension='birth_date').delete()
+    DemographicCounter.objects.bulk_create(
+        DemographicCounter(dimension='birth_date', key=date_of_birth.isoformat() if date_of_birth else '', count=n)
+        for date_of_birth, n in User.objects.values_list('date_of_birth').annotate(n=Count('pk')).order_by()
+    )
+
+
+def remove_birth_dates(apps, schema_editor):
+    apps.get_model('clock', 'DemographicCounter').objects.filter(dimension='birth_date').delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clock', '0012_user_drop_case_sensitive_unique'),
+    ]
+
+    operations = [
+        migrations.RunPython(populate_birth_dates, remove_birth_dates),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.1.2 on 2026-10-19 02:09
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def mark_confirmed_users(apps, schema_editor):
+    # When they confirmed is unknown; that they did is what the purge needs.
+    # Accounts that confirmed and changed their address before this field
+    # existed cannot be told apart from ones that never confirmed.
+    User = apps.get_model('clock', 'User')
+    User.objects.filter(email_confirmed=True).update(email_first_confirmed_at=F('date_joined'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clock', '0013_demographiccounter_birth_date'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='email_first_confirmed_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Email First Confirmed At'),
+        ),
+        migrations.RunPython(mark_confirmed_users, migrations.RunPython.noop),
+    ]
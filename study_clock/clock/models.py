@@ -1,34 +1,96 @@
-import uuid
 from django.contrib.auth.models import AbstractUser
-from django.db import models
+from django.db import models, router, transaction
+from django.db.models.functions import Lower
+from django.utils import timezone
 from django_countries.fields import CountryField
 from clock.managers import UserManager
+from clock.exceptions import ConcurrentUpdateError
+from clock import stats
 import logging
 
 logger = logging.getLogger(__name__)
 
 
 class User(AbstractUser):
-    username = models.CharField(max_length=150, unique=True, verbose_name='Username')
+    # Unique regardless of case through the lower() constraints in Meta.
+    username = models.CharField(max_length=150, verbose_name='Username')
     date_of_birth = models.DateField(verbose_name='Date of Birth')
-    email = models.EmailField(unique=True, verbose_name='Email Address')
+    email = models.EmailField(verbose_name='Email Address')
     country = CountryField(verbose_name='Country')
     is_premium = models.BooleanField(default=False, verbose_name='Premium User')
     avatar = models.ImageField(upload_to='avatars/', null=True, blank=True, verbose_name='Avatar')
+    avatar_hash = models.CharField(max_length=64, blank=True, verbose_name='Avatar Content Hash')
     email_confirmed = models.BooleanField(default=False)
-    email_confirmation_token = models.UUIDField(default=uuid.uuid4, unique=True, blank=True, null=True)
+    # Set by the first confirmation and kept when a later email change
+    # clears email_confirmed: only accounts that never confirmed are purged.
+    email_first_confirmed_at = models.DateTimeField(null=True, blank=True, verbose_name='Email First Confirmed At')
+    version = models.PositiveIntegerField(default=0, verbose_name='Version')
 
     objects = UserManager()
+    # The fields a client edits through UserSerializer, which `version`
+    # guards. Saves limited to other fields (last_login, the avatar, email
+    # confirmation) are the server's own and neither bump nor check it.
+    VERSIONED_FIELDS = frozenset({'first_name', 'last_name', 'username', 'email', 'date_of_birth', 'country',
+                                  'is_premium'})
+    _expected_version = None
+    _demographics = None
     REQUIRED_FIELDS = ['first_name','last_name', 'email', 'date_of_birth', 'country']
 
     class Meta:
         db_table = 'user'
         verbose_name = 'User'
         verbose_name_plural = 'Users'
+        constraints = [
+            models.UniqueConstraint(Lower('username'), name='user_username_lower_unique'),
+            models.UniqueConstraint(Lower('email'), name='user_email_lower_unique'),
+        ]
 
     def __str__(self):
         return self.username
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remembered so the demographic counters can be adjusted by the
+        # difference on save or delete without re-reading the row.
+        instance._demographics = stats.snapshot(instance)
+        return instance
+
+    def save(self, *args, **kwargs):
+        # Every update of an existing row that touches VERSIONED_FIELDS (or
+        # saves all fields) bumps `version` and only applies if the row still
+        # has the version this instance was loaded with, so a stale copy can
+        # never overwrite a newer one.
+        update_fields = kwargs.get('update_fields')
+        if self._state.adding or (update_fields is not None and not self.VERSIONED_FIELDS.intersection(update_fields)):
+            return super().save(*args, **kwargs)
+        if update_fields is not None:
+            kwargs['update_fields'] = {*update_fields, 'version'}
+
+        self._expected_version = self.version
+        self.version += 1
+        try:
+            # The savepoint keeps a rejected update from poisoning an
+            # enclosing transaction.
+            with transaction.atomic(using=kwargs.get('using') or router.db_for_write(User, instance=self)):
+                super().save(*args, **kwargs)
+        except Exception:
+            # Rejected or failed (e.g. a unique violation): the row was not
+            # written, so neither is the version bump.
+            self.version = self._expected_version
+            raise
+        finally:
+            self._expected_version = None
+
+    def _do_update(self, base_qs, using, pk_val, values, update_fields, forced_update):
+        if self._expected_version is None:
+            return super()._do_update(base_qs, using, pk_val, values, update_fields, forced_update)
+        base_qs = base_qs.filter(version=self._expected_version)
+        if not super()._do_update(base_qs, using, pk_val, values, update_fields, forced_update):
+            logger.warning('Concurrent update of user %s rejected at version %d', pk_val, self._expected_version)
+            raise ConcurrentUpdateError()
+        return True
+
 
 class Activity(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='activities')
@@ -47,13 +109,107 @@ class Activity(models.Model):
         return f'{self.name} - {self.user.username}'
 
     def add_time(self, minutes):
+        self._add_minutes(minutes)
+        self.save()
+        if minutes > 0:
+            StudySession.objects.create(user_id=self.user_id, activity=self, minutes=minutes)
+        logger.info('Time added for activity %s. Today is time: %d minutes', self.name, self.minutes_spent_today)
+
+    async def aadd_time(self, minutes):
+        self._add_minutes(minutes)
+        await self.asave()
+        if minutes > 0:
+            await StudySession.objects.acreate(user_id=self.user_id, activity=self, minutes=minutes)
+        logger.info('Time added for activity %s. Today is time: %d minutes', self.name, self.minutes_spent_today)
+
+    def _add_minutes(self, minutes):
         logger.debug('Adding time for activity %s: %d minutes', self.name, minutes)
         self.minutes_spent_today += minutes
         self.minutes_spent_this_week += minutes
         self.minutes_spent_this_month += minutes
         self.minutes_spent_in_total += minutes
-        self.save()
-        logger.info('Time added for activity %s. Today is time: %d minutes', self.name, self.minutes_spent_today)
+
+
+class StudySession(models.Model):
+    # One timer write: `minutes` of study that ended at `ended_at`. The
+    # Activity totals only say how much; these say when, for the study
+    # heatmap (clock.heatmap). Sessions outlive a deleted activity.
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='study_sessions')
+    activity = models.ForeignKey(Activity, on_delete=models.SET_NULL, null=True, blank=True,
+                                 related_name='study_sessions')
+    ended_at = models.DateTimeField(default=timezone.now, verbose_name='Ended At')
+    minutes = models.PositiveIntegerField(verbose_name='Minutes')
+
+    class Meta:
+        db_table = 'study_session'
+        verbose_name = 'Study Session'
+        verbose_name_plural = 'Study Sessions'
+        indexes = [models.Index(fields=['user', 'ended_at'])]
+
+    def __str__(self):
+        return f'{self.minutes} minutes until {self.ended_at} - {self.user_id}'
+
+
+class AchievementProgress(models.Model):
+    # The running totals the achievement rules (clock.achievements) are
+    # checked against, moved forward by each timer write and new activity.
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True,
+                                related_name='achievement_progress')
+    total_minutes = models.PositiveIntegerField(default=0, verbose_name='Total Minutes')
+    activities_created = models.PositiveIntegerField(default=0, verbose_name='Activities Created')
+    current_streak = models.PositiveIntegerField(default=0, verbose_name='Current Streak')
+    longest_streak = models.PositiveIntegerField(default=0, verbose_name='Longest Streak')
+    last_study_day = models.DateField(null=True, blank=True, verbose_name='Last Study Day')
+
+    class Meta:
+        db_table = 'achievement_progress'
+        verbose_name = 'Achievement Progress'
+        verbose_name_plural = 'Achievement Progress'
+
+    def __str__(self):
+        return f'{self.total_minutes} minutes, {self.longest_streak} day streak - {self.user_id}'
+
+
+class Achievement(models.Model):
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='achievements')
+    code = models.CharField(max_length=50, verbose_name='Code')
+    # For per-activity rules, the activity that reached the milestone.
+    activity_name = models.CharField(max_length=50, blank=True, verbose_name='Activity Name')
+    earned_at = models.DateTimeField(default=timezone.now, verbose_name='Earned At')
+
+    class Meta:
+        db_table = 'achievement'
+        verbose_name = 'Achievement'
+        verbose_name_plural = 'Achievements'
+        constraints = [models.UniqueConstraint(fields=['user', 'code'], name='achievement_user_code_unique')]
+
+    def __str__(self):
+        return f'{self.code} - {self.user_id}'
+
+
+class PendingTimer(models.Model):
+    # A pomodoro notification still to be pushed by clock.pomodoro. The row
+    # lives until a worker fires the timer, so timers survive restarts, and
+    # deleting it is how a worker claims the timer.
+    KIND_BREAK = 'break'
+    KIND_WORK = 'work'
+    KIND_CHOICES = [
+        (KIND_BREAK, 'Break time'),
+        (KIND_WORK, 'Back to work'),
+    ]
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='pending_timers')
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES, verbose_name='Kind')
+    fires_at = models.DateTimeField(verbose_name='Fires At')
+    created_at = models.DateTimeField(default=timezone.now, db_index=True, verbose_name='Created At')
+
+    class Meta:
+        db_table = 'pending_timer'
+        verbose_name = 'Pending Timer'
+        verbose_name_plural = 'Pending Timers'
+
+    def __str__(self):
+        return f'{self.kind} at {self.fires_at} - {self.user_id}'
 
 
 class PrivateMessage(models.Model):
@@ -65,3 +221,61 @@ class PrivateMessage(models.Model):
 
     def __str__(self):
         return f'From {self.sender} to {self.receiver}: {self.content[:20]}'
+
+
+class RevokedToken(models.Model):
+    jti = models.CharField(max_length=255, unique=True, verbose_name='Token ID')
+    expires_at = models.DateTimeField(db_index=True, verbose_name='Expires At')
+
+    class Meta:
+        db_table = 'revoked_token'
+        verbose_name = 'Revoked Token'
+        verbose_name_plural = 'Revoked Tokens'
+
+    def __str__(self):
+        return self.jti
+
+
+class OutgoingEmail(models.Model):
+    STATUS_QUEUED = 'queued'
+    STATUS_SENT = 'sent'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_QUEUED, 'Queued'),
+        (STATUS_SENT, 'Sent'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+
+    subject = models.CharField(max_length=255, verbose_name='Subject')
+    body = models.TextField(verbose_name='Body')
+    to = models.EmailField(verbose_name='Recipient')
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=STATUS_QUEUED, verbose_name='Status')
+    attempts = models.PositiveIntegerField(default=0, verbose_name='Attempts')
+    next_attempt_at = models.DateTimeField(default=timezone.now, verbose_name='Next Attempt At')
+    last_error = models.TextField(blank=True, verbose_name='Last Error')
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='Created At')
+    sent_at = models.DateTimeField(null=True, blank=True, verbose_name='Sent At')
+
+    class Meta:
+        db_table = 'outgoing_email'
+        verbose_name = 'Outgoing Email'
+        verbose_name_plural = 'Outgoing Emails'
+        indexes = [models.Index(fields=['status', 'next_attempt_at'])]
+
+    def __str__(self):
+        return f'{self.subject} to {self.to} ({self.status})'
+
+
+class DemographicCounter(models.Model):
+    dimension = models.CharField(max_length=20, verbose_name='Dimension')
+    key = models.CharField(max_length=20, blank=True, verbose_name='Key')
+    count = models.IntegerField(default=0, verbose_name='Count')
+
+    class Meta:
+        db_table = 'demographic_counter'
+        verbose_name = 'Demographic Counter'
+        verbose_name_plural = 'Demographic Counters'
+        constraints = [models.UniqueConstraint(fields=['dimension', 'key'], name='demographic_counter_unique')]
+
+    def __str__(self):
+        return f'{self.dimension}={self.key}: {self.count}'
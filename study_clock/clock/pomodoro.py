@@ -0,0 +1,276 @@
+import asyncio
+import datetime
+import math
+import time
+
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import connections, router, transaction
+from django.utils import timezone
+
+from .models import PendingTimer
+import logging
+
+logger = logging.getLogger(__name__)
+
+MESSAGES = dict(PendingTimer.KIND_CHOICES)
+# Seconds before a timer whose event could not be sent is tried again.
+RETRY_DELAY = 5
+
+
+def user_group(user_id):
+    return f'pomodoro_{user_id}'
+
+
+class TimingWheel:
+    # A hierarchical timing wheel (Varghese and Lauck) with a resolution of
+    # one tick: LEVELS wheels of 2**BITS slots, where a slot of level n spans
+    # 2**(BITS * n) ticks, so four levels of 64 slots cover 2**24 ticks (194
+    # days of seconds). Adding or cancelling a timer and advancing a tick are
+    # O(1) whatever the number of timers: a timer moves down a level at most
+    # LEVELS - 1 times, when the slot it waits in comes round, and fires from
+    # level 0 on its exact tick. Timers beyond the span wait in the farthest
+    # top-level slot and are placed again each time it comes round.
+    BITS = 6
+    LEVELS = 4
+    MASK = (1 << BITS) - 1
+    SPAN = 1 << (BITS * LEVELS)
+
+    def __init__(self, tick):
+        # The next tick to fire.
+        self.tick = tick
+        self.slots = [[{} for _ in range(1 << self.BITS)] for _ in range(self.LEVELS)]
+        # key -> (level, slot)
+        self.timers = {}
+
+    def __len__(self):
+        return len(self.timers)
+
+    def __contains__(self, key):
+        return key in self.timers
+
+    def add(self, key, expires, value):
+        # Replaces the timer with the same key. A timer already due fires on
+        # the next tick.
+        self.cancel(key)
+        self.place(key, max(expires, self.tick), value)
+
+    def cancel(self, key):
+        location = self.timers.pop(key, None)
+        if location is not None:
+            level, slot = location
+            del self.slots[level][slot][key]
+
+    def place(self, key, expires, value):
+        delta = min(expires - self.tick, self.SPAN - 1)
+        level = 0
+        while delta >= 1 << (self.BITS * (level + 1)):
+            level += 1
+        slot = ((self.tick + delta) >> (self.BITS * level)) & self.MASK
+        self.slots[level][slot][key] = (expires, value)
+        self.timers[key] = (level, slot)
+
+    def advance(self, now):
+        # Fires every tick up to and including `now` and returns the expired
+        # (key, value) pairs in order.
+        due = []
+        while self.tick <= now:
+            if not self.timers:
+                self.tick = now + 1
+                break
+            # A slot of a higher level comes round when the levels below it
+            # wrap; its timers now all fall within reach of a lower level.
+            for level in range(1, self.LEVELS):
+                if self.tick & ((1 << (self.BITS * level)) - 1):
+                    break
+                slot = (self.tick >> (self.BITS * level)) & self.MASK
+                bucket, self.slots[level][slot] = self.slots[level][slot], {}
+                for key, (expires, value) in bucket.items():
+                    self.place(key, expires, value)
+            slot = self.tick & self.MASK
+            bucket, self.slots[0][slot] = self.slots[0][slot], {}
+            for key, (expires, value) in bucket.items():
+                del self.timers[key]
+                due.append((key, value))
+            self.tick += 1
+        return due
+
+
+class PomodoroScheduler:
+    # Fires the pending timers of one ASGI worker, one tick a second. Every
+    # worker holds every timer: the table is loaded on start, rows created
+    # since are picked up every POLL_INTERVAL seconds, and timers started by
+    # a request to this worker are added straight away. Of the workers whose
+    # wheel fires a timer, the one that deletes its row sends the event, to
+    # the group of all the user's connections. A cancelled timer has no row
+    # left and fires as a no-op.
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.wheel = TimingWheel(int(clock()))
+        self.loop = None
+        self.task = None
+        self.polled_at = None
+
+    def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.task = self.loop.create_task(self.run())
+
+    async def stop(self):
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+
+    def add(self, timers):
+        # (pk, user_id, kind, fires_at) rows. Timers already held are kept.
+        for pk, user_id, kind, fires_at in timers:
+            if pk not in self.wheel:
+                self.wheel.add(pk, math.ceil(fires_at.timestamp()), (user_id, kind, fires_at))
+
+    async def run(self):
+        await self.load()
+        while True:
+            await asyncio.sleep(max(self.wheel.tick - self.clock(), 0))
+            try:
+                await self.step()
+            except Exception:
+                logger.exception('Pomodoro scheduler step failed')
+
+    async def load(self):
+        self.polled_at = self.clock()
+        self.add(await self.pending())
+        logger.info('Pomodoro scheduler started with %d pending timers', len(self.wheel))
+
+    async def step(self):
+        due = self.wheel.advance(int(self.clock()))
+        if due:
+            try:
+                await self.fire(due)
+            except Exception:
+                for key, value in due:
+                    self.wheel.add(key, self.wheel.tick + RETRY_DELAY, value)
+                raise
+        if self.clock() - self.polled_at >= settings.POMODORO['POLL_INTERVAL']:
+            # Overlapping, for rows committed late; those already held are
+            # skipped.
+            since = self.polled_at - settings.POMODORO['POLL_INTERVAL']
+            self.polled_at = self.clock()
+            self.add(await self.pending(datetime.datetime.fromtimestamp(since, datetime.timezone.utc)))
+
+    async def fire(self, due):
+        claimed = await self.claim([key for key, _ in due])
+        claimed = [(key, value) for key, value in due if key in claimed]
+        layer = get_channel_layer()
+        deadline = self.clock() - settings.POMODORO['MAX_LATENESS']
+        for index, (key, (user_id, kind, fires_at)) in enumerate(claimed):
+            if fires_at.timestamp() < deadline:
+                logger.info('Pomodoro %s timer %s of user %s dropped, due at %s', kind, key, user_id, fires_at)
+                continue
+            try:
+                await layer.group_send(user_group(user_id), {
+                    'type': 'pomodoro.event',
+                    'event': kind,
+                    'message': MESSAGES[kind],
+                    'at': fires_at.isoformat(),
+                })
+            except Exception:
+                # The rows of the timers not sent yet go back, so that this
+                # worker's retry, or another worker's, can claim them again.
+                await self.restore(claimed[index:])
+                raise
+
+    @database_sync_to_async
+    def claim(self, keys):
+        # Deletes the rows in one statement and returns the keys of those it
+        # deleted: of the workers firing the same timers, each gets a
+        # disjoint share.
+        if not keys:
+            return set()
+        connection = connections[router.db_for_write(PendingTimer)]
+        table = connection.ops.quote_name(PendingTimer._meta.db_table)
+        pk = connection.ops.quote_name(PendingTimer._meta.pk.column)
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {table} WHERE {pk} IN ({", ".join(["%s"] * len(keys))}) RETURNING {pk}',
+                           keys)
+            return {row[0] for row in cursor.fetchall()}
+
+    @database_sync_to_async
+    def restore(self, timers):
+        # A fresh created_at brings the rows back into the other workers'
+        # next poll as well.
+        PendingTimer.objects.bulk_create([
+            PendingTimer(pk=key, user_id=user_id, kind=kind, fires_at=fires_at)
+            for key, (user_id, kind, fires_at) in timers
+        ], ignore_conflicts=True)
+
+    @database_sync_to_async
+    def pending(self, since=None):
+        rows = PendingTimer.objects.all() if since is None else PendingTimer.objects.filter(created_at__gte=since)
+        return list(rows.values_list('pk', 'user_id', 'kind', 'fires_at'))
+
+
+_scheduler = None
+# Whether this process fires timers: set in the workers of `manage.py serve`,
+# or with POMODORO['SCHEDULER'] under another ASGI server. Other runners of
+# the application, such as `manage.py bench`, leave that to the servers.
+_enabled = False
+
+
+def enable_scheduler():
+    global _enabled
+    _enabled = True
+
+
+def ensure_scheduler():
+    # The scheduler of this process, started in the running event loop.
+    global _scheduler
+    loop = asyncio.get_running_loop()
+    if _scheduler is None or _scheduler.loop is not loop:
+        _scheduler = PomodoroScheduler()
+        _scheduler.start()
+    return _scheduler
+
+
+def schedule(timers):
+    # Hands timers created in this process to its scheduler, if it runs one;
+    # safe to call from any thread.
+    scheduler = _scheduler
+    if scheduler is not None and not scheduler.loop.is_closed():
+        rows = [(timer.pk, timer.user_id, timer.kind, timer.fires_at) for timer in timers]
+        scheduler.loop.call_soon_threadsafe(scheduler.add, rows)
+
+
+def start(user, work_minutes, break_minutes):
+    # Replaces the user's pending timers with a break after `work_minutes`
+    # and the way back to work `break_minutes` later.
+    now = timezone.now()
+    break_at = now + datetime.timedelta(minutes=work_minutes)
+    work_at = break_at + datetime.timedelta(minutes=break_minutes)
+    with transaction.atomic():
+        PendingTimer.objects.filter(user=user).delete()
+        timers = PendingTimer.objects.bulk_create([
+            PendingTimer(user=user, kind=PendingTimer.KIND_BREAK, fires_at=break_at, created_at=now),
+            PendingTimer(user=user, kind=PendingTimer.KIND_WORK, fires_at=work_at, created_at=now),
+        ])
+        transaction.on_commit(lambda: schedule(timers))
+    return timers
+
+
+def cancel(user):
+    return PendingTimer.objects.filter(user=user).delete()[0]
+
+
+class PomodoroSchedulerMiddleware:
+    # Starts the worker's scheduler, if it runs one, with the first scope the
+    # server hands over: the lifespan startup for servers that send one, or
+    # else the first request or connection. The workers of `manage.py serve`
+    # start theirs as soon as their event loop runs; this is a fallback.
+    def __init__(self, application):
+        self.application = application
+
+    async def __call__(self, scope, receive, send):
+        if _enabled or settings.POMODORO['SCHEDULER']:
+            ensure_scheduler()
+        return await self.application(scope, receive, send)
@@ -0,0 +1,96 @@
+import hashlib
+import math
+import threading
+import time
+from datetime import datetime, timezone as dt_timezone
+
+from django.conf import settings
+from django.utils import timezone
+from rest_framework_simplejwt.settings import api_settings
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class BloomFilter:
+    def __init__(self, capacity, error_rate=0.01):
+        capacity = max(capacity, 1)
+        self.size = max(int(-capacity * math.log(error_rate) / (math.log(2) ** 2)), 8)
+        self.hash_count = max(int(round(self.size / capacity * math.log(2))), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little') | 1
+        return ((first + i * second) % self.size for i in range(self.hash_count))
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+
+class RevocationList:
+    # A token that was never revoked is cleared by the Bloom filter without a
+    # query. The filter is rebuilt (and expired rows pruned) every
+    # REBUILD_INTERVAL seconds, which is also when revocations made by other
+    # workers become visible to this one.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._bloom = None
+        self._built_at = 0.0
+
+    @property
+    def options(self):
+        return settings.TOKEN_REVOCATION
+
+    def _stale(self):
+        return self._bloom is None or time.monotonic() - self._built_at > self.options['REBUILD_INTERVAL']
+
+    def rebuild(self):
+        from .models import RevokedToken
+
+        with self._lock:
+            pruned, _ = RevokedToken.objects.filter(expires_at__lte=timezone.now()).delete()
+            jtis = list(RevokedToken.objects.values_list('jti', flat=True))
+            bloom = BloomFilter(max(len(jtis) * 2, self.options['MIN_CAPACITY']), self.options['ERROR_RATE'])
+            for jti in jtis:
+                bloom.add(jti)
+            self._bloom = bloom
+            self._built_at = time.monotonic()
+        logger.debug('Revocation filter rebuilt with %d tokens, %d expired pruned', len(jtis), pruned)
+
+    def revoke(self, token):
+        from .models import RevokedToken
+
+        jti = token[api_settings.JTI_CLAIM]
+        expires_at = datetime.fromtimestamp(token['exp'], tz=dt_timezone.utc)
+        # The unique jti row decides which of several concurrent revocations
+        # wins; callers that rotate on revocation must honour the result.
+        _, created = RevokedToken.objects.get_or_create(jti=jti, defaults={'expires_at': expires_at})
+        if self._stale():
+            self.rebuild()
+        else:
+            self._bloom.add(jti)
+        if created:
+            logger.info('Refresh token revoked: %s', jti)
+        return created
+
+    def is_revoked(self, jti):
+        from .models import RevokedToken
+
+        if self._stale():
+            self.rebuild()
+        if jti not in self._bloom:
+            return False
+        return RevokedToken.objects.filter(jti=jti).exists()
+
+    def reset(self):
+        with self._lock:
+            self._bloom = None
+
+
+revoked_tokens = RevocationList()
@@ -0,0 +1,95 @@
+import random
+from contextvars import ContextVar
+from functools import wraps
+
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.core.cache import caches
+import logging
+
+logger = logging.getLogger(__name__)
+
+PRIMARY = 'default'
+
+_replica_reads = ContextVar('clock_replica_reads', default=False)
+
+
+def replicas():
+    return settings.DATABASE_ROUTING['REPLICAS']
+
+
+def _pin_key(user_id):
+    return f'primary-pin:{user_id}'
+
+
+def pin_to_primary(*user_ids):
+    # Replicas may not have a user's latest writes yet, so that user's reads
+    # stay on the primary until the window (longer than the expected lag)
+    # has passed.
+    if not replicas():
+        return
+    cache = caches[settings.DATABASE_ROUTING['CACHE']]
+    cache.set_many({_pin_key(user_id): True for user_id in user_ids if user_id is not None},
+                   settings.DATABASE_ROUTING['STICKY_SECONDS'])
+
+
+def is_pinned(user_id):
+    return bool(caches[settings.DATABASE_ROUTING['CACHE']].get(_pin_key(user_id)))
+
+
+async def ais_pinned(user_id):
+    return bool(await caches[settings.DATABASE_ROUTING['CACHE']].aget(_pin_key(user_id)))
+
+
+def replica_reads(method):
+    # Marks a read-only view method whose queries may be answered by a
+    # replica, unless the requesting user wrote recently.
+    if iscoroutinefunction(method):
+        return _async_replica_reads(method)
+
+    @wraps(method)
+    def wrapper(self, request, *args, **kwargs):
+        user = request.user
+        if not replicas() or (user.is_authenticated and is_pinned(user.pk)):
+            return method(self, request, *args, **kwargs)
+        token = _replica_reads.set(True)
+        try:
+            return method(self, request, *args, **kwargs)
+        finally:
+            _replica_reads.reset(token)
+    return wrapper
+
+
+def _async_replica_reads(method):
+    # The async ORM runs queries in a thread with a copy of the context, so
+    # the flag set here still reaches the router.
+    @wraps(method)
+    async def wrapper(self, request, *args, **kwargs):
+        user = request.user
+        if not replicas() or (user.is_authenticated and await ais_pinned(user.pk)):
+            return await method(self, request, *args, **kwargs)
+        token = _replica_reads.set(True)
+        try:
+            return await method(self, request, *args, **kwargs)
+        finally:
+            _replica_reads.reset(token)
+    return wrapper
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        if _replica_reads.get():
+            return random.choice(replicas())
+        return PRIMARY
+
+    def db_for_write(self, model, **hints):
+        # Explicit, so that saving an instance loaded from a replica does not
+        # write back to that replica.
+        return PRIMARY
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Replicas receive the schema through replication.
+        return db not in replicas()
@@ -0,0 +1,110 @@
+import gzip
+import hashlib
+import re
+import threading
+from pathlib import Path
+
+from django.conf import settings
+from django.http import Http404, HttpResponse, HttpResponseNotModified
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.utils.http import parse_etags
+from drf_yasg import openapi
+from drf_yasg.codecs import OpenAPICodecJson, OpenAPICodecYaml
+from drf_yasg.views import get_schema_view
+from rest_framework import permissions
+import logging
+
+logger = logging.getLogger(__name__)
+
+API_INFO = openapi.Info(
+    title='Clock API',
+    default_version='v1',
+    description='API documentation for the Clock application',
+    contact=openapi.Contact(email='bus9ko@gmail.com')
+)
+
+schema_view = get_schema_view(
+    API_INFO,
+    public=True,
+    permission_classes=[permissions.AllowAny],
+)
+
+FORMATS = {
+    '.json': ('application/json', OpenAPICodecJson),
+    '.yaml': ('application/yaml', OpenAPICodecYaml),
+}
+ACCEPTS_GZIP = re.compile(r'\bgzip\b')
+
+
+class RenderedSchema:
+    def __init__(self, content, content_type):
+        self.content = content
+        self.content_type = content_type
+        self.gzipped = gzip.compress(content, compresslevel=9, mtime=0)
+        self.etag = f'"{hashlib.sha256(content).hexdigest()[:32]}"'
+
+
+_rendered = {}
+_lock = threading.Lock()
+
+
+def schema_file(extension):
+    return Path(settings.API_SCHEMA['DIR']) / f'openapi{extension}'
+
+
+def render_schema():
+    # The document does not depend on the request: the view is public and
+    # lists every endpoint, so it is the same for all clients.
+    generator = schema_view.generator_class(API_INFO)
+    document = generator.get_schema(request=None, public=True)
+    return {extension: codec(validators=[]).encode(document) for extension, (_, codec) in FORMATS.items()}
+
+
+def load_schema():
+    files = {extension: schema_file(extension) for extension in FORMATS}
+    if all(path.is_file() for path in files.values()):
+        logger.info('Loading the pre-rendered OpenAPI schema from %s', settings.API_SCHEMA['DIR'])
+        return {extension: path.read_bytes() for extension, path in files.items()}
+    logger.info('Generating the OpenAPI schema')
+    return render_schema()
+
+
+def get_rendered(extension):
+    with _lock:
+        if not _rendered:
+            for ext, content in load_schema().items():
+                _rendered[ext] = RenderedSchema(content, FORMATS[ext][0])
+        return _rendered[extension]
+
+
+def warm_schema_cache():
+    # Only the pre-rendered files are loaded at startup: generating the
+    # document takes longer than the rest of a worker's startup, so without
+    # them that is left to the first request for it.
+    if all(schema_file(extension).is_file() for extension in FORMATS):
+        get_rendered('.json')
+
+
+def reset_schema_cache():
+    with _lock:
+        _rendered.clear()
+
+
+def schema_document(request, format):
+    if format not in FORMATS:
+        raise Http404('Unknown schema format')
+    rendered = get_rendered(format)
+
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match and rendered.etag in parse_etags(if_none_match):
+        response = HttpResponseNotModified()
+    elif ACCEPTS_GZIP.search(request.headers.get('Accept-Encoding', '')):
+        response = HttpResponse(rendered.gzipped, content_type=rendered.content_type)
+        response['Content-Encoding'] = 'gzip'
+    else:
+        response = HttpResponse(rendered.content, content_type=rendered.content_type)
+
+    response['ETag'] = rendered.etag
+    patch_vary_headers(response, ['Accept-Encoding'])
+    patch_cache_control(response, public=True, no_cache=True)
+    return response
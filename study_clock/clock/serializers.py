@@ -1,27 +1,66 @@
+from django.conf import settings
 from django.contrib.auth import authenticate
+from django.db import IntegrityError, transaction
 from rest_framework import serializers
+from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
+from rest_framework_simplejwt.serializers import TokenRefreshSerializer
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import RefreshToken
 from .models import User, PrivateMessage, Activity
+from .revocation import revoked_tokens
+from .exceptions import Conflict, ConcurrentUpdateError
 from .utils import send_email_confirmation
 
 
+UNIQUE_FIELD_ERRORS = {
+    'email': 'This email is already in use.',
+    'username': 'A user with that username already exists.',
+}
+# Uniqueness of username and email is left to the case-insensitive unique
+# indexes: the INSERT/UPDATE itself is the check, instead of a separate
+# exists() query that races and misses case variants.
+SKIP_UNIQUE_VALIDATORS = {'username': {'validators': []}, 'email': {'validators': []}}
+
+
+UNIQUE_CONSTRAINT_FIELDS = {
+    'user_username_lower_unique': 'username',
+    'user_email_lower_unique': 'email',
+}
+
+
+def unique_violation(error):
+    # The field whose constraint rejected the write: PostgreSQL names the
+    # constraint in the error's diagnostics, SQLite in the message. Any other
+    # integrity error is not a duplicate and is raised again.
+    constraint = getattr(getattr(error.__cause__, 'diag', None), 'constraint_name', None) or str(error)
+    for name, field in UNIQUE_CONSTRAINT_FIELDS.items():
+        if name in constraint:
+            return serializers.ValidationError({field: [UNIQUE_FIELD_ERRORS[field]]})
+    raise error
+
+
 class RegisterSerializer(serializers.ModelSerializer):
     class Meta:
         model = User
         fields = ('first_name', 'last_name', 'username', 'email', 'password', 'date_of_birth', 'country', 'avatar')
-        extra_kwargs = {'password': {'write_only': True}}
+        extra_kwargs = {'password': {'write_only': True}, **SKIP_UNIQUE_VALIDATORS}
 
     def create(self, validated_data):
-        user = User.objects.create_user(
-            first_name = validated_data['first_name'],
-            last_name = validated_data['last_name'],
-            username=validated_data['username'],
-            email=validated_data['email'],
-            password=validated_data['password'],
-            date_of_birth=validated_data['date_of_birth'],
-            country=validated_data['country'],
-            avatar=validated_data.get('avatar', None)
-        )
-        send_email_confirmation(user=user)
+        try:
+            with transaction.atomic():
+                user = User.objects.create_user(
+                    first_name = validated_data['first_name'],
+                    last_name = validated_data['last_name'],
+                    username=validated_data['username'],
+                    email=validated_data['email'],
+                    password=validated_data['password'],
+                    date_of_birth=validated_data['date_of_birth'],
+                    country=validated_data['country'],
+                    avatar=validated_data.get('avatar', None)
+                )
+                send_email_confirmation(user=user)
+        except IntegrityError as e:
+            raise unique_violation(e)
         return user
 
 
@@ -44,21 +83,104 @@ class LoginSerializer(serializers.Serializer):
         raise serializers.ValidationError('Invalid username or password.')
 
 
+class RevocableTokenRefreshSerializer(TokenRefreshSerializer):
+    def validate(self, attrs):
+        refresh = self.token_class(attrs['refresh'])
+        if revoked_tokens.is_revoked(refresh[api_settings.JTI_CLAIM]):
+            raise InvalidToken('Token is revoked')
+
+        data = {'access': str(refresh.access_token)}
+        if api_settings.ROTATE_REFRESH_TOKENS:
+            # is_revoked() only sees this worker's filter, so a refresh racing
+            # this one (here or on another worker) can pass it too; only the
+            # one that inserts the revocation gets a new pair.
+            if api_settings.BLACKLIST_AFTER_ROTATION and not revoked_tokens.revoke(refresh):
+                raise InvalidToken('Token is revoked')
+            refresh.set_jti()
+            refresh.set_exp()
+            refresh.set_iat()
+            data['refresh'] = str(refresh)
+        return data
+
+
+class LogoutSerializer(serializers.Serializer):
+    refresh = serializers.CharField()
+
+    def validate(self, attrs):
+        try:
+            refresh = RefreshToken(attrs['refresh'])
+        except TokenError as e:
+            raise serializers.ValidationError({'refresh': str(e)})
+        return {'refresh': refresh}
+
+    def save(self):
+        revoked_tokens.revoke(self.validated_data['refresh'])
+
+
 class UserSerializer(serializers.ModelSerializer):
+    version = serializers.IntegerField(required=False, min_value=0)
+
     class Meta:
         model = User
-        fields = ['id', 'first_name', 'last_name', 'username', 'email', 'date_of_birth', 'country', 'is_premium']
+        fields = ['id', 'first_name', 'last_name', 'username', 'email', 'date_of_birth', 'country', 'is_premium',
+                  'version']
+        extra_kwargs = SKIP_UNIQUE_VALIDATORS
+
+    def create(self, validated_data):
+        validated_data.pop('version', None)
+        try:
+            with transaction.atomic():
+                return super().create(validated_data)
+        except IntegrityError as e:
+            raise unique_violation(e)
+
+    def update(self, instance, validated_data):
+        # `version` is the one the client last read; without it the version
+        # loaded for this request is used.
+        expected_version = validated_data.pop('version', instance.version)
+        if expected_version != instance.version:
+            raise Conflict()
+
+        changed = [field for field, value in validated_data.items() if getattr(instance, field) != value]
+        if not changed:
+            return instance
+        for field in changed:
+            setattr(instance, field, validated_data[field])
+        try:
+            instance.save(update_fields=changed)
+        except ConcurrentUpdateError:
+            raise Conflict()
+        except IntegrityError as e:
+            raise unique_violation(e)
+        return instance
+
+
+class UserImportSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = User
+        fields = ('first_name', 'last_name', 'username', 'email', 'password', 'date_of_birth', 'country', 'is_premium')
+        # Uniqueness is checked per chunk by the import command.
+        extra_kwargs = {'username': {'validators': []}, 'email': {'validators': []}}
+
+    def validate_email(self, value):
+        return User.objects.normalize_email(value)
 
 
 class EmailUpdateSerializer(serializers.ModelSerializer):
     class Meta:
         model = User
         fields = ['email']
+        extra_kwargs = SKIP_UNIQUE_VALIDATORS
 
-    def validate_email(self, value):
-        if User.objects.filter(email=value).exists():
-            raise serializers.ValidationError('This email is already in use.')
-        return value
+    def update(self, instance, validated_data):
+        # A new address has to be confirmed again.
+        instance.email = validated_data['email']
+        instance.email_confirmed = False
+        try:
+            instance.save(update_fields=['email', 'email_confirmed'])
+        except IntegrityError as e:
+            raise unique_violation(e)
+        return instance
 
 
 class AvatarUpdateSerializer(serializers.ModelSerializer):
@@ -71,7 +193,8 @@ class PrivateMessageSerializer(serializers.ModelSerializer):
     class Meta:
         model = PrivateMessage
         fields = ['id', 'sender', 'receiver', 'content', 'timestamp', 'is_read']
-        read_only_fields = ['timestamp', 'is_read']
+        # The sender is always the authenticated user.
+        read_only_fields = ['sender', 'timestamp', 'is_read']
 
 
 class ActivitySerializer(serializers.ModelSerializer):
@@ -79,3 +202,10 @@ class ActivitySerializer(serializers.ModelSerializer):
         model = Activity
         fields = ['name']
         #read_only_fields = ['user', 'minutes']
+
+
+class PomodoroSerializer(serializers.Serializer):
+    work_minutes = serializers.IntegerField(min_value=1, max_value=240,
+                                            default=lambda: settings.POMODORO['WORK_MINUTES'])
+    break_minutes = serializers.IntegerField(min_value=1, max_value=240,
+                                             default=lambda: settings.POMODORO['BREAK_MINUTES'])
@@ -0,0 +1,100 @@
+from collections import Counter
+
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from . import achievements, caching, metrics, routers, stats
+from .models import Activity, PrivateMessage, StudySession, User
+
+
+@receiver(post_save, sender=User)
+def update_demographics_on_save(sender, instance, created, update_fields=None, raw=False, **kwargs):
+    if raw:
+        return
+    if update_fields is not None and not stats.TRACKED_FIELDS & set(update_fields):
+        return
+    current = stats.contributions(instance)
+    previous = None if created else instance._demographics
+    if previous is None and not created:
+        # Saved without having been loaded through the ORM; the old values
+        # are unknown, so leave the counters to `rebuild_user_stats`.
+        instance._demographics = current
+        return
+    deltas = current.copy()
+    if previous is not None:
+        deltas.subtract(previous)
+    stats.apply_deltas(deltas)
+    instance._demographics = current
+
+
+@receiver(post_delete, sender=User)
+def update_demographics_on_delete(sender, instance, **kwargs):
+    previous = instance._demographics or stats.contributions(instance)
+    deltas = Counter()
+    deltas.subtract(previous)
+    stats.apply_deltas(deltas)
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_cached_user(sender, instance, raw=False, **kwargs):
+    if not raw:
+        caching.invalidate_user(instance.pk)
+
+
+@receiver(post_save, sender=Activity)
+@receiver(post_delete, sender=Activity)
+def invalidate_cached_activities(sender, instance, raw=False, **kwargs):
+    if not raw:
+        caching.invalidate_activities(instance.user_id)
+
+
+@receiver(post_save, sender=PrivateMessage)
+@receiver(post_delete, sender=PrivateMessage)
+def invalidate_cached_conversation(sender, instance, raw=False, **kwargs):
+    if not raw:
+        caching.invalidate_conversation(instance.sender_id, instance.receiver_id)
+
+
+@receiver(post_save, sender=StudySession)
+@receiver(post_delete, sender=StudySession)
+def invalidate_cached_study_time(sender, instance, raw=False, **kwargs):
+    if not raw:
+        caching.invalidate_study_time(instance.user_id)
+
+
+@receiver(post_save, sender=StudySession)
+def record_study_for_achievements(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        achievements.record_session(instance)
+
+
+@receiver(post_save, sender=Activity)
+def record_activity_for_achievements(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        achievements.record_activity(instance)
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+@receiver(post_save, sender=Activity)
+@receiver(post_delete, sender=Activity)
+@receiver(post_save, sender=PrivateMessage)
+@receiver(post_delete, sender=PrivateMessage)
+def pin_writers_to_primary(sender, instance, raw=False, **kwargs):
+    # Everyone whose reads would show the change, not only the author: the
+    # receiver of a message must not see a conversation without it either.
+    if raw:
+        return
+    if sender is User:
+        routers.pin_to_primary(instance.pk)
+    elif sender is Activity:
+        routers.pin_to_primary(instance.user_id)
+    else:
+        routers.pin_to_primary(instance.sender_id, instance.receiver_id)
+
+
+@receiver(connection_created)
+def time_queries(sender, connection, **kwargs):
+    metrics.install_query_timer(connection)
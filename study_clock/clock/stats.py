@@ -0,0 +1,180 @@
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from functools import reduce
+from operator import or_
+
+from django.db import transaction
+from django.db.models import Case, Count, F, Q, Value, When
+from django.db.models.functions import ExtractYear
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+import logging
+
+logger = logging.getLogger(__name__)
+
+TRACKED_FIELDS = frozenset({'country', 'is_premium', 'date_of_birth', 'email_confirmed'})
+AGE_BUCKETS = ((0, 17, 'under 18'), (18, 24, '18-24'), (25, 34, '25-34'), (35, 44, '35-44'), (45, 54, '45-54'),
+               (55, 64, '55-64'), (65, None, '65+'))
+
+# Counters moved per statement by apply_deltas.
+BATCH_SIZE = 500
+
+_local = threading.local()
+
+
+def contributions(user):
+    # The counter rows a single user adds 1 to. Birth dates are stored rather
+    # than ages so counts never go stale as users get older; per year for
+    # the bulk of the age buckets, and per day for the years whose users
+    # straddle a bucket boundary until their birthday.
+    date_of_birth = user.date_of_birth
+    if isinstance(date_of_birth, str):
+        date_of_birth = parse_date(date_of_birth)
+    return Counter({
+        ('total', ''): 1,
+        ('country', str(getattr(user.country, 'code', user.country) or '')): 1,
+        ('premium', '1' if user.is_premium else '0'): 1,
+        ('email_confirmed', '1' if user.email_confirmed else '0'): 1,
+        ('birth_year', str(date_of_birth.year) if date_of_birth else ''): 1,
+        ('birth_date', date_of_birth.isoformat() if date_of_birth else ''): 1,
+    })
+
+
+def snapshot(user):
+    if TRACKED_FIELDS & user.get_deferred_fields():
+        return None
+    return contributions(user)
+
+
+def apply_deltas(deltas):
+    deltas = {key: delta for key, delta in deltas.items() if delta}
+    if not deltas:
+        return
+    pending = getattr(_local, 'pending', None)
+    if pending is not None:
+        pending.update(deltas)
+        return
+
+    # A fixed number of queries per BATCH_SIZE counters, as a user's birth
+    # date alone is often a counter of its own: the missing rows are created
+    # at zero, then one UPDATE adds every delta. Batches keep the statements
+    # of bulk deletes, which move thousands of counters, within the
+    # database's limits.
+    deltas = list(deltas.items())
+    with transaction.atomic():
+        for start in range(0, len(deltas), BATCH_SIZE):
+            _apply_batch(dict(deltas[start:start + BATCH_SIZE]))
+
+
+def _apply_batch(deltas):
+    from .models import DemographicCounter
+
+    keys_by_dimension = {}
+    for dimension, key in deltas:
+        keys_by_dimension.setdefault(dimension, []).append(key)
+    rows = DemographicCounter.objects.filter(
+        reduce(or_, (Q(dimension=dimension, key__in=keys) for dimension, keys in keys_by_dimension.items())))
+    missing = set(deltas) - set(rows.values_list('dimension', 'key'))
+    if missing:
+        # Another writer may create some of them first.
+        DemographicCounter.objects.bulk_create(
+            [DemographicCounter(dimension=dimension, key=key) for dimension, key in missing], ignore_conflicts=True)
+    rows.update(count=F('count') + Case(
+        *[When(dimension=dimension, key=key, then=Value(delta)) for (dimension, key), delta in deltas.items()],
+        default=Value(0),
+    ))
+
+
+@contextmanager
+def deferred():
+    # Collects counter changes from many saves or deletes and writes them in
+    # one pass on exit, e.g. around bulk deletes that fire one signal per row.
+    if getattr(_local, 'pending', None) is not None:
+        yield
+        return
+    _local.pending = Counter()
+    try:
+        yield
+    finally:
+        pending, _local.pending = _local.pending, None
+    apply_deltas(pending)
+
+
+def record_created(users):
+    total = Counter()
+    for user in users:
+        total.update(contributions(user))
+    apply_deltas(total)
+
+
+def rebuild():
+    from .models import DemographicCounter, User
+
+    counts = Counter()
+    counts[('total', '')] = User.objects.count()
+    for row in User.objects.values('country').annotate(n=Count('pk')).order_by():
+        counts[('country', row['country'])] = row['n']
+    for row in User.objects.values('is_premium').annotate(n=Count('pk')).order_by():
+        counts[('premium', '1' if row['is_premium'] else '0')] = row['n']
+    for row in User.objects.values('email_confirmed').annotate(n=Count('pk')).order_by():
+        counts[('email_confirmed', '1' if row['email_confirmed'] else '0')] = row['n']
+    for row in User.objects.annotate(year=ExtractYear('date_of_birth')).values('year').annotate(n=Count('pk')).order_by():
+        counts[('birth_year', str(row['year']) if row['year'] else '')] = row['n']
+    for row in User.objects.values('date_of_birth').annotate(n=Count('pk')).order_by():
+        counts[('birth_date', row['date_of_birth'].isoformat() if row['date_of_birth'] else '')] = row['n']
+
+    with transaction.atomic():
+        DemographicCounter.objects.all().delete()
+        DemographicCounter.objects.bulk_create(
+            DemographicCounter(dimension=dimension, key=key, count=count)
+            for (dimension, key), count in counts.items()
+        )
+    logger.info('Demographic counters rebuilt for %d users', counts[('total', '')])
+
+
+def age_bucket(age):
+    for _, high, label in AGE_BUCKETS:
+        if high is None or age <= high:
+            return label
+
+
+def summary(today=None):
+    from .models import DemographicCounter
+
+    today = today or timezone.localdate()
+    counters = {}
+    for dimension, key, count in DemographicCounter.objects.exclude(dimension='birth_date') \
+            .values_list('dimension', 'key', 'count'):
+        counters.setdefault(dimension, {})[key] = count
+
+    # Users born in a given year are one of two ages, depending on whether
+    # their birthday has come yet this year. Both fall in the same bucket,
+    # except in the years right after each bucket's upper age; for those,
+    # the users yet to have their birthday are counted from the per-day rows.
+    boundary_years = [today.year - high - 1 for _, high, _ in AGE_BUCKETS if high is not None]
+    not_yet = Counter()
+    ranges = Q()
+    for year in boundary_years:
+        ranges |= Q(key__gt=f'{year:04d}-{today:%m-%d}', key__lte=f'{year:04d}-12-31')
+    for key, count in DemographicCounter.objects.filter(ranges, dimension='birth_date').values_list('key', 'count'):
+        not_yet[int(key[:4])] += count
+
+    total = counters.get('total', {}).get('', 0)
+    age_buckets = {label: 0 for _, _, label in AGE_BUCKETS}
+    for year, count in counters.get('birth_year', {}).items():
+        if not year:
+            continue
+        age = today.year - int(year)
+        later = not_yet[int(year)]
+        age_buckets[age_bucket(age)] += count - later
+        if later:
+            age_buckets[age_bucket(age - 1)] += later
+
+    return {
+        'total_users': total,
+        'users_per_country': {code: count for code, count in sorted(counters.get('country', {}).items()) if count},
+        'premium_ratio': counters.get('premium', {}).get('1', 0) / total if total else 0.0,
+        'email_confirmed_ratio': counters.get('email_confirmed', {}).get('1', 0) / total if total else 0.0,
+        'age_buckets': age_buckets,
+    }
@@ -1,27 +1,91 @@
+import asyncio
+import gzip
+import json
 import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
 import uuid
+import queue
 import random
-
+import signal
+import threading
+import time
+import urllib.error
+import urllib.request
+from unittest import mock, skipUnless
+from io import BytesIO, StringIO
+
+from asgiref.sync import async_to_sync
+from channels.exceptions import ChannelFull
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import update_last_login
+from django.contrib.auth.signals import user_login_failed
+from django.core import mail
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.mail.backends.base import BaseEmailBackend
 from django.core.files.uploadedfile import SimpleUploadedFile
-from django.db import IntegrityError, models
+from django.core.management import CommandError, call_command
+from django.db import IntegrityError, connection, connections, models
 from django.db.models import F, ExpressionWrapper, fields
 from django.http import HttpRequest
-from django.test import TestCase
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 from rest_framework.exceptions import ValidationError
 
-from .models import User, Activity, PrivateMessage
-from rest_framework.test import APITestCase, APIClient
+from .models import User, Activity, PrivateMessage, RevokedToken, OutgoingEmail, StudySession, Achievement, \
+    AchievementProgress, PendingTimer
+from rest_framework.test import APITestCase, APITransactionTestCase, APIClient
+from rest_framework_simplejwt.tokens import RefreshToken
 
 from .permissions import IsAdmin, IsPremiumUser
-from .serializers import RegisterSerializer, LoginSerializer, EmailUpdateSerializer
-from django.urls import reverse, resolve
+from .revocation import revoked_tokens
+from .hashing import hasher_pool
+from .avatars import stage_original
+from .exceptions import ConcurrentUpdateError
+from .caching import cache_stats, get_cache as get_response_cache
+from .schema import render_schema, reset_schema_cache, warm_schema_cache
+from .log import JsonFormatter, QueueListenerHandler, SamplingFilter
+from .metrics import MetricsRegistry, RequestStats, metrics_registry
+from .routers import ReplicaRouter, replica_reads
+from .checks import check_replica_pin_cache
+from .staticfiles import AsyncWhiteNoiseMiddleware
+from .routing import websocket_urlpatterns
+from .management.commands.bench import Command as BenchCommand, percentile
+from .management.commands.replicate_sqlite import copy_database
+from .management.commands.profile_startup import parse_importtime
+from .management.commands.serve import Arbiter, resident_memory
+from .channel_layers import ChannelBroker, LocalFanOutChannelLayer, UnixSocketChannelLayer
+from . import achievements, heatmap, pomodoro, stats
+from .utils import send_email_confirmation, queue_email, deliver_queued_emails, make_email_verification_token
+from .serializers import RegisterSerializer, LoginSerializer, EmailUpdateSerializer, UserSerializer, unique_violation
+from django.urls import get_resolver, reverse, resolve
 from rest_framework import status
 from .views import RegisterView, ProtectedView
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 from django.db import transaction
 
 logger = logging.getLogger(__name__)
 
+_arbiter_guard = mock.patch.object(Arbiter, 'run', side_effect=AssertionError(
+    'A test started the serve arbiter in-process; run `manage.py serve` in a subprocess instead'))
+
+
+def setUpModule():
+    # An arbiter started here would spawn real workers and never return.
+    _arbiter_guard.start()
+
+
+def tearDownModule():
+    _arbiter_guard.stop()
+
 
 class UserManagerTest(TestCase):
     def setUp(self):
@@ -602,15 +666,15 @@ class VerifyEmailTest(APITestCase):
             date_of_birth='2000-01-01',
             country='US'
         )
-        self.user.email_confirmation_token = str(uuid.uuid4())
-        self.user.save()
+        self.token = make_email_verification_token(self.user)
 
     def test_email_verification_success(self):
         logger.info('Starting test_email_verification_success')
-        response = self.client.get(f'/verify-email/?token={self.user.email_confirmation_token}')
+        response = self.client.get(f'/verify-email/?token={self.token}')
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.user.refresh_from_db()
         self.assertTrue(self.user.email_confirmed)
+        self.assertIsNotNone(self.user.email_first_confirmed_at)
         logger.info('test_email_verification_success passed')
 
     def test_email_verification_invalid_token(self):
@@ -633,6 +697,82 @@ class VerifyEmailTest(APITestCase):
         self.assertEqual(response.data['detail'], 'Invalid or expired token')
         logger.info('test_email_verification_of_non_existing_user passed')
 
+    def test_invalid_token_rejected_without_queries(self):
+        logger.info('Starting test_invalid_token_rejected_without_queries')
+        with self.assertNumQueries(0):
+            response = self.client.get(f'/verify-email/?token={self.token}tampered')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        logger.info('test_invalid_token_rejected_without_queries passed')
+
+    @override_settings(EMAIL_VERIFICATION_TOKEN_MAX_AGE=-1)
+    def test_expired_token(self):
+        logger.info('Starting test_expired_token')
+        with self.assertNumQueries(0):
+            response = self.client.get(f'/verify-email/?token={self.token}')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.user.refresh_from_db()
+        self.assertFalse(self.user.email_confirmed)
+        logger.info('test_expired_token passed')
+
+    def test_token_invalid_after_email_change(self):
+        logger.info('Starting test_token_invalid_after_email_change')
+        self.user.email = 'changed@example.com'
+        self.user.save()
+        response = self.client.get(f'/verify-email/?token={self.token}')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        logger.info('test_token_invalid_after_email_change passed')
+
+
+class PurgeUnconfirmedUsersCommandTest(TestCase):
+    def setUp(self):
+        logger.info('Setting up PurgeUnconfirmedUsersCommandTest...')
+        for i in range(5):
+            User.objects.create_user(
+                username=f'stale_{i}',
+                email=f'stale_{i}@example.com',
+                password='password',
+                date_of_birth='2000-01-01',
+                country='US'
+            )
+        User.objects.update(date_joined=timezone.now() - timedelta(days=30))
+        User.objects.create_user(
+            username='fresh',
+            email='fresh@example.com',
+            password='password',
+            date_of_birth='2000-01-01',
+            country='US'
+        )
+        confirmed = User.objects.get(username='stale_0')
+        confirmed.email_confirmed = True
+        confirmed.email_first_confirmed_at = timezone.now() - timedelta(days=29)
+        confirmed.save()
+
+    def test_purge_unconfirmed_users(self):
+        logger.info('Starting test_purge_unconfirmed_users')
+        call_command('purge_unconfirmed_users', days=14, chunk_size=2, stdout=StringIO())
+        self.assertEqual(set(User.objects.values_list('username', flat=True)), {'stale_0', 'fresh'})
+        logger.info('test_purge_unconfirmed_users passed')
+
+    def test_purge_dry_run(self):
+        logger.info('Starting test_purge_dry_run')
+        stdout = StringIO()
+        call_command('purge_unconfirmed_users', dry_run=True, stdout=stdout)
+        self.assertIn('4 unconfirmed users would be deleted', stdout.getvalue())
+        self.assertEqual(User.objects.count(), 6)
+        logger.info('test_purge_dry_run passed')
+
+    def test_purge_keeps_confirmed_user_after_email_change(self):
+        logger.info('Starting test_purge_keeps_confirmed_user_after_email_change')
+        confirmed = User.objects.get(username='stale_0')
+        serializer = EmailUpdateSerializer(confirmed, data={'email': 'changed@example.com'})
+        self.assertTrue(serializer.is_valid(), serializer.errors)
+        serializer.save()
+        confirmed.refresh_from_db()
+        self.assertFalse(confirmed.email_confirmed)
+        call_command('purge_unconfirmed_users', days=14, stdout=StringIO())
+        self.assertTrue(User.objects.filter(username='stale_0').exists())
+        logger.info('test_purge_keeps_confirmed_user_after_email_change passed')
+
 
 
 class UpdateEmailTest(APITestCase):
@@ -658,11 +798,12 @@ class UpdateEmailTest(APITestCase):
         self.another_user.save()
 
     def test_invalid_email(self):
-        data = {'username': 'testuser', 'password': 'password123', 'email' : 'test@example.com'}
-        email_serializer = EmailUpdateSerializer(data)
-        new_email = 'another@example.com'
-        with self.assertRaises(ValidationError):
-            email_serializer.validate_email(new_email)
+        for new_email in ('another@example.com', 'Another@Example.COM'):
+            response = self.client.post('/update-email/', {'email': new_email})
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+            self.assertIn('email', response.data)
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.email, 'test@example.com')
 
     def test_update_email(self):
         logger.info('Starting test_update_email')
@@ -915,3 +1056,2178 @@ class LoginViewTest(APITestCase):
         logger.info("test_invalid_post_request_login_view passed")
 
 
+
+
+class TokenRevocationTest(APITestCase):
+    def setUp(self):
+        logger.info('Setting up TokenRevocationTest...')
+        revoked_tokens.reset()
+        self.user = User.objects.create_user(
+            username='user',
+            email='user@gmail.com',
+            password='password',
+            date_of_birth='2020-01-01',
+            country='BY'
+        )
+        self.refresh = str(RefreshToken.for_user(self.user))
+
+    def test_refresh_not_revoked_token_without_queries(self):
+        logger.info('Starting test_refresh_not_revoked_token_without_queries')
+        url = reverse('token_refresh')
+        response = self.client.post(url, {'refresh': self.refresh})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        with self.assertNumQueries(0):
+            response = self.client.post(url, {'refresh': self.refresh})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn('access', response.data)
+        logger.info('test_refresh_not_revoked_token_without_queries passed')
+
+    def test_logout_revokes_refresh_token(self):
+        logger.info('Starting test_logout_revokes_refresh_token')
+        response = self.client.post(reverse('logout'), {'refresh': self.refresh})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self.client.post(reverse('token_refresh'), {'refresh': self.refresh})
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        logger.info('test_logout_revokes_refresh_token passed')
+
+    def test_logout_with_invalid_token(self):
+        logger.info('Starting test_logout_with_invalid_token')
+        response = self.client.post(reverse('logout'), {'refresh': 'invalid'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        logger.info('test_logout_with_invalid_token passed')
+
+    def test_rebuild_prunes_expired_tokens(self):
+        logger.info('Starting test_rebuild_prunes_expired_tokens')
+        RevokedToken.objects.create(jti='expired', expires_at=timezone.now() - timedelta(minutes=1))
+        RevokedToken.objects.create(jti='active', expires_at=timezone.now() + timedelta(days=1))
+        revoked_tokens.rebuild()
+        self.assertFalse(RevokedToken.objects.filter(jti='expired').exists())
+        self.assertTrue(revoked_tokens.is_revoked('active'))
+        self.assertFalse(revoked_tokens.is_revoked('expired'))
+        logger.info('test_rebuild_prunes_expired_tokens passed')
+
+    @mock.patch('clock.serializers.api_settings.ROTATE_REFRESH_TOKENS', True)
+    def test_concurrent_rotation_issues_one_pair(self):
+        logger.info('Starting test_concurrent_rotation_issues_one_pair')
+        url = reverse('token_refresh')
+        # Both refreshes pass the filter check before either revokes, as two
+        # workers with their own filters would.
+        with mock.patch.object(revoked_tokens, 'is_revoked', return_value=False):
+            responses = [self.client.post(url, {'refresh': self.refresh}) for _ in range(2)]
+        self.assertEqual(sorted(response.status_code for response in responses), [200, 401])
+        self.assertEqual(RevokedToken.objects.count(), 1)
+        logger.info('test_concurrent_rotation_issues_one_pair passed')
+
+
+class AsyncLoginViewTest(APITestCase):
+    def setUp(self):
+        logger.info("Setting up AsyncLoginViewTest...")
+        self.user = User.objects.create_user(
+            username='user',
+            email='user@gmail.com',
+            password='password',
+            date_of_birth='2020-01-01',
+            country='BY'
+        )
+        self.url = reverse('login-async')
+
+    def test_valid_login(self):
+        logger.info('Starting test_valid_login')
+        response = self.client.post(self.url, {'username': 'user', 'password': 'password'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn('refresh', response.json())
+        self.assertIn('access', response.json())
+        logger.info('test_valid_login passed')
+
+    def test_invalid_password(self):
+        logger.info('Starting test_invalid_password')
+        response = self.client.post(self.url, {'username': 'user', 'password': 'fake_password'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertNotIn('access', response.json())
+        logger.info('test_invalid_password passed')
+
+    def test_unknown_user(self):
+        logger.info('Starting test_unknown_user')
+        response = self.client.post(self.url, {'username': 'nobody', 'password': 'password'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        logger.info('test_unknown_user passed')
+
+    def test_saturated_pool_returns_503(self):
+        logger.info('Starting test_saturated_pool_returns_503')
+        slots = hasher_pool.workers + hasher_pool.queue_size
+        for _ in range(slots):
+            hasher_pool._slots.acquire()
+        try:
+            response = self.client.post(self.url, {'username': 'user', 'password': 'password'}, format='json')
+        finally:
+            for _ in range(slots):
+                hasher_pool._slots.release()
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        logger.info('test_saturated_pool_returns_503 passed')
+
+    def test_malformed_body(self):
+        logger.info('Starting test_malformed_body')
+        response = self.client.post(self.url, ['user', 'password'], format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.post(self.url, {'username': 'user', 'password': ['password']}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.json(), {'password': ['Not a valid string.']})
+        logger.info('test_malformed_body passed')
+
+    def test_failed_login_signal(self):
+        logger.info('Starting test_failed_login_signal')
+        failures = []
+        handler = lambda sender, credentials, **kwargs: failures.append(credentials)  # noqa: E731
+        user_login_failed.connect(handler)
+        try:
+            self.client.post(self.url, {'username': 'user', 'password': 'fake_password'}, format='json')
+            self.user.is_active = False
+            self.user.save()
+            response = self.client.post(self.url, {'username': 'user', 'password': 'password'}, format='json')
+        finally:
+            user_login_failed.disconnect(handler)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(len(failures), 2)
+        self.assertNotIn('password', {value for credentials in failures for value in credentials.values()})
+        logger.info('test_failed_login_signal passed')
+
+    @override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.PBKDF2PasswordHasher',
+                                         'django.contrib.auth.hashers.MD5PasswordHasher'])
+    def test_outdated_hash_is_upgraded(self):
+        logger.info('Starting test_outdated_hash_is_upgraded')
+        User.objects.filter(pk=self.user.pk).update(password=make_password('password', hasher='md5'))
+        response = self.client.post(self.url, {'username': 'USER', 'password': 'password'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.user.refresh_from_db()
+        self.assertTrue(self.user.password.startswith('pbkdf2_sha256$'))
+        logger.info('test_outdated_hash_is_upgraded passed')
+
+
+class UserImportExportCommandTest(TestCase):
+    def setUp(self):
+        logger.info('Setting up UserImportExportCommandTest...')
+        User.objects.create_user(
+            username='existing',
+            email='existing@example.com',
+            password='password',
+            date_of_birth='2000-01-01',
+            country='US'
+        )
+
+    def write_file(self, suffix, content):
+        file = tempfile.NamedTemporaryFile('w', suffix=suffix, delete=False, encoding='utf-8')
+        file.write(content)
+        file.close()
+        self.addCleanup(os.remove, file.name)
+        return file.name
+
+    def test_import_csv(self):
+        logger.info('Starting test_import_csv')
+        path = self.write_file('.csv', 'username,email,password,date_of_birth,country\n'
+                                       'alice,alice@example.com,secret1,2000-01-01,US\n'
+                                       'bob,bob@example.com,secret2,1999-05-05,BY\n')
+        call_command('import_users', path, workers=2, stdout=StringIO(), stderr=StringIO())
+        alice = User.objects.get(username='alice')
+        self.assertTrue(alice.check_password('secret1'))
+        self.assertEqual(User.objects.count(), 3)
+        logger.info('test_import_csv passed')
+
+    def test_import_reports_invalid_rows(self):
+        logger.info('Starting test_import_reports_invalid_rows')
+        path = self.write_file('.jsonl', '{"username": "carol", "email": "carol@example.com", "password": "p", '
+                                         '"date_of_birth": "2000-01-01", "country": "US"}\n'
+                                         '{"username": "existing", "email": "other@example.com", "password": "p", '
+                                         '"date_of_birth": "2000-01-01", "country": "US"}\n'
+                                         '{"username": "dave", "email": "not-an-email", "password": "p", '
+                                         '"date_of_birth": "2000-01-01", "country": "US"}\n'
+                                         'not json\n')
+        stderr = StringIO()
+        call_command('import_users', path, workers=0, stdout=StringIO(), stderr=stderr)
+        self.assertTrue(User.objects.filter(username='carol').exists())
+        self.assertFalse(User.objects.filter(username='dave').exists())
+        errors = stderr.getvalue()
+        self.assertIn('line 2:', errors)
+        self.assertIn('line 3:', errors)
+        self.assertIn('line 4:', errors)
+        logger.info('test_import_reports_invalid_rows passed')
+
+    def test_export_jsonl(self):
+        logger.info('Starting test_export_jsonl')
+        stdout = StringIO()
+        call_command('export_users', format='jsonl', stdout=stdout, stderr=StringIO())
+        rows = [json.loads(line) for line in stdout.getvalue().splitlines()]
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]['username'], 'existing')
+        self.assertNotIn('password', rows[0])
+        logger.info('test_export_jsonl passed')
+
+
+class FailingEmailBackend(BaseEmailBackend):
+    def send_messages(self, email_messages):
+        raise ConnectionError('SMTP server unavailable')
+
+
+class EmailOutboxTest(TestCase):
+    def setUp(self):
+        logger.info('Setting up EmailOutboxTest...')
+        self.user = User.objects.create_user(
+            username='testuser',
+            email='test@example.com',
+            password='password123',
+            date_of_birth='2000-01-01',
+            country='US'
+        )
+
+    def test_confirmation_is_queued_not_sent(self):
+        logger.info('Starting test_confirmation_is_queued_not_sent')
+        send_email_confirmation(self.user)
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(OutgoingEmail.objects.filter(to='test@example.com').count(), 1)
+        logger.info('test_confirmation_is_queued_not_sent passed')
+
+    def test_deliver_queued_emails(self):
+        logger.info('Starting test_deliver_queued_emails')
+        for i in range(3):
+            queue_email('Subject', 'Body', f'user{i}@example.com')
+        self.assertEqual(deliver_queued_emails(), 3)
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertFalse(OutgoingEmail.objects.filter(status=OutgoingEmail.STATUS_QUEUED).exists())
+        self.assertEqual(deliver_queued_emails(), 0)
+        logger.info('test_deliver_queued_emails passed')
+
+    @override_settings(EMAIL_BACKEND='clock.tests.FailingEmailBackend')
+    def test_failed_email_is_retried_with_backoff(self):
+        logger.info('Starting test_failed_email_is_retried_with_backoff')
+        outgoing = queue_email('Subject', 'Body', 'user@example.com')
+        self.assertEqual(deliver_queued_emails(), 0)
+        outgoing.refresh_from_db()
+        self.assertEqual(outgoing.status, OutgoingEmail.STATUS_QUEUED)
+        self.assertEqual(outgoing.attempts, 1)
+        self.assertGreater(outgoing.next_attempt_at, timezone.now())
+        self.assertIn('SMTP server unavailable', outgoing.last_error)
+        logger.info('test_failed_email_is_retried_with_backoff passed')
+
+    @override_settings(EMAIL_BACKEND='clock.tests.FailingEmailBackend')
+    def test_email_fails_after_max_attempts(self):
+        logger.info('Starting test_email_fails_after_max_attempts')
+        outgoing = queue_email('Subject', 'Body', 'user@example.com')
+        for _ in range(settings.EMAIL_OUTBOX['MAX_ATTEMPTS']):
+            OutgoingEmail.objects.filter(pk=outgoing.pk).update(next_attempt_at=timezone.now())
+            deliver_queued_emails()
+        outgoing.refresh_from_db()
+        self.assertEqual(outgoing.status, OutgoingEmail.STATUS_FAILED)
+        logger.info('test_email_fails_after_max_attempts passed')
+
+
+def make_test_image(size=(800, 600), color=(200, 30, 30), image_format='JPEG'):
+    from PIL import Image
+
+    buffer = BytesIO()
+    Image.new('RGB', size, color).save(buffer, image_format)
+    return buffer.getvalue()
+
+
+class AvatarPipelineTest(APITestCase):
+    def setUp(self):
+        logger.info('Setting up AvatarPipelineTest...')
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        pipeline = {**settings.AVATAR_PIPELINE, 'ASYNC': False, 'MAX_UPLOAD_SIZE': 512 * 1024}
+        overrides = override_settings(MEDIA_ROOT=media_root, AVATAR_PIPELINE=pipeline)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        self.media_root = media_root
+
+        self.user = User.objects.create_user(
+            username='testuser',
+            email='test@example.com',
+            password='password123',
+            date_of_birth='2000-01-01',
+            country='US'
+        )
+        self.client.force_authenticate(user=self.user)
+
+    def upload(self, content, name='avatar.jpg', content_type='image/jpeg'):
+        avatar = SimpleUploadedFile(name=name, content=content, content_type=content_type)
+        return self.client.post('/update-avatar/', {'avatar': avatar})
+
+    def test_renditions_are_generated(self):
+        logger.info('Starting test_renditions_are_generated')
+        from PIL import Image
+
+        response = self.upload(make_test_image())
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.user.refresh_from_db()
+        self.assertEqual(len(self.user.avatar_hash), 64)
+        for size in settings.AVATAR_PIPELINE['SIZES']:
+            for extension in ('webp', 'jpg'):
+                path = os.path.join(self.media_root, 'avatars', self.user.avatar_hash, f'{size}.{extension}')
+                with Image.open(path) as image:
+                    self.assertEqual(image.size, (size, size))
+                    self.assertNotIn('exif', image.info)
+        self.assertEqual(os.listdir(os.path.join(self.media_root, 'avatars', 'originals')), [])
+        logger.info('test_renditions_are_generated passed')
+
+    def test_identical_uploads_are_deduplicated(self):
+        logger.info('Starting test_identical_uploads_are_deduplicated')
+        content = make_test_image()
+        self.upload(content)
+        other = User.objects.create_user(
+            username='other',
+            email='other@example.com',
+            password='password123',
+            date_of_birth='2000-01-01',
+            country='US'
+        )
+        self.client.force_authenticate(user=other)
+        self.upload(content, name='copy.jpg')
+        self.user.refresh_from_db()
+        other.refresh_from_db()
+        self.assertEqual(self.user.avatar_hash, other.avatar_hash)
+        self.assertEqual(len(os.listdir(os.path.join(self.media_root, 'avatars'))), 2)
+        logger.info('test_identical_uploads_are_deduplicated passed')
+
+    def test_identical_uploads_are_staged_separately(self):
+        logger.info('Starting test_identical_uploads_are_staged_separately')
+        content = make_test_image()
+        first = stage_original(SimpleUploadedFile('avatar.jpg', content), 'digest')
+        second = stage_original(SimpleUploadedFile('avatar.jpg', content), 'digest')
+        self.assertNotEqual(first, second)
+        default_storage.delete(first)
+        self.assertTrue(default_storage.exists(second))
+        logger.info('test_identical_uploads_are_staged_separately passed')
+
+    def test_upload_over_size_cap_is_rejected(self):
+        logger.info('Starting test_upload_over_size_cap_is_rejected')
+        for size in (550 * 1024, 2 * 1024 * 1024):
+            response = self.upload(os.urandom(size))
+            self.assertEqual(response.status_code, status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+            self.assertEqual(response.data, {'avatar': 'The file exceeds the 512.0\xa0KB limit.'})
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.avatar_hash, '')
+        logger.info('test_upload_over_size_cap_is_rejected passed')
+
+    def test_non_image_upload_is_rejected(self):
+        logger.info('Starting test_non_image_upload_is_rejected')
+        response = self.upload(b'not an image', name='file.txt', content_type='text/plain')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        logger.info('test_non_image_upload_is_rejected passed')
+
+
+class MediaServingTest(TestCase):
+    def setUp(self):
+        logger.info('Setting up MediaServingTest...')
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        overrides = override_settings(MEDIA_ROOT=media_root)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+
+        self.digest = 'a' * 64
+        os.makedirs(os.path.join(media_root, 'avatars', self.digest))
+        self.content = bytes(range(256)) * 4
+        with open(os.path.join(media_root, 'avatars', self.digest, '64.webp'), 'wb') as file:
+            file.write(self.content)
+        with open(os.path.join(media_root, 'notes.txt'), 'wb') as file:
+            file.write(b'plain file')
+        self.url = f'/media/avatars/{self.digest}/64.webp'
+
+    def test_content_hash_file_is_immutable(self):
+        logger.info('Starting test_content_hash_file_is_immutable')
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertEqual(response['Content-Type'], 'image/webp')
+        self.assertIn('ETag', response)
+        logger.info('test_content_hash_file_is_immutable passed')
+
+    def test_other_files_must_revalidate(self):
+        logger.info('Starting test_other_files_must_revalidate')
+        response = self.client.get('/media/notes.txt')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn('no-cache', response['Cache-Control'])
+        logger.info('test_other_files_must_revalidate passed')
+
+    def test_if_none_match_returns_304(self):
+        logger.info('Starting test_if_none_match_returns_304')
+        etag = self.client.get(self.url)['ETag']
+        response = self.client.get(self.url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        logger.info('test_if_none_match_returns_304 passed')
+
+    def test_range_request(self):
+        logger.info('Starting test_range_request')
+        response = self.client.get(self.url, headers={'Range': 'bytes=10-19'})
+        self.assertEqual(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+        self.assertEqual(b''.join(response.streaming_content), self.content[10:20])
+        self.assertEqual(response['Content-Range'], f'bytes 10-19/{len(self.content)}')
+        self.assertEqual(response['Content-Length'], '10')
+
+        response = self.client.get(self.url, headers={'Range': 'bytes=-5'})
+        self.assertEqual(b''.join(response.streaming_content), self.content[-5:])
+        logger.info('test_range_request passed')
+
+    def test_unsatisfiable_range(self):
+        logger.info('Starting test_unsatisfiable_range')
+        response = self.client.get(self.url, headers={'Range': 'bytes=5000-'})
+        self.assertEqual(response.status_code, status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE)
+        logger.info('test_unsatisfiable_range passed')
+
+    def test_path_traversal_and_missing_files(self):
+        logger.info('Starting test_path_traversal_and_missing_files')
+        self.assertEqual(self.client.get('/media/../manage.py').status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(self.client.get('/media/missing.txt').status_code, status.HTTP_404_NOT_FOUND)
+        logger.info('test_path_traversal_and_missing_files passed')
+
+
+class OptimisticConcurrencyTest(APITestCase):
+    def setUp(self):
+        logger.info('Setting up OptimisticConcurrencyTest...')
+        self.admin_user = User.objects.create_superuser(
+            username='admin', email='admin@example.com', password='adminpass', date_of_birth='1980-01-01', country='US')
+        self.user = User.objects.create_user(
+            username='user1', email='user1@example.com', password='password', date_of_birth='2000-01-01', country='CA')
+        self.data = {'username': 'user1', 'email': 'user1@example.com', 'date_of_birth': '2000-01-01', 'country': 'CA'}
+
+    def test_update_saves_only_changed_fields(self):
+        logger.info('Starting test_update_saves_only_changed_fields')
+        self.user.refresh_from_db()
+        self.client.force_authenticate(user=self.user)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.put(reverse('user-update', args=[self.user.id]),
+                                       {**self.data, 'country': 'BY'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['version'], 1)
+        updates = [query['sql'] for query in queries.captured_queries if query['sql'].startswith('UPDATE "user"')]
+        self.assertEqual(len(updates), 1)
+        self.assertIn('"country"', updates[0])
+        self.assertNotIn('"email"', updates[0])
+        self.assertIn('"version" = 0', updates[0].split('WHERE')[1])
+        logger.info('test_update_saves_only_changed_fields passed')
+
+    def test_stale_version_returns_conflict(self):
+        logger.info('Starting test_stale_version_returns_conflict')
+        self.client.force_authenticate(user=self.admin_user)
+        url = reverse('user-detail', args=[self.user.id])
+        response = self.client.patch(url, {'country': 'AF', 'version': 0}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        self.client.force_authenticate(user=self.user)
+        response = self.client.put(reverse('user-update', args=[self.user.id]),
+                                   {**self.data, 'first_name': 'Late', 'version': 0}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.country, 'AF')
+        self.assertEqual(self.user.first_name, '')
+        logger.info('test_stale_version_returns_conflict passed')
+
+    def test_concurrent_save_of_stale_instance_is_rejected(self):
+        logger.info('Starting test_concurrent_save_of_stale_instance_is_rejected')
+        first = User.objects.get(pk=self.user.pk)
+        second = User.objects.get(pk=self.user.pk)
+        first.first_name = 'First'
+        first.save(update_fields=['first_name'])
+        second.last_name = 'Second'
+        with self.assertRaises(ConcurrentUpdateError):
+            second.save(update_fields=['last_name'])
+        self.user.refresh_from_db()
+        self.assertEqual((self.user.first_name, self.user.last_name, self.user.version), ('First', '', 1))
+        logger.info('test_concurrent_save_of_stale_instance_is_rejected passed')
+
+    def test_server_side_saves_leave_the_version_alone(self):
+        logger.info('Starting test_server_side_saves_leave_the_version_alone')
+        update_last_login(None, self.user)
+        self.user.avatar_hash = 'f' * 64
+        self.user.save(update_fields=['avatar', 'avatar_hash'])
+        self.user.email_confirmed = True
+        self.user.save(update_fields=['email_confirmed'])
+        self.assertEqual(User.objects.get(pk=self.user.pk).version, 0)
+
+        # A client that read version 0 before those saves can still update.
+        self.client.force_authenticate(user=self.user)
+        response = self.client.put(reverse('user-update', args=[self.user.id]),
+                                   {**self.data, 'first_name': 'Edited', 'version': 0}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['version'], 1)
+        logger.info('test_server_side_saves_leave_the_version_alone passed')
+
+    def test_versioned_fields_are_the_serializer_fields(self):
+        logger.info('Starting test_versioned_fields_are_the_serializer_fields')
+        self.assertEqual(User.VERSIONED_FIELDS, set(UserSerializer.Meta.fields) - {'id', 'version'})
+        logger.info('test_versioned_fields_are_the_serializer_fields passed')
+
+    def test_unchanged_update_does_not_write(self):
+        logger.info('Starting test_unchanged_update_does_not_write')
+        self.user.refresh_from_db()
+        self.client.force_authenticate(user=self.user)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.put(reverse('user-update', args=[self.user.id]), self.data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertFalse(any(query['sql'].startswith('UPDATE') for query in queries.captured_queries))
+        logger.info('test_unchanged_update_does_not_write passed')
+
+
+class UserStatisticsTest(APITestCase):
+    def setUp(self):
+        logger.info('Setting up UserStatisticsTest...')
+        self.admin_user = User.objects.create_superuser(
+            username='admin', email='admin@example.com', password='adminpass', date_of_birth='1980-01-01', country='US')
+        self.young = User.objects.create_user(
+            username='young', email='young@example.com', password='password', date_of_birth=f'{date.today().year - 20}-01-01',
+            country='BY')
+        self.old = User.objects.create_user(
+            username='old', email='old@example.com', password='password', date_of_birth=f'{date.today().year - 70}-01-01',
+            country='BY', is_premium=True)
+        self.url = reverse('user-stats')
+
+    def get_stats(self):
+        self.client.force_authenticate(user=self.admin_user)
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data
+
+    def test_statistics_track_creates_updates_and_deletes(self):
+        logger.info('Starting test_statistics_track_creates_updates_and_deletes')
+        data = self.get_stats()
+        self.assertEqual(data['total_users'], 3)
+        self.assertEqual(data['users_per_country'], {'BY': 2, 'US': 1})
+        self.assertAlmostEqual(data['premium_ratio'], 2 / 3)
+        self.assertEqual(data['age_buckets']['18-24'], 1)
+        self.assertEqual(data['age_buckets']['65+'], 1)
+
+        user = User.objects.get(pk=self.young.pk)
+        user.country = 'US'
+        user.email_confirmed = True
+        user.save()
+        User.objects.filter(pk=self.old.pk).delete()
+
+        data = self.get_stats()
+        self.assertEqual(data['total_users'], 2)
+        self.assertEqual(data['users_per_country'], {'US': 2})
+        self.assertAlmostEqual(data['email_confirmed_ratio'], 0.5)
+        self.assertEqual(data['age_buckets']['65+'], 0)
+        logger.info('test_statistics_track_creates_updates_and_deletes passed')
+
+    def test_statistics_use_constant_queries(self):
+        logger.info('Starting test_statistics_use_constant_queries')
+        self.client.force_authenticate(user=self.admin_user)
+        User.objects.bulk_create([
+            User(username=f'bulk_{i}', email=f'bulk_{i}@example.com', date_of_birth='1990-01-01', country='US')
+            for i in range(100)
+        ])
+        with self.assertNumQueries(2):
+            self.client.get(self.url)
+        logger.info('test_statistics_use_constant_queries passed')
+
+    def test_ages_count_from_the_birthday(self):
+        logger.info('Starting test_ages_count_from_the_birthday')
+        today = date(2026, 6, 15)
+        before = stats.summary(today=today)['age_buckets']
+        for name, date_of_birth in (('turned_18', '2008-06-15'), ('still_17', '2008-06-16'), ('turned_65', '1961-06-01'),
+                                    ('still_64', '1961-12-31')):
+            User.objects.create_user(username=name, email=f'{name}@example.com', password='password',
+                                     date_of_birth=date_of_birth, country='US')
+        after = stats.summary(today=today)['age_buckets']
+        self.assertEqual({label: after[label] - before[label] for label in after},
+                         {'under 18': 1, '18-24': 1, '25-34': 0, '35-44': 0, '45-54': 0, '55-64': 1, '65+': 1})
+        logger.info('test_ages_count_from_the_birthday passed')
+
+    def test_rebuild_matches_incremental_counters(self):
+        logger.info('Starting test_rebuild_matches_incremental_counters')
+        incremental = self.get_stats()
+        call_command('rebuild_user_stats', stdout=StringIO())
+        self.assertEqual(self.get_stats(), incremental)
+        logger.info('test_rebuild_matches_incremental_counters passed')
+
+    def test_statistics_require_admin(self):
+        logger.info('Starting test_statistics_require_admin')
+        self.client.force_authenticate(user=self.young)
+        self.assertEqual(self.client.get(self.url).status_code, status.HTTP_403_FORBIDDEN)
+        logger.info('test_statistics_require_admin passed')
+
+
+class CaseInsensitiveIdentityTest(APITestCase):
+    def setUp(self):
+        logger.info("Setting up CaseInsensitiveIdentityTest...")
+        self.user = User.objects.create_user(
+            username='MixedCase',
+            email='Mixed@Example.com',
+            password='password123',
+            date_of_birth='2000-01-01',
+            country='US'
+        )
+
+    def test_lookups_ignore_case(self):
+        logger.info("Starting test_lookups_ignore_case")
+        self.assertEqual(User.objects.by_username('mixedcase').get(), self.user)
+        self.assertEqual(User.objects.by_email('MIXED@example.COM').get(), self.user)
+        self.assertEqual(list(User.objects.by_usernames(['MIXEDCASE', 'nobody'])), [self.user])
+        self.assertEqual(User.objects.get_by_natural_key('mixedCASE'), self.user)
+        logger.info("test_lookups_ignore_case passed")
+
+    def test_login_ignores_username_case(self):
+        logger.info("Starting test_login_ignores_username_case")
+        response = self.client.post(reverse('login'), {'username': 'mixedcase', 'password': 'password123'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        logger.info("test_login_ignores_username_case passed")
+
+    def test_constraint_rejects_case_variants(self):
+        logger.info("Starting test_constraint_rejects_case_variants")
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            User.objects.create_user(username='mixedcase', email='other@example.com', password='x',
+                                     date_of_birth='2000-01-01', country='US')
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            User.objects.create_user(username='other', email='mixed@example.com', password='x',
+                                     date_of_birth='2000-01-01', country='US')
+        logger.info("test_constraint_rejects_case_variants passed")
+
+    def test_only_identity_violations_become_field_errors(self):
+        logger.info("Starting test_only_identity_violations_become_field_errors")
+        for username, email, field in [('mixedcase', 'other@example.com', 'username'),
+                                       ('other', 'MIXED@example.com', 'email')]:
+            with self.assertRaises(IntegrityError) as caught, transaction.atomic():
+                User.objects.create_user(username=username, email=email, password='x',
+                                         date_of_birth='2000-01-01', country='US')
+            self.assertEqual(list(unique_violation(caught.exception).detail), [field])
+        error = IntegrityError('NOT NULL constraint failed: user.email_username')
+        with self.assertRaises(IntegrityError) as caught:
+            unique_violation(error)
+        self.assertIs(caught.exception, error)
+        logger.info("test_only_identity_violations_become_field_errors passed")
+
+    def test_register_case_variant_is_rejected_in_one_round_trip(self):
+        logger.info("Starting test_register_case_variant_is_rejected_in_one_round_trip")
+        data = {'first_name': 'A', 'last_name': 'B', 'username': 'MIXEDCASE', 'email': 'new@example.com',
+                'password': 'password123', 'date_of_birth': '2000-01-01', 'country': 'US'}
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(reverse('register'), data)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('username', response.data)
+        self.assertFalse(any('SELECT' in query['sql'] and '"user"' in query['sql'] for query in queries))
+        self.assertEqual(User.objects.count(), 1)
+        logger.info("test_register_case_variant_is_rejected_in_one_round_trip passed")
+
+    def test_admin_search_by_username_and_email(self):
+        logger.info("Starting test_admin_search_by_username_and_email")
+        admin = User.objects.create_superuser(username='admin', email='admin@example.com', password='x',
+                                              date_of_birth='2000-01-01', country='US')
+        self.client.force_authenticate(user=admin)
+        response = self.client.get('/api/users/', {'username': 'MIXEDCASE'})
+        self.assertEqual([row['id'] for row in response.data], [self.user.id])
+        response = self.client.get('/api/users/', {'email': 'mixed@EXAMPLE.com'})
+        self.assertEqual([row['id'] for row in response.data], [self.user.id])
+        logger.info("test_admin_search_by_username_and_email passed")
+
+
+class ResponseCacheTest(APITestCase):
+    def setUp(self):
+        logger.info("Setting up ResponseCacheTest...")
+        get_response_cache().clear()
+        cache_stats.reset()
+        self.user = User.objects.create_user(username='poller', email='poller@example.com', password='x',
+                                             date_of_birth='2000-01-01', country='US')
+        self.friend = User.objects.create_user(username='friend', email='friend@example.com', password='x',
+                                               date_of_birth='2000-01-01', country='BY')
+        self.activity = Activity.objects.create(user=self.user, name='Reading')
+        self.client.force_authenticate(user=self.user)
+
+    def test_repeated_poll_is_served_from_cache(self):
+        logger.info("Starting test_repeated_poll_is_served_from_cache")
+        first = self.client.get(reverse('all-activities'))
+        self.assertEqual(first['X-Cache'], 'MISS')
+        with CaptureQueriesContext(connection) as queries:
+            second = self.client.get(reverse('all-activities'))
+        self.assertEqual(second['X-Cache'], 'HIT')
+        self.assertEqual(second.data, first.data)
+        self.assertEqual(len(queries), 0)
+        self.assertEqual(cache_stats.snapshot()['activities'], {'hits': 1, 'misses': 1})
+        logger.info("test_repeated_poll_is_served_from_cache passed")
+
+    def test_keys_are_per_user(self):
+        logger.info("Starting test_keys_are_per_user")
+        self.client.get(reverse('user-read'))
+        self.client.force_authenticate(user=self.friend)
+        response = self.client.get(reverse('user-read'))
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertEqual(response.data['username'], 'friend')
+        logger.info("test_keys_are_per_user passed")
+
+    def test_activity_change_invalidates_only_the_owner(self):
+        logger.info("Starting test_activity_change_invalidates_only_the_owner")
+        self.client.get(reverse('all-activities'))
+        self.client.get(reverse('user-read'))
+        self.client.post(reverse('add-time'), {'name': 'Reading', 'time': 25})
+
+        response = self.client.get(reverse('all-activities'))
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertEqual(response.data[0]['minutes_spent_today'], 25)
+        self.assertEqual(self.client.get(reverse('user-read'))['X-Cache'], 'HIT')
+        logger.info("test_activity_change_invalidates_only_the_owner passed")
+
+    def test_user_change_invalidates_profile_and_activities(self):
+        logger.info("Starting test_user_change_invalidates_profile_and_activities")
+        self.client.get(reverse('all-activities'))
+        self.client.get(reverse('user-read'))
+        user = User.objects.get(pk=self.user.pk)
+        user.username = 'renamed'
+        user.save(update_fields=['username'])
+        self.client.force_authenticate(user=user)
+
+        self.assertEqual(self.client.get(reverse('user-read')).data['username'], 'renamed')
+        self.assertEqual(self.client.get(reverse('all-activities')).data[0]['username'], 'renamed')
+        logger.info("test_user_change_invalidates_profile_and_activities passed")
+
+    def test_new_message_invalidates_both_sides_of_the_conversation(self):
+        logger.info("Starting test_new_message_invalidates_both_sides_of_the_conversation")
+        url = reverse('message-history', args=[self.friend.pk])
+        self.assertEqual(self.client.get(url).data, [])
+        self.client.force_authenticate(user=self.friend)
+        self.client.get(reverse('message-history', args=[self.user.pk]))
+
+        PrivateMessage.objects.create(sender=self.friend, receiver=self.user, content='Hi')
+        self.assertEqual(len(self.client.get(reverse('message-history', args=[self.user.pk])).data), 1)
+        self.client.force_authenticate(user=self.user)
+        self.assertEqual(len(self.client.get(url).data), 1)
+        logger.info("test_new_message_invalidates_both_sides_of_the_conversation passed")
+
+    def test_admin_can_read_counters(self):
+        logger.info("Starting test_admin_can_read_counters")
+        self.client.get(reverse('user-read'))
+        admin = User.objects.create_superuser(username='admin', email='admin@example.com', password='x',
+                                              date_of_birth='2000-01-01', country='US')
+        self.client.force_authenticate(user=admin)
+        response = self.client.get(reverse('cache-stats'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['user-read'], {'hits': 0, 'misses': 1})
+        logger.info("test_admin_can_read_counters passed")
+
+
+class PrecomputedSchemaTest(TestCase):
+    def setUp(self):
+        logger.info("Setting up PrecomputedSchemaTest...")
+        reset_schema_cache()
+        self.addCleanup(reset_schema_cache)
+
+    def test_schema_is_generated_once_and_revalidated_by_etag(self):
+        logger.info("Starting test_schema_is_generated_once_and_revalidated_by_etag")
+        with mock.patch('clock.schema.render_schema', wraps=render_schema) as render:
+            first = self.client.get('/swagger.json')
+            second = self.client.get('/swagger.yaml')
+            not_modified = self.client.get('/swagger.json', HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(render.call_count, 1)
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(json.loads(first.content)['info']['title'], 'Clock API')
+        self.assertEqual(second['Content-Type'], 'application/yaml')
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertEqual(not_modified['ETag'], first['ETag'])
+        logger.info("test_schema_is_generated_once_and_revalidated_by_etag passed")
+
+    def test_compressed_when_accepted(self):
+        logger.info("Starting test_compressed_when_accepted")
+        plain = self.client.get('/swagger.json')
+        compressed = self.client.get('/swagger.json', HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(compressed['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(compressed.content), plain.content)
+        self.assertIn('Accept-Encoding', compressed['Vary'])
+        logger.info("test_compressed_when_accepted passed")
+
+    def test_pre_rendered_files_are_served_without_generation(self):
+        logger.info("Starting test_pre_rendered_files_are_served_without_generation")
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        with override_settings(API_SCHEMA={**settings.API_SCHEMA, 'DIR': directory}):
+            call_command('generate_api_schema', stdout=StringIO())
+            reset_schema_cache()
+            with mock.patch('clock.schema.render_schema') as render:
+                response = self.client.get('/swagger.json')
+        render.assert_not_called()
+        with open(os.path.join(directory, 'openapi.json'), 'rb') as file:
+            self.assertEqual(response.content, file.read())
+        logger.info("test_pre_rendered_files_are_served_without_generation passed")
+
+    def test_ui_points_at_the_precomputed_document(self):
+        logger.info("Starting test_ui_points_at_the_precomputed_document")
+        response = self.client.get('/swagger/')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'/swagger.json', response.content)
+        logger.info("test_ui_points_at_the_precomputed_document passed")
+
+    def test_api_only_workers_do_not_import_drf_yasg(self):
+        logger.info("Starting test_api_only_workers_do_not_import_drf_yasg")
+        code = ('import os, sys, django; os.environ.setdefault("DJANGO_SETTINGS_MODULE", "study_clock.settings"); '
+                'django.setup(); import study_clock.urls; '
+                'print(any(name.startswith("drf_yasg") for name in sys.modules))')
+        result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True,
+                                env={**os.environ, 'API_DOCS': '0'}, cwd=settings.BASE_DIR)
+        self.assertEqual(result.stdout.strip(), 'False', result.stderr)
+        logger.info("test_api_only_workers_do_not_import_drf_yasg passed")
+
+
+class StructuredLoggingTest(TestCase):
+    def make_record(self, name='clock.views', level=logging.DEBUG, message='Step %d', args=(1,), **extra):
+        record = logging.LogRecord(name, level, __file__, 1, message, args, None)
+        record.__dict__.update(extra)
+        return record
+
+    def test_json_formatter_includes_extra_fields_and_exceptions(self):
+        logger.info("Starting test_json_formatter_includes_extra_fields_and_exceptions")
+        try:
+            raise ValueError('broken')
+        except ValueError:
+            record = logging.LogRecord('clock.views', logging.ERROR, __file__, 1, 'Failed for %s', ('bob',),
+                                       sys.exc_info())
+        record.user_id = 7
+        entry = json.loads(JsonFormatter().format(record))
+        self.assertEqual(entry['message'], 'Failed for bob')
+        self.assertEqual(entry['level'], 'ERROR')
+        self.assertEqual(entry['user_id'], 7)
+        self.assertIn('ValueError: broken', entry['exception'])
+        logger.info("test_json_formatter_includes_extra_fields_and_exceptions passed")
+
+    def test_sampling_keeps_one_in_n_debug_records(self):
+        logger.info("Starting test_sampling_keeps_one_in_n_debug_records")
+        sampling = SamplingFilter({'clock': 5})
+        kept = [sampling.filter(self.make_record()) for _ in range(20)]
+        self.assertEqual(kept.count(True), 4)
+        self.assertTrue(all(sampling.filter(self.make_record(level=logging.INFO)) for _ in range(5)))
+        self.assertTrue(all(sampling.filter(self.make_record(name='django.request')) for _ in range(5)))
+        logger.info("test_sampling_keeps_one_in_n_debug_records passed")
+
+    def test_queue_handler_writes_through_the_listener(self):
+        logger.info("Starting test_queue_handler_writes_through_the_listener")
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'test.log')
+        handler = QueueListenerHandler({'class': 'logging.FileHandler', 'filename': path, 'formatter': 'json'})
+        handler.handle(self.make_record(level=logging.INFO))
+        handler.close()
+        with open(path) as file:
+            self.assertEqual(json.loads(file.read())['message'], 'Step 1')
+        logger.info("test_queue_handler_writes_through_the_listener passed")
+
+    def test_full_queue_drops_instead_of_blocking(self):
+        logger.info("Starting test_full_queue_drops_instead_of_blocking")
+        handler = QueueListenerHandler({'class': 'logging.NullHandler'}, queue_size=1)
+        handler.listener.stop()
+        for _ in range(3):
+            handler.handle(self.make_record(level=logging.INFO))
+        self.assertEqual(handler.dropped, 2)
+        handler.listener = None
+        handler.close()
+        logger.info("test_full_queue_drops_instead_of_blocking passed")
+
+
+class RequestMetricsTest(APITestCase):
+    def setUp(self):
+        logger.info("Setting up RequestMetricsTest...")
+        metrics_registry.reset()
+        self.user = User.objects.create_user(username='timed', email='timed@example.com', password='password123',
+                                             date_of_birth='2000-01-01', country='US')
+        self.admin = User.objects.create_superuser(username='admin', email='admin@example.com', password='x',
+                                                   date_of_birth='2000-01-01', country='US')
+
+    def test_server_timing_reports_queries(self):
+        logger.info("Starting test_server_timing_reports_queries")
+        self.client.force_authenticate(user=self.user)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('all-activities'))
+        self.assertRegex(response['Server-Timing'], r'^app;dur=[\d.]+, db;dur=[\d.]+;desc="(\d+) queries", '
+                                                    r'total;dur=[\d.]+$')
+        self.assertIn(f'desc="{len(queries)} queries"', response['Server-Timing'])
+        logger.info("test_server_timing_reports_queries passed")
+
+    def test_metrics_are_aggregated_per_url_name(self):
+        logger.info("Starting test_metrics_are_aggregated_per_url_name")
+        self.client.force_authenticate(user=self.user)
+        for _ in range(3):
+            self.client.get(reverse('user-read'))
+        self.client.get('/no-such-page/')
+
+        self.client.force_authenticate(user=self.admin)
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+        body = response.content.decode()
+        self.assertIn('clock_requests_total{endpoint="user-read",method="GET",status="200"} 3', body)
+        self.assertIn('clock_request_duration_seconds_bucket{endpoint="user-read",method="GET",le="+Inf"} 3', body)
+        self.assertIn('clock_request_duration_seconds_count{endpoint="user-read",method="GET"} 3', body)
+        self.assertIn('clock_requests_total{endpoint="unmatched",method="GET",status="404"} 1', body)
+        self.assertRegex(body, r'clock_request_db_queries_total\{endpoint="user-read",method="GET"\} \d+')
+        logger.info("test_metrics_are_aggregated_per_url_name passed")
+
+    def test_async_views_are_measured(self):
+        logger.info("Starting test_async_views_are_measured")
+        self.client.post(reverse('login-async'), {'username': 'timed', 'password': 'password123'}, format='json')
+        snapshot = metrics_registry.render()
+        self.assertIn('clock_requests_total{endpoint="login-async",method="POST",status="200"} 1', snapshot)
+        self.assertNotIn('clock_request_db_queries_total{endpoint="login-async",method="POST"} 0', snapshot)
+        logger.info("test_async_views_are_measured passed")
+
+    def test_metrics_add_up_every_workers_file(self):
+        logger.info("Starting test_metrics_add_up_every_workers_file")
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        with override_settings(REQUEST_METRICS={**settings.REQUEST_METRICS, 'DIRECTORY': directory.name}):
+            other_worker = MetricsRegistry(worker_id='other')
+            for _ in range(2):
+                other_worker.record('user-read', 'GET', 200, 0.01, RequestStats())
+            other_worker.flush()
+            self.client.force_authenticate(user=self.user)
+            self.client.get(reverse('user-read'))
+
+            self.client.force_authenticate(user=self.admin)
+            body = self.client.get(reverse('metrics')).content.decode()
+        self.assertIn('clock_requests_total{endpoint="user-read",method="GET",status="200"} 3', body)
+        self.assertIn('clock_request_duration_seconds_count{endpoint="user-read",method="GET"} 3', body)
+        self.assertEqual(sorted(os.listdir(directory.name)), sorted(['other.json', f'{os.getpid()}.json']))
+        logger.info("test_metrics_add_up_every_workers_file passed")
+
+    def test_metrics_require_admin(self):
+        logger.info("Starting test_metrics_require_admin")
+        self.client.force_authenticate(user=self.user)
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, status.HTTP_403_FORBIDDEN)
+        logger.info("test_metrics_require_admin passed")
+
+
+def url_names(patterns, namespace=None):
+    for pattern in patterns:
+        if hasattr(pattern, 'url_patterns'):
+            if pattern.namespace != 'admin':
+                yield from url_names(pattern.url_patterns, pattern.namespace or namespace)
+        elif pattern.name:
+            yield f'{namespace}:{pattern.name}' if namespace else pattern.name
+
+
+@override_settings(DATABASE_ROUTING={**settings.DATABASE_ROUTING, 'REPLICAS': []})
+class QueryBudgetTest(APITestCase):
+    # Every route is called against a realistically sized database and must
+    # run exactly its budgeted number of queries, so an N+1 (or any other new
+    # query) fails here. Reads stay on the primary whatever replicas are
+    # configured, so every query is counted on one connection. Activities are seeded for every user; messages only
+    # for the conversations the tests read, since the budgets do not depend
+    # on how many other conversations exist.
+    USERS = 10_000
+    ACTIVITIES_PER_USER = 20
+    MESSAGES_PER_CONVERSATION = 200
+
+    # Authenticated calls include the query that loads the token's user.
+    BUDGETS = {
+        'redirect': 0,
+        'index': 0,
+        'token_obtain_pair': 1,
+        'token_refresh': 0,
+        'register': 9,
+        'protected_view': 1,
+        'login': 1,
+        'login-async': 1,
+        'logout': 4,
+        'api-root': 0,
+        'user-list': 2,
+        'user-detail': 2,
+        'user-update': 4,
+        'user-read': 1,
+        'user-read-async': 1,
+        'user-stats': 3,
+        'cache-stats': 1,
+        'metrics': 1,
+        'verify-email': 6,
+        'update-email': 5,
+        'update-avatar': 1,
+        'message-history': 2,
+        'message-history-async': 2,
+        'send-message': 3,
+        'update-activity': 3,
+        'create-activity': 7,
+        'delete-activity': 4,
+        'all-activities': 2,
+        'all-activities-async': 2,
+        'add-time': 8,
+        'add-time-async': 8,
+        'study-heatmap': 2,
+        'achievements': 3,
+        'pomodoro-start': 5,
+        'pomodoro-cancel': 2,
+        'schema-json': 0,
+        'schema-swagger-ui': 0,
+        'schema-redoc': 0,
+        'media': 0,
+    }
+    CONSUMER_BUDGETS = {
+        'chat-message': 1,
+        'support-message': 0,
+    }
+
+    @classmethod
+    def setUpTestData(cls):
+        password = make_password('password123')
+        User.objects.bulk_create([
+            User(username=f'budget_{i}', email=f'budget_{i}@example.com', password=password,
+                 date_of_birth=date(1990 + i % 20, 1 + i % 12, 1 + i % 28), country=('US', 'BY', 'DE', 'PL')[i % 4],
+                 email_confirmed=i % 2 == 1, is_premium=i % 5 == 0)
+            for i in range(cls.USERS)
+        ], batch_size=2000)
+        users = list(User.objects.order_by('pk').values_list('pk', flat=True))
+        Activity.objects.bulk_create([
+            Activity(user_id=user_id, name=f'Activity {n}', minutes_spent_today=n, minutes_spent_in_total=n * 10)
+            for user_id in users for n in range(cls.ACTIVITIES_PER_USER)
+        ], batch_size=5000)
+
+        cls.user = User.objects.get(pk=users[0])
+        cls.peer = User.objects.get(pk=users[1])
+        cls.admin = User.objects.create_superuser(username='budget_admin', email='budget_admin@example.com',
+                                                  password='x', date_of_birth='1990-01-01', country='US')
+        PrivateMessage.objects.bulk_create([
+            PrivateMessage(sender=(cls.user, cls.peer)[n % 2], receiver=(cls.peer, cls.user)[n % 2],
+                           content=f'Message {n}')
+            for n in range(cls.MESSAGES_PER_CONVERSATION)
+        ])
+        stats.rebuild()
+        # As after `manage.py backfill_achievements`.
+        achievements.save(*achievements.replay([cls.user.pk]))
+
+    def setUp(self):
+        logger.info("Setting up QueryBudgetTest...")
+        get_response_cache().clear()
+        revoked_tokens.rebuild()
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        media_settings = override_settings(MEDIA_ROOT=self.media_root)
+        media_settings.enable()
+        self.addCleanup(media_settings.disable)
+
+    def authenticate(self, user):
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {RefreshToken.for_user(user).access_token}')
+
+    def assert_budget(self, name, call, expected_status):
+        with self.assertNumQueries(self.BUDGETS[name]):
+            response = call()
+        self.assertEqual(response.status_code, expected_status, getattr(response, 'data', response))
+        return response
+
+    def test_every_route_has_a_budget(self):
+        logger.info("Starting test_every_route_has_a_budget")
+        self.assertEqual(set(url_names(get_resolver().url_patterns)), set(self.BUDGETS))
+        logger.info("test_every_route_has_a_budget passed")
+
+    def test_public_routes(self):
+        logger.info("Starting test_public_routes")
+        self.assert_budget('redirect', lambda: self.client.get(reverse('redirect')), 302)
+        self.assert_budget('index', lambda: self.client.get(reverse('index')), 200)
+        self.assert_budget('api-root', lambda: self.client.get(reverse('api-root')), 200)
+        self.assert_budget('schema-json', lambda: self.client.get('/swagger.json'), 200)
+        self.assert_budget('schema-swagger-ui', lambda: self.client.get(reverse('schema-swagger-ui')), 200)
+        self.assert_budget('schema-redoc', lambda: self.client.get(reverse('schema-redoc')), 200)
+        default_storage.save('budget.txt', ContentFile(b'budget'))
+        self.assert_budget('media', lambda: self.client.get('/media/budget.txt'), 200)
+        self.assert_budget('verify-email', lambda: self.client.get(
+            reverse('verify-email'), {'token': make_email_verification_token(self.user)}), 200)
+        logger.info("test_public_routes passed")
+
+    def test_authentication_routes(self):
+        logger.info("Starting test_authentication_routes")
+        credentials = {'username': self.user.username, 'password': 'password123'}
+        tokens = self.assert_budget('token_obtain_pair', lambda: self.client.post(
+            reverse('token_obtain_pair'), credentials), 200).data
+        self.assert_budget('token_refresh', lambda: self.client.post(
+            reverse('token_refresh'), {'refresh': tokens['refresh']}), 200)
+        self.assert_budget('login', lambda: self.client.post(reverse('login'), credentials), 200)
+        self.assert_budget('login-async', lambda: self.client.post(reverse('login-async'), credentials,
+                                                                   format='json'), 200)
+        self.assert_budget('logout', lambda: self.client.post(reverse('logout'), {'refresh': tokens['refresh']}), 200)
+        self.assert_budget('register', lambda: self.client.post(reverse('register'), {
+            'first_name': 'New', 'last_name': 'User', 'username': 'budget_new', 'email': 'budget_new@example.com',
+            'password': 'password123', 'date_of_birth': '1995-05-05', 'country': 'US'}), 201)
+        logger.info("test_authentication_routes passed")
+
+    def test_user_routes(self):
+        logger.info("Starting test_user_routes")
+        self.authenticate(self.user)
+        self.assert_budget('protected_view', lambda: self.client.get(reverse('protected_view')), 200)
+        self.assert_budget('user-read', lambda: self.client.get(reverse('user-read')), 200)
+        get_response_cache().clear()
+        self.assert_budget('user-read-async', lambda: self.client.get(reverse('user-read-async')), 200)
+        profile = self.client.get(reverse('user-read')).data
+        self.assert_budget('user-update', lambda: self.client.put(
+            reverse('user-update', args=[self.user.pk]), {**profile, 'first_name': 'Budget'}), 200)
+        self.assert_budget('update-email', lambda: self.client.post(
+            reverse('update-email'), {'email': 'budget_changed@example.com'}), 200)
+        avatar = SimpleUploadedFile('avatar.jpg', make_test_image(), content_type='image/jpeg')
+        self.assert_budget('update-avatar', lambda: self.client.post(reverse('update-avatar'), {'avatar': avatar}), 200)
+        logger.info("test_user_routes passed")
+
+    def test_admin_routes(self):
+        logger.info("Starting test_admin_routes")
+        self.authenticate(self.admin)
+        self.assert_budget('user-list', lambda: self.client.get(reverse('user-list'), {'country': 'PL'}), 200)
+        self.assert_budget('user-detail', lambda: self.client.get(reverse('user-detail', args=[self.user.pk])), 200)
+        self.assert_budget('user-stats', lambda: self.client.get(reverse('user-stats')), 200)
+        self.assert_budget('cache-stats', lambda: self.client.get(reverse('cache-stats')), 200)
+        self.assert_budget('metrics', lambda: self.client.get(reverse('metrics')), 200)
+        logger.info("test_admin_routes passed")
+
+    def test_activity_routes(self):
+        logger.info("Starting test_activity_routes")
+        self.authenticate(self.user)
+        response = self.assert_budget('all-activities', lambda: self.client.get(reverse('all-activities')), 200)
+        self.assertEqual(len(response.data), self.ACTIVITIES_PER_USER)
+        get_response_cache().clear()
+        response = self.assert_budget('all-activities-async', lambda: self.client.get(
+            reverse('all-activities-async')), 200)
+        self.assertEqual(len(response.data), self.ACTIVITIES_PER_USER)
+        self.assert_budget('create-activity', lambda: self.client.post(reverse('create-activity'),
+                                                                       {'name': 'Budgeting'}), 200)
+        self.assert_budget('add-time', lambda: self.client.post(reverse('add-time'),
+                                                                {'name': 'Budgeting', 'time': 30}), 200)
+        self.assert_budget('add-time-async', lambda: self.client.post(reverse('add-time-async'),
+                                                                      {'name': 'Budgeting', 'time': 30},
+                                                                      format='json'), 200)
+        response = self.assert_budget('study-heatmap', lambda: self.client.get(reverse('study-heatmap')), 200)
+        self.assertEqual(response.data['total_minutes'], 60)
+        response = self.assert_budget('achievements', lambda: self.client.get(reverse('achievements')), 200)
+        self.assertEqual(response.data['activities_created'], self.ACTIVITIES_PER_USER + 1)
+        self.assert_budget('update-activity', lambda: self.client.patch(
+            reverse('update-activity'), {'old_name': 'Budgeting', 'new_name': 'Planning'}), 200)
+        self.assert_budget('delete-activity', lambda: self.client.delete(reverse('delete-activity'),
+                                                                         {'name': 'Planning'}), 200)
+        logger.info("test_activity_routes passed")
+
+    def test_pomodoro_routes(self):
+        logger.info("Starting test_pomodoro_routes")
+        self.authenticate(self.user)
+        self.assert_budget('pomodoro-start', lambda: self.client.post(reverse('pomodoro-start')), 200)
+        response = self.assert_budget('pomodoro-cancel', lambda: self.client.post(reverse('pomodoro-cancel')), 200)
+        self.assertEqual(response.data['cancelled'], 2)
+        logger.info("test_pomodoro_routes passed")
+
+    def test_message_routes(self):
+        logger.info("Starting test_message_routes")
+        self.authenticate(self.user)
+        response = self.assert_budget('message-history', lambda: self.client.get(
+            reverse('message-history', args=[self.peer.pk])), 200)
+        self.assertEqual(len(response.data), self.MESSAGES_PER_CONVERSATION)
+        get_response_cache().clear()
+        response = self.assert_budget('message-history-async', lambda: self.client.get(
+            reverse('message-history-async', args=[self.peer.pk])), 200)
+        self.assertEqual(len(response.data), self.MESSAGES_PER_CONVERSATION)
+        self.assert_budget('send-message', lambda: self.client.post(
+            reverse('send-message'), {'receiver': self.peer.pk, 'content': 'Hi'}), 201)
+        logger.info("test_message_routes passed")
+
+    def test_consumers(self):
+        # Each budget covers a whole session: connect, one message and its
+        # echo, disconnect. database_sync_to_async runs the consumer's
+        # queries on this thread's connection, where they are captured.
+        logger.info("Starting test_consumers")
+        async def exchange(path, payload):
+            communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), path)
+            communicator.scope['user'] = self.user
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            await communicator.send_to(text_data=json.dumps(payload))
+            received = json.loads(await communicator.receive_from())
+            await communicator.disconnect()
+            return received
+
+        with self.assertNumQueries(self.CONSUMER_BUDGETS['chat-message']):
+            received = async_to_sync(exchange)(f'/ws/chat/{self.peer.pk}/', {'content': 'Hello'})
+        self.assertEqual(received['content'], 'Hello')
+
+        with self.assertNumQueries(self.CONSUMER_BUDGETS['support-message']):
+            received = async_to_sync(exchange)('/ws/support/', {'message': 'Help'})
+        self.assertEqual(received['username'], self.user.username)
+        logger.info("test_consumers passed")
+
+
+class BenchCommandTest(TestCase):
+    def result(self, throughput, p95):
+        return {'throughput': throughput, 'latency_ms': {'p95': p95}}
+
+    def test_percentile_uses_nearest_rank(self):
+        logger.info("Starting test_percentile_uses_nearest_rank")
+        ordered = [float(n) for n in range(1, 101)]
+        self.assertEqual(percentile(ordered, 50), 50.0)
+        self.assertEqual(percentile(ordered, 99), 99.0)
+        self.assertEqual(percentile([3.0], 95), 3.0)
+        self.assertIsNone(percentile([], 50))
+        logger.info("test_percentile_uses_nearest_rank passed")
+
+    def test_compare_reports_regressions_beyond_tolerance(self):
+        logger.info("Starting test_compare_reports_regressions_beyond_tolerance")
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        baseline = os.path.join(directory, 'baseline.json')
+        with open(baseline, 'w') as file:
+            json.dump({'scenarios': {'login': self.result(100, 50), 'activities': self.result(400, 10)}}, file)
+
+        command = BenchCommand(stdout=StringIO())
+        command.compare({'scenarios': {'login': self.result(95, 52)}}, baseline, 0.1)
+        with self.assertRaisesMessage(CommandError, 'activities'):
+            command.compare({'scenarios': {'login': self.result(95, 52), 'activities': self.result(300, 10)}},
+                            baseline, 0.1)
+        logger.info("test_compare_reports_regressions_beyond_tolerance passed")
+
+    def test_degenerate_results_are_reported_not_compared(self):
+        logger.info("Starting test_degenerate_results_are_reported_not_compared")
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        baseline = os.path.join(directory, 'baseline.json')
+        with open(baseline, 'w') as file:
+            json.dump({'scenarios': {'login': self.result(0, 50), 'activities': self.result(400, 0)}}, file)
+
+        out = StringIO()
+        command = BenchCommand(stdout=out)
+        command.compare({'scenarios': {'login': self.result(95, 52), 'activities': self.result(300, 10)}},
+                        baseline, 0.1)
+        self.assertEqual(out.getvalue().count('no throughput or p95 to compare'), 2)
+        command.compare_flavours({'login': self.result(None, None), 'login-async': self.result(95, 52)})
+        command.report('login', {'throughput': None, 'errors': 0,
+                                 'latency_ms': {'p50': None, 'p95': None, 'p99': None}})
+        self.assertIn('login                            - req/s', out.getvalue())
+        logger.info("test_degenerate_results_are_reported_not_compared passed")
+
+    def test_requests_must_be_positive(self):
+        logger.info("Starting test_requests_must_be_positive")
+        with self.assertRaisesMessage(CommandError, '--requests'):
+            call_command('bench', requests=0, stdout=StringIO())
+        logger.info("test_requests_must_be_positive passed")
+
+
+# Distinct from any alias in DATABASES (DATABASE_SQLITE_REPLICA=1 defines
+# 'replica'), so the test never copies a database onto itself.
+REPLICA_ALIAS = 'routing_test_replica'
+REPLICA_ROUTING = {'REPLICAS': [REPLICA_ALIAS], 'STICKY_SECONDS': 5, 'CACHE': 'responses'}
+
+
+@skipUnless(connection.vendor == 'sqlite', 'copy_database stands in for replication between SQLite files')
+@override_settings(DATABASE_ROUTING=REPLICA_ROUTING)
+class ReplicaRoutingTest(APITransactionTestCase):
+    # A second SQLite database stands in for the replica; it only sees the
+    # primary's rows when copy_database runs, which simulates the lag. It is
+    # registered here rather than in DATABASES, so the runner does not create
+    # it: each copy brings the schema along.
+    @classmethod
+    def setUpClass(cls):
+        cls.replica_dir = tempfile.mkdtemp()
+        connections.settings[REPLICA_ALIAS] = {**connections['default'].settings_dict,
+                                           'NAME': os.path.join(cls.replica_dir, 'replica.sqlite3')}
+        cls.databases = {'default', REPLICA_ALIAS}
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        connections[REPLICA_ALIAS].close()
+        del connections[REPLICA_ALIAS]
+        del connections.settings[REPLICA_ALIAS]
+        shutil.rmtree(cls.replica_dir)
+
+    def setUp(self):
+        logger.info("Setting up ReplicaRoutingTest...")
+        self.user = User.objects.create_user(username='reader', email='reader@example.com', password='x',
+                                             date_of_birth='2000-01-01', country='US')
+        self.friend = User.objects.create_user(username='writer', email='writer@example.com', password='x',
+                                               date_of_birth='2000-01-01', country='BY')
+        copy_database('default', REPLICA_ALIAS)
+        # Replication has caught up, so the pins set by the inserts can go.
+        get_response_cache().clear()
+        self.client.force_authenticate(user=self.user)
+
+    def activity_names(self):
+        get_response_cache().delete_many([f'response:activities:{self.user.pk}'])
+        return [activity['name'] for activity in self.client.get(reverse('all-activities')).data]
+
+    def test_reads_stick_to_primary_after_a_write(self):
+        logger.info("Starting test_reads_stick_to_primary_after_a_write")
+        Activity.objects.create(user=self.user, name='Reading')
+        self.assertEqual(self.activity_names(), ['Reading'])
+
+        # Once the window has passed the replica answers, and it is behind.
+        get_response_cache().clear()
+        self.assertEqual(self.activity_names(), [])
+
+        copy_database('default', REPLICA_ALIAS)
+        self.assertEqual(self.activity_names(), ['Reading'])
+        logger.info("test_reads_stick_to_primary_after_a_write passed")
+
+    def test_message_pins_both_participants(self):
+        logger.info("Starting test_message_pins_both_participants")
+        PrivateMessage.objects.create(sender=self.friend, receiver=self.user, content='Hi')
+        response = self.client.get(reverse('message-history', args=[self.friend.pk]))
+        self.assertEqual([message['content'] for message in response.data], ['Hi'])
+        logger.info("test_message_pins_both_participants passed")
+
+    def test_writes_and_unmarked_views_use_the_primary(self):
+        logger.info("Starting test_writes_and_unmarked_views_use_the_primary")
+        router = ReplicaRouter()
+        self.assertEqual(router.db_for_read(User), 'default')
+
+        class View:
+            @replica_reads
+            def get(self, request):
+                return router.db_for_read(User), router.db_for_write(User)
+
+        request = HttpRequest()
+        request.user = self.user
+        self.assertEqual(View().get(request), (REPLICA_ALIAS, 'default'))
+        self.assertFalse(router.allow_migrate(REPLICA_ALIAS, 'clock'))
+        self.assertTrue(router.allow_migrate('default', 'clock'))
+        logger.info("test_writes_and_unmarked_views_use_the_primary passed")
+
+
+class ReplicaPinCacheCheckTest(TestCase):
+    def setUp(self):
+        logger.info("Setting up ReplicaPinCacheCheckTest...")
+        self.caches = {**settings.CACHES, 'responses': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+    def test_refuses_per_process_pin_cache_with_replicas(self):
+        logger.info("Starting test_refuses_per_process_pin_cache_with_replicas")
+        with override_settings(CACHES=self.caches, DATABASE_ROUTING=REPLICA_ROUTING):
+            self.assertEqual([error.id for error in check_replica_pin_cache(None)], ['clock.E001'])
+        logger.info("test_refuses_per_process_pin_cache_with_replicas passed")
+
+    def test_allows_per_process_cache_without_replicas_or_with_a_shared_one(self):
+        logger.info("Starting test_allows_per_process_cache_without_replicas_or_with_a_shared_one")
+        with override_settings(CACHES=self.caches, DATABASE_ROUTING={**REPLICA_ROUTING, 'REPLICAS': []}):
+            self.assertEqual(check_replica_pin_cache(None), [])
+        shared = {**self.caches, 'responses': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+                                               'LOCATION': tempfile.gettempdir()}}
+        with override_settings(CACHES=shared, DATABASE_ROUTING=REPLICA_ROUTING):
+            self.assertEqual(check_replica_pin_cache(None), [])
+        logger.info("test_allows_per_process_cache_without_replicas_or_with_a_shared_one passed")
+
+
+class StartupProfileTest(TestCase):
+    def test_parse_importtime(self):
+        logger.info("Starting test_parse_importtime")
+        modules = parse_importtime([
+            'import time: self [us] | cumulative | imported package',
+            'import time:       120 |        120 |     clock.stats',
+            'import time:      1500 |       1620 |   clock.models',
+        ])
+        self.assertEqual(modules, [('clock.stats', 0.00012, 0.00012), ('clock.models', 0.0015, 0.00162)])
+        logger.info("test_parse_importtime passed")
+
+    def test_reports_imports_and_first_request(self):
+        logger.info("Starting test_reports_imports_and_first_request")
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        output = os.path.join(directory, 'startup.json')
+        call_command('profile_startup', output=output, budget=60, stdout=StringIO())
+        with open(output) as file:
+            report = json.load(file)
+        self.assertEqual(report['first_request_status'], 401)
+        self.assertIn('clock', report['packages'])
+        self.assertGreater(report['import_seconds'], 0)
+        logger.info("test_reports_imports_and_first_request passed")
+
+    def test_schema_is_not_generated_at_startup(self):
+        logger.info("Starting test_schema_is_not_generated_at_startup")
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        reset_schema_cache()
+        self.addCleanup(reset_schema_cache)
+        with override_settings(API_SCHEMA={**settings.API_SCHEMA, 'DIR': directory}), \
+                mock.patch('clock.schema.render_schema') as render:
+            warm_schema_cache()
+        render.assert_not_called()
+        logger.info("test_schema_is_not_generated_at_startup passed")
+
+
+# Keeps the compared views on the primary when replicas are configured.
+@override_settings(DATABASE_ROUTING={**settings.DATABASE_ROUTING, 'REPLICAS': []})
+class AsyncEndpointsTest(APITestCase):
+    def setUp(self):
+        logger.info("Setting up AsyncEndpointsTest...")
+        get_response_cache().clear()
+        self.user = User.objects.create_user(username='async_user', email='async@example.com', password='x',
+                                             date_of_birth='2000-01-01', country='US')
+        self.peer = User.objects.create_user(username='async_peer', email='async_peer@example.com', password='x',
+                                             date_of_birth='2000-01-01', country='BY')
+        Activity.objects.create(user=self.user, name='Reading', minutes_spent_today=5)
+        PrivateMessage.objects.create(sender=self.user, receiver=self.peer, content='Hi')
+        PrivateMessage.objects.create(sender=self.peer, receiver=self.user, content='Hello')
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {RefreshToken.for_user(self.user).access_token}')
+
+    def test_same_data_as_the_sync_views(self):
+        logger.info("Starting test_same_data_as_the_sync_views")
+        for sync_name, async_name, args in [('user-read', 'user-read-async', []),
+                                            ('all-activities', 'all-activities-async', []),
+                                            ('message-history', 'message-history-async', [self.peer.pk])]:
+            expected = self.client.get(reverse(sync_name, args=args)).json()
+            get_response_cache().clear()
+            response = self.client.get(reverse(async_name, args=args))
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json(), expected, async_name)
+        logger.info("test_same_data_as_the_sync_views passed")
+
+    def test_shares_cache_entries_with_the_sync_view(self):
+        logger.info("Starting test_shares_cache_entries_with_the_sync_view")
+        self.client.get(reverse('all-activities'))
+        response = self.client.get(reverse('all-activities-async'))
+        self.assertEqual(response['X-Cache'], 'HIT')
+        logger.info("test_shares_cache_entries_with_the_sync_view passed")
+
+    def test_add_time(self):
+        logger.info("Starting test_add_time")
+        response = self.client.post(reverse('add-time-async'), {'name': 'Reading', 'time': 25}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Activity.objects.get(user=self.user).minutes_spent_today, 30)
+        response = self.client.post(reverse('add-time-async'), {'name': 'Reading', 'time': 'soon'}, format='json')
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post(reverse('add-time-async'), {'name': 'Cooking', 'time': 5}, format='json')
+        self.assertEqual(response.json(), {'message': 'there is no such activity'})
+        response = self.client.post(reverse('add-time-async'), [{'name': 'Reading', 'time': 5}], format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {'detail': 'Expected a JSON object'})
+        logger.info("test_add_time passed")
+
+    def test_authentication_errors_match_drf(self):
+        logger.info("Starting test_authentication_errors_match_drf")
+        self.client.credentials()
+        for name in ('user-read', 'user-read-async'):
+            response = self.client.get(reverse(name))
+            self.assertEqual(response.status_code, 401)
+            self.assertEqual(response.json(), {'detail': 'Authentication credentials were not provided.'})
+            self.assertEqual(response['WWW-Authenticate'], 'Bearer realm="api"')
+
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer not-a-token')
+        response = self.client.get(reverse('user-read-async'))
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(response.json()['code'], 'token_not_valid')
+
+        self.user.is_active = False
+        self.user.save()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {RefreshToken.for_user(self.user).access_token}')
+        for name in ('user-read', 'user-read-async'):
+            self.assertEqual(self.client.get(reverse(name)).json(),
+                             {'detail': 'User is inactive', 'code': 'user_inactive'})
+        logger.info("test_authentication_errors_match_drf passed")
+
+    def test_static_files_middleware_stays_async(self):
+        logger.info("Starting test_static_files_middleware_stays_async")
+        async def get_response(request):
+            return 'view'
+
+        middleware = AsyncWhiteNoiseMiddleware(get_response)
+        request = HttpRequest()
+        request.path_info = '/api/activity/all/async/'
+        self.assertTrue(asyncio.iscoroutinefunction(middleware))
+        self.assertEqual(async_to_sync(middleware)(request), 'view')
+        logger.info("test_static_files_middleware_stays_async passed")
+
+
+class ServeCommandTest(TestCase):
+    @override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+    def test_refuses_per_process_channel_layer_with_several_workers(self):
+        logger.info("Starting test_refuses_per_process_channel_layer_with_several_workers")
+        with self.assertRaisesMessage(CommandError, 'InMemoryChannelLayer'):
+            call_command('serve', workers=2, port=0, stdout=StringIO())
+        logger.info("test_refuses_per_process_channel_layer_with_several_workers passed")
+
+    @override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels_redis.core.RedisChannelLayer'}},
+                       CACHES={**settings.CACHES, 'responses': {
+                           'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_refuses_per_process_response_cache_with_several_workers(self):
+        logger.info("Starting test_refuses_per_process_response_cache_with_several_workers")
+        with self.assertRaisesMessage(CommandError, 'RESPONSE_CACHE_BACKEND'):
+            call_command('serve', workers=2, port=0, stdout=StringIO())
+        with self.assertRaisesMessage(CommandError, 'study heatmap generations'):
+            call_command('serve', workers=2, port=0, stdout=StringIO())
+        logger.info("test_refuses_per_process_response_cache_with_several_workers passed")
+
+    def test_resident_memory(self):
+        logger.info("Starting test_resident_memory")
+        self.assertGreater(resident_memory(os.getpid()), 1024 * 1024)
+        self.assertIsNone(resident_memory(2 ** 22 + 1))
+        logger.info("test_resident_memory passed")
+
+    def test_reload_and_graceful_shutdown(self):
+        logger.info("Starting test_reload_and_graceful_shutdown")
+        process = subprocess.Popen(
+            [sys.executable, 'manage.py', 'serve', '--workers', '1', '--port', '0', '--graceful-timeout', '2'],
+            cwd=settings.BASE_DIR, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True,
+        )
+        self.addCleanup(process.kill)
+        lines = queue.Queue()
+        threading.Thread(target=lambda: [lines.put(line.strip()) for line in process.stdout], daemon=True).start()
+
+        def wait_for(text):
+            while True:
+                line = lines.get(timeout=30)
+                if text in line:
+                    return line
+
+        port = int(wait_for('Listening on').split(':')[1].split()[0])
+        wait_for('ready')
+        url = f'http://127.0.0.1:{port}{reverse("user-read")}'
+        with self.assertRaises(urllib.error.HTTPError) as response:
+            urllib.request.urlopen(url, timeout=10)
+        self.assertEqual(response.exception.code, 401)
+
+        process.send_signal(signal.SIGHUP)
+        wait_for('draining (reload)')
+        with self.assertRaises(urllib.error.HTTPError) as response:
+            urllib.request.urlopen(url, timeout=10)
+        self.assertEqual(response.exception.code, 401)
+
+        process.send_signal(signal.SIGTERM)
+        self.assertEqual(process.wait(timeout=30), 0)
+        logger.info("test_reload_and_graceful_shutdown passed")
+
+
+class UnixSocketChannelLayerTest(TestCase):
+    def setUp(self):
+        logger.info("Setting up UnixSocketChannelLayerTest...")
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'channels.sock')
+
+    def run_with_broker(self, scenario):
+        async def run():
+            broker = asyncio.create_task(ChannelBroker().serve(self.path))
+            while not os.path.exists(self.path):
+                await asyncio.sleep(0.01)
+            try:
+                return await scenario()
+            finally:
+                broker.cancel()
+        return async_to_sync(run)()
+
+    def test_send_receive_and_groups(self):
+        logger.info("Starting test_send_receive_and_groups")
+        async def scenario():
+            layer = UnixSocketChannelLayer(self.path)
+            first, second = await layer.new_channel(), await layer.new_channel()
+            await layer.send(first, {'type': 'test.message', 'text': 'hi', 'raw': b'\x00'})
+            self.assertEqual(await layer.receive(first), {'type': 'test.message', 'text': 'hi', 'raw': b'\x00'})
+
+            await layer.group_add('room', first)
+            await layer.group_add('room', second)
+            await layer.group_send('room', {'type': 'test.message', 'text': 'all'})
+            self.assertEqual((await layer.receive(first))['text'], 'all')
+            self.assertEqual((await layer.receive(second))['text'], 'all')
+
+            await layer.group_discard('room', second)
+            # A receive cancelled while waiting leaves the next message to
+            # the next receive.
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(layer.receive(second), 0.1)
+            await layer.group_send('room', {'type': 'test.message', 'text': 'first only'})
+            await layer.send(second, {'type': 'test.message', 'text': 'direct'})
+            self.assertEqual((await layer.receive(first))['text'], 'first only')
+            self.assertEqual((await layer.receive(second))['text'], 'direct')
+            await layer.close()
+        self.run_with_broker(scenario)
+        logger.info("test_send_receive_and_groups passed")
+
+    def test_capacity_and_expiry(self):
+        logger.info("Starting test_capacity_and_expiry")
+        async def scenario():
+            layer = UnixSocketChannelLayer(self.path, capacity=1, expiry=0.2, channel_capacity={'large.*': 3})
+            await layer.send('small', {'type': 'test.message'})
+            with self.assertRaises(ChannelFull):
+                await layer.send('small', {'type': 'test.message'})
+            for _ in range(3):
+                await layer.send('large.channel', {'type': 'test.message'})
+            with self.assertRaises(ChannelFull):
+                await layer.send('large.channel', {'type': 'test.message'})
+
+            # Once a message expires unread the channel is taken to be gone
+            # and leaves its groups.
+            await layer.group_add('room', 'small')
+            await asyncio.sleep(0.3)
+            await layer.send('small', {'type': 'test.message', 'text': 'fresh'})
+            await layer.group_send('room', {'type': 'test.message', 'text': 'group'})
+            self.assertEqual((await layer.receive('small'))['text'], 'fresh')
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(layer.receive('small'), 0.1)
+            await layer.flush()
+            await layer.close()
+        self.run_with_broker(scenario)
+        logger.info("test_capacity_and_expiry passed")
+
+    def test_group_send_from_another_process(self):
+        logger.info("Starting test_group_send_from_another_process")
+        child = (
+            'import asyncio, sys\n'
+            'from clock.channel_layers import UnixSocketChannelLayer\n'
+            'layer = UnixSocketChannelLayer(sys.argv[1])\n'
+            'asyncio.run(layer.group_send("room", {"type": "test.message", "text": "from child"}))\n'
+        )
+
+        async def scenario():
+            layer = UnixSocketChannelLayer(self.path)
+            channel = await layer.new_channel()
+            await layer.group_add('room', channel)
+            process = await asyncio.create_subprocess_exec(sys.executable, '-c', child, self.path,
+                                                           cwd=settings.BASE_DIR)
+            self.assertEqual(await process.wait(), 0)
+            message = await asyncio.wait_for(layer.receive(channel), 5)
+            await layer.close()
+            return message
+        self.assertEqual(self.run_with_broker(scenario)['text'], 'from child')
+        logger.info("test_group_send_from_another_process passed")
+
+    def test_support_chat_through_the_broker(self):
+        logger.info("Starting test_support_chat_through_the_broker")
+        user = User.objects.create_user(username='layer_user', email='layer@example.com', password='x',
+                                        date_of_birth='2000-01-01', country='US')
+
+        async def scenario():
+            communicators = []
+            for _ in range(2):
+                communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), '/ws/support/')
+                communicator.scope['user'] = user
+                connected, _ = await communicator.connect()
+                self.assertTrue(connected)
+                communicators.append(communicator)
+            await communicators[0].send_to(text_data=json.dumps({'message': 'Help'}))
+            received = [json.loads(await communicator.receive_from(timeout=5)) for communicator in communicators]
+            for communicator in communicators:
+                await communicator.disconnect()
+            return received
+
+        layers = {'default': {'BACKEND': 'clock.channel_layers.UnixSocketChannelLayer', 'CONFIG': {'path': self.path}}}
+        with override_settings(CHANNEL_LAYERS=layers):
+            received = self.run_with_broker(scenario)
+        self.assertEqual([message['message'] for message in received], ['Help', 'Help'])
+        logger.info("test_support_chat_through_the_broker passed")
+
+
+class LocalFanOutChannelLayerTest(TestCase):
+    class CountingBroker(ChannelBroker):
+        def __init__(self):
+            super().__init__()
+            self.deliveries = 0
+
+        def deliver(self, session, channel, payload):
+            self.deliveries += 1
+            return super().deliver(session, channel, payload)
+
+    def setUp(self):
+        logger.info("Setting up LocalFanOutChannelLayerTest...")
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'channels.sock')
+        self.broker = self.CountingBroker()
+
+    def run_with_broker(self, scenario):
+        async def run():
+            broker = asyncio.create_task(self.broker.serve(self.path))
+            while not os.path.exists(self.path):
+                await asyncio.sleep(0.01)
+            # Two layers on one broker stand in for two worker processes.
+            workers = [LocalFanOutChannelLayer(UnixSocketChannelLayer(self.path)) for _ in range(2)]
+            try:
+                return await scenario(*workers)
+            finally:
+                for worker in workers:
+                    await worker.close()
+                broker.cancel()
+        return async_to_sync(run)()
+
+    def test_group_send_reaches_each_process_once(self):
+        logger.info("Starting test_group_send_reaches_each_process_once")
+        async def scenario(first, second):
+            members = [await first.new_channel() for _ in range(3)] + [await second.new_channel() for _ in range(2)]
+            for member in members[:3]:
+                await first.group_add('support_chat', member)
+            for member in members[3:]:
+                await second.group_add('support_chat', member)
+
+            self.broker.deliveries = 0
+            await first.group_send('support_chat', {'type': 'chat_message', 'message': 'Help'})
+            received = [await asyncio.wait_for((first if index < 3 else second).receive(member), 5)
+                        for index, member in enumerate(members)]
+            self.assertEqual(self.broker.deliveries, 2)
+            return received
+        received = self.run_with_broker(scenario)
+        self.assertEqual([message['message'] for message in received], ['Help'] * 5)
+        logger.info("test_group_send_reaches_each_process_once passed")
+
+    def test_direct_sends_and_leaving_groups(self):
+        logger.info("Starting test_direct_sends_and_leaving_groups")
+        async def scenario(first, second):
+            member = await first.new_channel()
+            await second.send(member, {'type': 'test.message', 'text': 'across'})
+            self.assertEqual((await asyncio.wait_for(first.receive(member), 5))['text'], 'across')
+            await first.send(member, {'type': 'test.message', 'text': 'local'})
+            self.assertEqual((await first.receive(member))['text'], 'local')
+
+            await first.group_add('room', member)
+            await first.group_add('room', await first.new_channel())
+            self.assertEqual(len(self.broker.groups['fanout.room']), 1)
+            await first.group_discard('room', member)
+            await second.group_send('room', {'type': 'test.message', 'text': 'group'})
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(first.receive(member), 0.2)
+            for channel in list(first.processes[asyncio.get_running_loop()].groups['room']):
+                await first.group_discard('room', channel)
+            self.assertNotIn('fanout.room', self.broker.groups)
+        self.run_with_broker(scenario)
+        logger.info("test_direct_sends_and_leaving_groups passed")
+
+    def test_support_chat_unchanged(self):
+        logger.info("Starting test_support_chat_unchanged")
+        user = User.objects.create_user(username='fanout_user', email='fanout@example.com', password='x',
+                                        date_of_birth='2000-01-01', country='US')
+
+        async def scenario():
+            communicators = []
+            for _ in range(3):
+                communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), '/ws/support/')
+                communicator.scope['user'] = user
+                connected, _ = await communicator.connect()
+                self.assertTrue(connected)
+                communicators.append(communicator)
+            await communicators[1].send_to(text_data=json.dumps({'message': 'Help'}))
+            received = [json.loads(await communicator.receive_from(timeout=5)) for communicator in communicators]
+            for communicator in communicators:
+                await communicator.disconnect()
+            return received
+
+        layers = {'default': {'BACKEND': 'clock.channel_layers.LocalFanOutChannelLayer',
+                              'CONFIG': {'layer': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}}}
+        with override_settings(CHANNEL_LAYERS=layers):
+            received = async_to_sync(scenario)()
+        self.assertEqual([message['message'] for message in received], ['Help'] * 3)
+        logger.info("test_support_chat_unchanged passed")
+
+
+class StudyHeatmapTest(APITestCase):
+    def setUp(self):
+        logger.info("Setting up StudyHeatmapTest...")
+        get_response_cache().clear()
+        self.user = User.objects.create_user(username='heatmap_user', email='heatmap@example.com', password='x',
+                                             date_of_birth='2000-01-01', country='US')
+        self.activity = Activity.objects.create(user=self.user, name='Reading')
+        self.client.force_authenticate(user=self.user)
+
+    def session(self, ended_at, minutes):
+        return StudySession.objects.create(user=self.user, ended_at=timezone.make_aware(ended_at), minutes=minutes)
+
+    def get(self, **params):
+        return self.client.get(reverse('study-heatmap'), params)
+
+    def test_sessions_are_split_across_hours_and_days(self):
+        # 23:00 Monday to 00:30 Tuesday, and 10:15 to 13:45 on Wednesday.
+        logger.info("Starting test_sessions_are_split_across_hours_and_days")
+        self.session(datetime(2024, 11, 5, 0, 30), 90)
+        self.session(datetime(2024, 11, 6, 13, 45), 210)
+        response = self.get(start='2024-11-04', end='2024-11-07')
+        self.assertEqual(response.status_code, 200)
+        grid = response.data['heatmap']
+        self.assertEqual((grid[0][23], grid[1][0]), (60, 30))
+        self.assertEqual(grid[2][10:14], [45, 60, 60, 45])
+        self.assertEqual(response.data['daily'], [60, 30, 210, 0])
+        self.assertEqual(response.data['total_minutes'], 300)
+
+        # Only the part inside the range counts.
+        response = self.get(start='2024-11-05', end='2024-11-05')
+        self.assertEqual(response.data['daily'], [30])
+        self.assertEqual(response.data['heatmap'][0][23], 0)
+        logger.info("test_sessions_are_split_across_hours_and_days passed")
+
+    def test_matches_minute_by_minute_binning(self):
+        logger.info("Starting test_matches_minute_by_minute_binning")
+        rng = random.Random(7)
+        start, end = date(2023, 3, 1), date(2023, 4, 30)
+        expected = [[0] * 24 for _ in range(7)]
+        origin = datetime.combine(start, datetime.min.time())
+        for _ in range(300):
+            ended_at = origin + timedelta(minutes=rng.randrange(-600, 62 * 24 * 60))
+            minutes = rng.randrange(1, 400)
+            self.session(ended_at, minutes)
+            for offset in range(1, minutes + 1):
+                moment = ended_at - timedelta(minutes=offset)
+                if start <= moment.date() <= end:
+                    expected[moment.weekday()][moment.hour] += 1
+        response = self.get(start=start.isoformat(), end=end.isoformat())
+        self.assertEqual(response.data['heatmap'], expected)
+        self.assertEqual(sum(response.data['daily']), sum(map(sum, expected)))
+        logger.info("test_matches_minute_by_minute_binning passed")
+
+    def test_utc_offsets_follow_daylight_saving_changes(self):
+        logger.info("Starting test_utc_offsets_follow_daylight_saving_changes")
+        import numpy as np
+        import zoneinfo
+
+        tz = zoneinfo.ZoneInfo('America/New_York')
+        # Around the spring and autumn changes of 2024, and a spread of years.
+        moments = np.concatenate([np.arange(1710054000 - 3600, 1710054000 + 3600, 7),
+                                  np.arange(1730613600 - 3600, 1730613600 + 3600, 7),
+                                  np.array([random.Random(3).randrange(10 ** 9, 2 * 10 ** 9) for _ in range(500)])])
+        expected = [datetime.fromtimestamp(int(moment), tz).utcoffset().total_seconds() for moment in moments]
+        self.assertEqual(heatmap.utc_offsets(moments, tz).tolist(), expected)
+        logger.info("test_utc_offsets_follow_daylight_saving_changes passed")
+
+    def test_cached_per_range_until_the_next_timer_write(self):
+        logger.info("Starting test_cached_per_range_until_the_next_timer_write")
+        self.assertEqual(self.get()['X-Cache'], 'MISS')
+        self.assertEqual(self.get()['X-Cache'], 'HIT')
+        self.assertEqual(self.get(start='2024-01-01', end='2024-01-31')['X-Cache'], 'MISS')
+
+        self.client.post(reverse('add-time'), {'name': 'Reading', 'time': 25})
+        response = self.get()
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertEqual(response.data['total_minutes'], 25)
+        self.assertEqual(self.get(start='2024-01-01', end='2024-01-31')['X-Cache'], 'MISS')
+        logger.info("test_cached_per_range_until_the_next_timer_write passed")
+
+    def test_timer_writes_record_sessions(self):
+        logger.info("Starting test_timer_writes_record_sessions")
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {RefreshToken.for_user(self.user).access_token}')
+        self.client.post(reverse('add-time'), {'name': 'Reading', 'time': 25})
+        self.client.post(reverse('add-time-async'), {'name': 'Reading', 'time': 15}, format='json')
+        self.client.post(reverse('add-time'), {'name': 'Reading', 'time': 0})
+        self.assertEqual(list(StudySession.objects.filter(user=self.user).values_list('minutes', 'activity')),
+                         [(25, self.activity.pk), (15, self.activity.pk)])
+        self.activity.delete()
+        self.assertEqual(StudySession.objects.filter(user=self.user, activity=None).count(), 2)
+        logger.info("test_timer_writes_record_sessions passed")
+
+    def test_rejects_bad_ranges(self):
+        logger.info("Starting test_rejects_bad_ranges")
+        for params in ({'start': 'yesterday'}, {'start': '2024-02-30'}, {'start': '2024-02-02', 'end': '2024-02-01'},
+                       {'start': '2000-01-01', 'end': '2024-01-01'}):
+            self.assertEqual(self.get(**params).status_code, 400, params)
+        logger.info("test_rejects_bad_ranges passed")
+
+    def test_default_range_is_the_last_year(self):
+        logger.info("Starting test_default_range_is_the_last_year")
+        today = date(2024, 6, 30)
+        self.assertEqual(heatmap.parse_range(None, None, today=today), (date(2023, 7, 2), today))
+        logger.info("test_default_range_is_the_last_year passed")
+
+
+class AchievementsTest(APITestCase):
+    def setUp(self):
+        logger.info("Setting up AchievementsTest...")
+        self.user = User.objects.create_user(username='achiever', email='achiever@example.com', password='x',
+                                             date_of_birth='2000-01-01', country='US')
+        self.client.force_authenticate(user=self.user)
+
+    def study(self, activity, minutes, day, hour=12):
+        # What a timer write does, on a chosen day.
+        activity._add_minutes(minutes)
+        activity.save()
+        StudySession.objects.create(user=self.user, activity=activity, minutes=minutes,
+                                    ended_at=timezone.make_aware(datetime.combine(day, datetime.min.time())
+                                                                 + timedelta(hours=hour)))
+
+    def earned(self):
+        return dict(Achievement.objects.filter(user=self.user).values_list('code', 'activity_name'))
+
+    def progress(self):
+        return AchievementProgress.objects.values_list(
+            'total_minutes', 'activities_created', 'current_streak', 'longest_streak', 'last_study_day'
+        ).get(user=self.user)
+
+    def test_timer_writes_and_new_activities_are_evaluated(self):
+        logger.info("Starting test_timer_writes_and_new_activities_are_evaluated")
+        self.client.post(reverse('create-activity'), {'name': 'Reading'})
+        self.assertEqual(self.earned(), {'first-activity': ''})
+        self.client.post(reverse('add-time'), {'name': 'Reading', 'time': 600})
+        self.assertEqual(self.earned(), {'first-activity': '', 'first-minutes': '', 'total-10h': '',
+                                         'activity-10h': 'Reading'})
+        self.assertEqual(self.progress(), (600, 1, 1, 1, timezone.localdate()))
+
+        for name in ('Writing', 'Maths', 'Physics', 'History'):
+            self.client.post(reverse('create-activity'), {'name': name})
+        self.assertIn('five-activities', self.earned())
+        logger.info("test_timer_writes_and_new_activities_are_evaluated passed")
+
+    def test_streaks(self):
+        logger.info("Starting test_streaks")
+        activity = Activity.objects.create(user=self.user, name='Reading')
+        start = date(2024, 3, 1)
+        for offset in (0, 1, 2, 2, 4, 5):
+            self.study(activity, 20, start + timedelta(days=offset))
+        self.assertEqual(self.progress(), (120, 1, 2, 3, date(2024, 3, 6)))
+        self.assertIn('streak-3', self.earned())
+        self.assertNotIn('streak-7', self.earned())
+
+        # An older session does not move the streak.
+        self.study(activity, 20, start)
+        self.assertEqual(self.progress()[2:], (2, 3, date(2024, 3, 6)))
+        logger.info("test_streaks passed")
+
+    def test_running_state_matches_a_replay_of_the_history(self):
+        logger.info("Starting test_running_state_matches_a_replay_of_the_history")
+        rng = random.Random(11)
+        activities = [Activity.objects.create(user=self.user, name=f'Subject {n}') for n in range(4)]
+        day = date(2024, 1, 1)
+        for _ in range(150):
+            day += timedelta(days=rng.choice((0, 1, 1, 1, 2)))
+            self.study(rng.choice(activities), rng.randrange(1, 120), day, hour=rng.randrange(24))
+        (replayed,), earned = achievements.replay([self.user.pk])
+        self.assertEqual(self.progress(), (replayed.total_minutes, replayed.activities_created,
+                                           replayed.current_streak, replayed.longest_streak,
+                                           replayed.last_study_day))
+        self.assertEqual(set(self.earned()), {achievement.code for achievement in earned})
+        logger.info("test_running_state_matches_a_replay_of_the_history passed")
+
+    def test_state_is_built_from_the_history_on_first_use(self):
+        # Written before achievements were tracked: no signals.
+        logger.info("Starting test_state_is_built_from_the_history_on_first_use")
+        activity, = Activity.objects.bulk_create([Activity(user=self.user, name='Reading', minutes_spent_in_total=590)])
+        StudySession.objects.bulk_create([
+            StudySession(user=self.user, activity=activity, minutes=10,
+                         ended_at=timezone.make_aware(datetime(2024, 5, day, 9))) for day in (1, 2, 3)
+        ])
+        self.client.post(reverse('add-time'), {'name': 'Reading', 'time': 15})
+        self.assertEqual(self.progress()[:2], (605, 1))
+        self.assertEqual(set(self.earned()), {'first-activity', 'first-minutes', 'total-10h', 'activity-10h',
+                                              'streak-3'})
+        self.client.post(reverse('add-time'), {'name': 'Reading', 'time': 5})
+        self.assertEqual(self.progress()[:2], (610, 1))
+        logger.info("test_state_is_built_from_the_history_on_first_use passed")
+
+    def test_backfill_command(self):
+        logger.info("Starting test_backfill_command")
+        others = User.objects.bulk_create([
+            User(username=f'backfill_{n}', email=f'backfill_{n}@example.com', date_of_birth=date(2000, 1, 1),
+                 country='US') for n in range(5)
+        ])
+        Activity.objects.bulk_create([Activity(user=user, name='Reading', minutes_spent_in_total=60 * n)
+                                      for n, user in enumerate(others)])
+        out = StringIO()
+        call_command('backfill_achievements', workers=0, chunk_size=2, stdout=out)
+        self.assertIn('Done: 6 users backfilled', out.getvalue())
+        self.assertEqual(AchievementProgress.objects.get(user=others[4]).total_minutes, 240)
+        self.assertEqual(set(Achievement.objects.filter(user=others[0]).values_list('code', flat=True)),
+                         {'first-activity'})
+        self.assertEqual(set(Achievement.objects.filter(user=others[1]).values_list('code', flat=True)),
+                         {'first-activity', 'first-minutes'})
+
+        call_command('backfill_achievements', workers=0, stdout=out)
+        self.assertIn('Done: 0 users backfilled', out.getvalue())
+        AchievementProgress.objects.filter(user=others[4]).update(total_minutes=0)
+        call_command('backfill_achievements', '--all', workers=0, stdout=out)
+        self.assertEqual(AchievementProgress.objects.get(user=others[4]).total_minutes, 240)
+        logger.info("test_backfill_command passed")
+
+    def test_endpoint(self):
+        logger.info("Starting test_endpoint")
+        activity = Activity.objects.create(user=self.user, name='Reading')
+        for day in (1, 2, 3):
+            self.study(activity, 30, date(2024, 5, day))
+        response = self.client.get(reverse('achievements'))
+        self.assertEqual(response.status_code, 200)
+        # The last study day is long gone.
+        self.assertEqual((response.data['current_streak'], response.data['longest_streak']), (0, 3))
+        rules = {rule['code']: rule for rule in response.data['achievements']}
+        self.assertEqual(len(rules), len(achievements.RULES))
+        self.assertIsNotNone(rules['streak-3']['earned_at'])
+        self.assertIsNone(rules['streak-7']['earned_at'])
+        self.assertEqual(achievements.summary(self.user.pk, today=date(2024, 5, 4))['current_streak'], 3)
+        logger.info("test_endpoint passed")
+
+
+class BackfillWorkersTest(APITransactionTestCase):
+    # The workers are separate processes and only see committed rows, in a
+    # database they can open themselves.
+    def setUp(self):
+        logger.info("Setting up BackfillWorkersTest...")
+        if connection.is_in_memory_db():
+            self.skipTest('Worker processes cannot open an in-memory test database')
+        self.users = User.objects.bulk_create([
+            User(username=f'backfill_{n}', email=f'backfill_{n}@example.com', date_of_birth=date(2000, 1, 1),
+                 country='US') for n in range(5)
+        ])
+        Activity.objects.bulk_create([Activity(user=user, name='Reading', minutes_spent_in_total=60 * n)
+                                      for n, user in enumerate(self.users)])
+
+    def test_backfill_in_worker_processes(self):
+        logger.info("Starting test_backfill_in_worker_processes")
+        out = StringIO()
+        call_command('backfill_achievements', workers=2, chunk_size=2, stdout=out)
+        self.assertIn('Done: 5 users backfilled', out.getvalue())
+        self.assertEqual(AchievementProgress.objects.get(user=self.users[4]).total_minutes, 240)
+        self.assertEqual(set(Achievement.objects.filter(user=self.users[1]).values_list('code', flat=True)),
+                         {'first-activity', 'first-minutes'})
+        logger.info("test_backfill_in_worker_processes passed")
+
+
+class SmallTimingWheel(pomodoro.TimingWheel):
+    # Three levels of four slots: a span of 64 ticks, so that cascades and
+    # timers beyond the span come up within a few hundred ticks.
+    BITS = 2
+    LEVELS = 3
+    MASK = 3
+    SPAN = 64
+
+
+class PomodoroTest(APITestCase):
+    def setUp(self):
+        logger.info("Setting up PomodoroTest...")
+        self.user = User.objects.create_user(username='pomodoro_user', email='pomodoro@example.com', password='x',
+                                             date_of_birth='2000-01-01', country='US')
+        self.client.force_authenticate(user=self.user)
+
+    def check_wheel(self, wheel_class, horizon, seed):
+        rng = random.Random(seed)
+        start = rng.randrange(10 ** 6)
+        wheel = wheel_class(start)
+        expected = {}
+        for key in range(2000):
+            expires = start + rng.randrange(-10, horizon)
+            wheel.add(key, expires, key)
+            expected[key] = max(expires, start)
+        for key in range(0, 2000, 7):
+            wheel.cancel(key)
+            del expected[key]
+        wheel.add(1, start + 5, 1)
+        expected[1] = start + 5
+
+        now, fired = start - 1, set()
+        while wheel:
+            before, now = now, now + rng.choice((1, 3, 64, 1000))
+            due = wheel.advance(now)
+            ticks = [expected[key] for key, _ in due]
+            self.assertEqual(ticks, sorted(ticks))
+            for key, value in due:
+                # By the first advance past its tick, and only once.
+                self.assertEqual(key, value)
+                self.assertTrue(before < expected[key] <= now)
+                self.assertNotIn(key, fired)
+                fired.add(key)
+        self.assertEqual(fired, set(expected))
+
+    def test_timing_wheel_fires_each_timer_once_on_time(self):
+        logger.info("Starting test_timing_wheel_fires_each_timer_once_on_time")
+        self.check_wheel(pomodoro.TimingWheel, 1 << 16, seed=1)
+        self.check_wheel(SmallTimingWheel, 500, seed=2)
+        logger.info("test_timing_wheel_fires_each_timer_once_on_time passed")
+
+    def test_timing_wheel_fires_on_the_exact_tick(self):
+        logger.info("Starting test_timing_wheel_fires_on_the_exact_tick")
+        wheel = SmallTimingWheel(0)
+        for key, expires in enumerate((0, 1, 4, 15, 16, 17, 63, 64, 65, 200)):
+            wheel.add(key, expires, expires)
+        fired = {}
+        for tick in range(250):
+            for _, expires in wheel.advance(tick):
+                fired[expires] = tick
+        self.assertEqual(fired, {expires: expires for expires in fired})
+        self.assertEqual(len(fired), 10)
+        logger.info("test_timing_wheel_fires_on_the_exact_tick passed")
+
+    def test_events_are_pushed_to_every_connection_once(self):
+        logger.info("Starting test_events_are_pushed_to_every_connection_once")
+        now = [time.time()]
+        pomodoro.start(self.user, 1, 2)
+        overdue = PendingTimer.objects.create(user=self.user, kind=PendingTimer.KIND_WORK,
+                                              fires_at=timezone.now() - timedelta(hours=1))
+
+        async def scenario():
+            communicators = []
+            for _ in range(2):
+                communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), '/ws/pomodoro/')
+                communicator.scope['user'] = self.user
+                connected, _ = await communicator.connect()
+                self.assertTrue(connected)
+                communicators.append(communicator)
+            # Two workers, or one restarted: both load the persisted timers.
+            workers = [pomodoro.PomodoroScheduler(clock=lambda: now[0]) for _ in range(2)]
+            for worker in workers:
+                await worker.load()
+
+            received = []
+            for minutes in (1, 2):
+                now[0] += minutes * 60 + 1
+                for worker in workers:
+                    await worker.step()
+                received.append([json.loads(await communicator.receive_from()) for communicator in communicators])
+                for communicator in communicators:
+                    self.assertTrue(await communicator.receive_nothing())
+            for communicator in communicators:
+                await communicator.disconnect()
+            return received
+
+        received = async_to_sync(scenario)()
+        self.assertEqual([[message['event'] for message in messages] for messages in received],
+                         [['break', 'break'], ['work', 'work']])
+        self.assertEqual(received[0][0]['message'], 'Break time')
+        self.assertFalse(PendingTimer.objects.filter(user=self.user).exists())
+        self.assertFalse(PendingTimer.objects.filter(pk=overdue.pk).exists())
+        logger.info("test_events_are_pushed_to_every_connection_once passed")
+
+    def test_timers_whose_event_was_not_sent_are_kept(self):
+        logger.info("Starting test_timers_whose_event_was_not_sent_are_kept")
+        now = [time.time()]
+        timers = pomodoro.start(self.user, 1, 2)
+        other = User.objects.create_user(username='pomodoro_other', email='pomodoro_other@example.com', password='x',
+                                         date_of_birth='2000-01-01', country='US')
+        pomodoro.start(other, 1, 2)
+        sent = []
+
+        class FlakyLayer:
+            async def group_send(self, group, message):
+                if not sent:
+                    sent.append(None)
+                    raise ConnectionError('channel layer unavailable')
+                sent.append(group)
+
+        async def scenario():
+            scheduler = pomodoro.PomodoroScheduler(clock=lambda: now[0])
+            await scheduler.load()
+            now[0] += 61
+            with self.assertRaises(ConnectionError):
+                await scheduler.step()
+            self.assertEqual(len(scheduler.wheel), 4)
+            now[0] += pomodoro.RETRY_DELAY + 1
+            await scheduler.step()
+
+        with mock.patch.object(pomodoro, 'get_channel_layer', return_value=FlakyLayer()):
+            async_to_sync(scenario)()
+        self.assertEqual(sorted(sent[1:]), sorted([pomodoro.user_group(self.user.pk), pomodoro.user_group(other.pk)]))
+        self.assertEqual(list(PendingTimer.objects.filter(kind=PendingTimer.KIND_BREAK)), [])
+        self.assertTrue(PendingTimer.objects.filter(pk=timers[1].pk).exists())
+        logger.info("test_timers_whose_event_was_not_sent_are_kept passed")
+
+    def test_scheduler_only_runs_where_enabled(self):
+        logger.info("Starting test_scheduler_only_runs_where_enabled")
+        async def application(scope, receive, send):
+            pass
+
+        middleware = pomodoro.PomodoroSchedulerMiddleware(application)
+        with mock.patch.object(pomodoro, 'ensure_scheduler') as ensure_scheduler:
+            async_to_sync(middleware)({'type': 'http'}, None, None)
+            ensure_scheduler.assert_not_called()
+            with override_settings(POMODORO={**settings.POMODORO, 'SCHEDULER': True}):
+                async_to_sync(middleware)({'type': 'http'}, None, None)
+            with mock.patch.object(pomodoro, '_enabled', True):
+                async_to_sync(middleware)({'type': 'http'}, None, None)
+        self.assertEqual(ensure_scheduler.call_count, 2)
+        logger.info("test_scheduler_only_runs_where_enabled passed")
+
+    def test_start_and_cancel(self):
+        logger.info("Starting test_start_and_cancel")
+        response = self.client.post(reverse('pomodoro-start'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['work_at'] - response.data['break_at'], timedelta(minutes=5))
+        self.assertAlmostEqual((response.data['break_at'] - timezone.now()).total_seconds(), 25 * 60, delta=5)
+
+        response = self.client.post(reverse('pomodoro-start'), {'work_minutes': 50, 'break_minutes': 10})
+        self.assertEqual(response.data['work_at'] - response.data['break_at'], timedelta(minutes=10))
+        self.assertEqual(PendingTimer.objects.filter(user=self.user).count(), 2)
+        self.assertEqual(self.client.post(reverse('pomodoro-start'), {'work_minutes': 0}).status_code, 400)
+
+        self.assertEqual(self.client.post(reverse('pomodoro-cancel')).data, {'cancelled': 2})
+        self.assertFalse(PendingTimer.objects.filter(user=self.user).exists())
+        logger.info("test_start_and_cancel passed")
+
+    def test_timers_started_here_go_straight_to_the_local_scheduler(self):
+        logger.info("Starting test_timers_started_here_go_straight_to_the_local_scheduler")
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        scheduler = pomodoro.PomodoroScheduler()
+        scheduler.loop = loop
+        with mock.patch.object(pomodoro, '_scheduler', scheduler), self.captureOnCommitCallbacks(execute=True):
+            timers = pomodoro.start(self.user, 25, 5)
+        loop.run_until_complete(asyncio.sleep(0))
+        self.assertEqual(len(scheduler.wheel), 2)
+        self.assertIn(timers[0].pk, scheduler.wheel)
+        logger.info("test_timers_started_here_go_straight_to_the_local_scheduler passed")
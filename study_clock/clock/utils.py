@@ -1,12 +1,114 @@
+import hashlib
+from datetime import timedelta
+
 from django.conf import settings
-from django.core.mail import EmailMessage
+from django.core import signing
+from django.core.mail import EmailMessage, get_connection
+from django.db import transaction
+from django.utils import timezone
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def queue_email(subject, body, to):
+    from .models import OutgoingEmail
+
+    return OutgoingEmail.objects.create(subject=subject, body=body, to=to)
+
+
+EMAIL_VERIFICATION_SALT = 'clock.email-verification'
+
+
+def _email_digest(email):
+    return hashlib.sha256(email.lower().encode()).hexdigest()[:16]
+
+
+def make_email_verification_token(user):
+    # The token carries the user id and a digest of the address being
+    # confirmed, so a link sent before an email change stops working.
+    return signing.dumps({'id': user.pk, 'email': _email_digest(user.email)}, salt=EMAIL_VERIFICATION_SALT)
+
+
+def read_email_verification_token(token):
+    # Raises signing.BadSignature (or its subclass SignatureExpired) without
+    # touching the database.
+    payload = signing.loads(token, salt=EMAIL_VERIFICATION_SALT, max_age=settings.EMAIL_VERIFICATION_TOKEN_MAX_AGE)
+    return payload['id'], payload['email']
+
+
+def email_matches_token(user, digest):
+    return _email_digest(user.email) == digest
 
 
 def send_email_confirmation(user):
-    token = user.email_confirmation_token
+    token = make_email_verification_token(user)
     verification_url = f'{settings.SITE_URL}/verify-email?token={token}'
     email_subject = 'Email Confirmation'
     email_body = f'Please confirm your email by clicking the following link: {verification_url}'
 
-    email = EmailMessage(subject=email_subject, body=email_body, to=[user.email])
-    email.send()
+    queue_email(email_subject, email_body, user.email)
+
+
+def deliver_queued_emails(batch_size=None):
+    from .models import OutgoingEmail
+
+    options = settings.EMAIL_OUTBOX
+    batch_size = batch_size or options['BATCH_SIZE']
+    now = timezone.now()
+
+    with transaction.atomic():
+        # skip_locked lets several workers drain the outbox without sending
+        # the same message twice.
+        batch = list(
+            OutgoingEmail.objects.select_for_update(skip_locked=True)
+            .filter(status=OutgoingEmail.STATUS_QUEUED, next_attempt_at__lte=now)
+            .order_by('next_attempt_at')[:batch_size]
+        )
+        if not batch:
+            return 0
+
+        sent = []
+        connection = get_connection(fail_silently=False)
+        try:
+            connection.open()
+        except Exception as e:
+            logger.error('Could not open the email connection: %s', e)
+            for outgoing in batch:
+                _schedule_retry(outgoing, e, options)
+            OutgoingEmail.objects.bulk_update(batch, ['status', 'attempts', 'next_attempt_at', 'last_error'])
+            return 0
+
+        try:
+            for outgoing in batch:
+                message = EmailMessage(subject=outgoing.subject, body=outgoing.body, to=[outgoing.to],
+                                       connection=connection)
+                try:
+                    message.send()
+                except Exception as e:
+                    logger.warning('Sending email %d to %s failed: %s', outgoing.pk, outgoing.to, e)
+                    _schedule_retry(outgoing, e, options)
+                else:
+                    outgoing.status = OutgoingEmail.STATUS_SENT
+                    outgoing.attempts += 1
+                    outgoing.sent_at = timezone.now()
+                    sent.append(outgoing)
+        finally:
+            connection.close()
+
+        OutgoingEmail.objects.bulk_update(batch, ['status', 'attempts', 'next_attempt_at', 'last_error', 'sent_at'])
+
+    logger.info('Delivered %d of %d queued emails', len(sent), len(batch))
+    return len(sent)
+
+
+def _schedule_retry(outgoing, error, options):
+    from .models import OutgoingEmail
+
+    outgoing.attempts += 1
+    outgoing.last_error = str(error)
+    if outgoing.attempts >= options['MAX_ATTEMPTS']:
+        outgoing.status = OutgoingEmail.STATUS_FAILED
+    else:
+        delay = options['RETRY_BACKOFF'] * 2 ** (outgoing.attempts - 1)
+        outgoing.next_attempt_at = timezone.now() + timedelta(seconds=delay)
@@ -1,10 +1,16 @@
+from django.conf import settings
 from django.contrib.auth import authenticate, login
+from django.core import signing
 from django.core.serializers import serialize
 from django.db import models
-from django.http import HttpResponse
+from django.http import HttpResponse, JsonResponse
 from django.shortcuts import render, redirect
-from drf_yasg import openapi
-from drf_yasg.utils import swagger_auto_schema
+from django.template.defaultfilters import filesizeformat
+from django.utils import timezone
+from django.utils.decorators import method_decorator
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_http_methods
 from rest_framework import status, generics, viewsets, filters
 from rest_framework.permissions import IsAuthenticated, AllowAny
 from rest_framework.response import Response
@@ -12,12 +18,21 @@ from rest_framework.status import HTTP_201_CREATED
 from rest_framework.views import APIView
 from rest_framework_simplejwt.tokens import RefreshToken
 from .serializers import RegisterSerializer, ErrorSerializer, MessageSerializer, LoginSerializer, UserSerializer, \
-    EmailUpdateSerializer, AvatarUpdateSerializer, PrivateMessageSerializer, ActivitySerializer
+    EmailUpdateSerializer, AvatarUpdateSerializer, PrivateMessageSerializer, ActivitySerializer, LogoutSerializer, \
+    PomodoroSerializer
 from .permissions import IsAdmin
 from .models import User, PrivateMessage, Activity
-from .utils import send_email_confirmation
+from .utils import send_email_confirmation, read_email_verification_token, email_matches_token
+from .hashing import aauthenticate, PoolSaturated
+from .avatars import AvatarUploadHandler, stage_original, schedule_avatar_processing
+from .media import media_response
+from .docs import openapi, swagger_auto_schema
+from .caching import cached_response, cache_stats, USER_READ, ACTIVITIES, MESSAGE_HISTORY
+from .metrics import metrics_registry
+from .routers import replica_reads
+from .authentication import AsyncAPIView, DataResponse
+from . import achievements, heatmap, pomodoro, stats
 import logging
-import uuid
 import json
 
 logger = logging.getLogger(__name__)
@@ -38,6 +53,11 @@ def chat_view(request):
     return render(request, 'chat.html')
 
 
+@require_http_methods(['GET', 'HEAD'])
+def serve_media(request, path):
+    return media_response(request, path)
+
+
 def login_page(request):
     if request.method == 'POST':
         username = request.POST.get('username')
@@ -140,6 +160,76 @@ class LoginView(APIView):
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
+@method_decorator(csrf_exempt, name='dispatch')
+class AsyncLoginView(View):
+    # Same contract as LoginView, but password verification runs in the
+    # bounded hasher pool so the event loop keeps serving other requests.
+    async def post(self, request):
+        logger.debug('Attempt to log in a user (async)')
+        if request.content_type == 'application/json':
+            try:
+                data = json.loads(request.body)
+            except ValueError:
+                return JsonResponse({'detail': 'Malformed JSON'}, status=status.HTTP_400_BAD_REQUEST)
+        else:
+            data = request.POST
+
+        if not isinstance(data, dict):
+            return JsonResponse({'non_field_errors': ['Invalid data. Expected a dictionary.']},
+                                status=status.HTTP_400_BAD_REQUEST)
+        errors = {field: ['This field is required.'] for field in ('username', 'password') if not data.get(field)}
+        errors.update({field: ['Not a valid string.'] for field in ('username', 'password')
+                       if field not in errors and not isinstance(data[field], str)})
+        if errors:
+            return JsonResponse(errors, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            user = await aauthenticate(request, data['username'], data['password'])
+        except PoolSaturated:
+            return JsonResponse({'detail': 'Server is busy, try again later'}, status=status.HTTP_503_SERVICE_UNAVAILABLE,
+                                headers={'Retry-After': '1'})
+
+        if user is None:
+            logger.warning('Login failed for user: %s', data['username'])
+            return JsonResponse({'non_field_errors': ['Invalid username or password.']},
+                                status=status.HTTP_400_BAD_REQUEST)
+
+        refresh = RefreshToken.for_user(user)
+        logger.info('User logged in successfully: %s', user.username)
+        return JsonResponse({
+            'refresh': str(refresh),
+            'access': str(refresh.access_token),
+        }, status=status.HTTP_200_OK)
+
+
+class LogoutView(APIView):
+    permission_classes = [AllowAny]
+
+    @swagger_auto_schema(
+        operation_description='Revokes a refresh token so it can no longer be used to obtain access tokens',
+        request_body=LogoutSerializer,
+        responses={
+            200: openapi.Response(
+                description='Token revoked',
+                schema=MessageSerializer,
+                examples={'application/json': {'message': 'Logged out successfully'}},
+            ),
+            400: openapi.Response(
+                description='Invalid token',
+                schema=ErrorSerializer,
+                examples={'application/json': {'refresh': ['Token is invalid or expired']}},
+            ),
+        },
+    )
+    def post(self, request):
+        serializer = LogoutSerializer(data=request.data)
+        if serializer.is_valid():
+            serializer.save()
+            logger.info('Refresh token revoked on logout')
+            return Response({'message': 'Logged out successfully'}, status=status.HTTP_200_OK)
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+
 class UserListCreateView(generics.ListCreateAPIView):
     queryset = User.objects.all()
     serializer_class = UserSerializer
@@ -163,13 +253,82 @@ class UserFilterViewSet(viewsets.ModelViewSet):
 
     def get_queryset(self):
         queryset = super().get_queryset()
+        if getattr(self, 'swagger_fake_view', False):
+            # Schema generation runs without a request.
+            return queryset
 
         is_premium = self.request.query_params.get('is_premium', None)
         if is_premium is not None:
             queryset = queryset.filter(is_premium=is_premium)
 
+        username = self.request.query_params.get('username', None)
+        if username is not None:
+            queryset = queryset.by_username(username)
+
+        email = self.request.query_params.get('email', None)
+        if email is not None:
+            queryset = queryset.by_email(email)
+
         return queryset
 
+    @replica_reads
+    def list(self, request, *args, **kwargs):
+        return super().list(request, *args, **kwargs)
+
+
+class UserStatisticsView(APIView):
+    permission_classes = [IsAdmin]
+
+    @swagger_auto_schema(
+        operation_description='Returns demographic statistics about all users. Served from incrementally '
+                              'maintained counters, so the cost does not depend on the number of users.',
+        responses={
+            200: openapi.Response(
+                description='User statistics',
+                examples={'application/json': {
+                    'total_users': 3,
+                    'users_per_country': {'BY': 1, 'US': 2},
+                    'premium_ratio': 0.33,
+                    'email_confirmed_ratio': 0.67,
+                    'age_buckets': {'under 18': 0, '18-24': 2, '25-34': 1, '35-44': 0, '45-54': 0, '55-64': 0,
+                                    '65+': 0},
+                }},
+            ),
+        },
+    )
+    def get(self, request):
+        return Response(stats.summary(), status=status.HTTP_200_OK)
+
+
+class CacheStatisticsView(APIView):
+    permission_classes = [IsAdmin]
+
+    @swagger_auto_schema(
+        operation_description='Returns response cache hits and misses per endpoint, counted by the worker process '
+                              'that serves the request.',
+        responses={
+            200: openapi.Response(
+                description='Response cache statistics',
+                examples={'application/json': {'user-read': {'hits': 40, 'misses': 2}}},
+            ),
+        },
+    )
+    def get(self, request):
+        return Response(cache_stats.snapshot(), status=status.HTTP_200_OK)
+
+
+class MetricsView(APIView):
+    permission_classes = [IsAdmin]
+
+    @swagger_auto_schema(
+        operation_description='Returns request counts, latency histograms and database time per endpoint in the '
+                              'Prometheus text format, summed over all serve workers (as of their last flush, '
+                              'see REQUEST_METRICS) or for this process alone when no metrics directory is set.',
+        responses={200: 'Prometheus text exposition format'},
+    )
+    def get(self, request):
+        return HttpResponse(metrics_registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
 
 class UserUpdateView(APIView):
     permission_classes = [IsAuthenticated]
@@ -192,10 +351,16 @@ class UserUpdateView(APIView):
                 description='User not found',
                 schema=ErrorSerializer,
                 examples={'application/json': {'detail': 'User not found'}}
+            ),
+            409: openapi.Response(
+                description='The user was modified by another request since `version` was read',
+                schema=ErrorSerializer,
+                examples={'application/json': {'detail': 'The resource was modified by another request. '
+                                                          'Reload it and try again.'}}
             )
         }
     )
-    def put(self, request):
+    def put(self, request, pk=None):
         try:
             user = request.user
         except User.DoesNotExist:
@@ -232,6 +397,8 @@ class UserReadView(APIView):
     #         )
     #     }
     # )
+    @cached_response(USER_READ)
+    @replica_reads
     def get(self, request):
         try:
             user = request.user
@@ -245,7 +412,81 @@ class UserReadView(APIView):
         return Response(serializer.data, status=status.HTTP_200_OK)
 
 
-#TODO: think about this
+class AsyncUserReadView(AsyncAPIView):
+    # UserReadView on the event loop; the user comes from authentication.
+    @cached_response(USER_READ)
+    @replica_reads
+    async def get(self, request):
+        return DataResponse(UserSerializer(request.user).data)
+
+
+class StudyHeatmapView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    @swagger_auto_schema(
+        operation_description='Returns the minutes the user studied per weekday and hour of day (7 rows of 24, '
+                              'Monday first) and per day, between two local dates, from the timer writes.',
+        manual_parameters=[
+            openapi.Parameter('start', openapi.IN_QUERY, description='First day (default: 364 days before end)',
+                              type=openapi.TYPE_STRING, format=openapi.FORMAT_DATE),
+            openapi.Parameter('end', openapi.IN_QUERY, description='Last day (default: today)',
+                              type=openapi.TYPE_STRING, format=openapi.FORMAT_DATE),
+        ],
+        responses={
+            200: openapi.Response(
+                description='Study heatmap',
+                examples={'application/json': {
+                    'start': '2024-11-01',
+                    'end': '2024-11-02',
+                    'timezone': 'Europe/Moscow',
+                    'total_minutes': 90.0,
+                    'weekdays': ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday'],
+                    'heatmap': '7 lists of 24 minute totals',
+                    'daily': [90.0, 0.0],
+                }},
+            ),
+            400: openapi.Response(description='Invalid range', schema=ErrorSerializer),
+        },
+    )
+    def get(self, request):
+        try:
+            start, end = heatmap.parse_range(request.query_params.get('start'), request.query_params.get('end'))
+        except ValueError as exc:
+            return Response({'detail': str(exc)}, status=status.HTTP_400_BAD_REQUEST)
+        data, hit = heatmap.study_heatmap(request.user.pk, start, end)
+        return Response(data, status=status.HTTP_200_OK, headers={'X-Cache': 'HIT' if hit else 'MISS'})
+
+
+class AchievementsView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    @swagger_auto_schema(
+        operation_description='Returns the running totals behind the achievements and every achievement rule, '
+                              'with when the user earned it (null if not yet). The current streak is 0 once a '
+                              'day without study time has passed.',
+        responses={
+            200: openapi.Response(
+                description='Achievements',
+                examples={'application/json': {
+                    'total_minutes': 640,
+                    'activities_created': 2,
+                    'current_streak': 3,
+                    'longest_streak': 4,
+                    'last_study_day': '2024-11-02',
+                    'achievements': [
+                        {'code': 'activity-10h', 'title': '10 hours on one activity', 'measure': 'activity_minutes',
+                         'threshold': 600, 'earned_at': '2024-11-02T18:25:43.511000+03:00', 'activity': 'Reading'},
+                        {'code': 'streak-7', 'title': 'Studied 7 days in a row', 'measure': 'streak',
+                         'threshold': 7, 'earned_at': None, 'activity': None},
+                    ],
+                }},
+            ),
+        },
+    )
+    def get(self, request):
+        return Response(achievements.summary(request.user.pk), status=status.HTTP_200_OK)
+
+
 class VerifyEmailView(APIView):
     permission_classes = [AllowAny]
 
@@ -278,30 +519,18 @@ class VerifyEmailView(APIView):
         if not token:
             return Response({'detail': 'Token is required.'}, status=status.HTTP_400_BAD_REQUEST)
         try:
-            uuid.UUID(token)
-        except:
-            return Response({'detail': 'Invalid token'}, status=status.HTTP_400_BAD_REQUEST)
-
-        try:
-            user = User.objects.get(email_confirmation_token=token)
-            user.email_confirmed = True
-            user.email_confirmation_token = None
-            user.save()
-            return Response({'message': 'Email successfully confirmed.'}, status=status.HTTP_200_OK)
-        except User.DoesNotExist:
+            user_id, email_digest = read_email_verification_token(token)
+        except signing.BadSignature:
             return Response({'detail': 'Invalid or expired token'}, status=status.HTTP_400_BAD_REQUEST)
 
-        # try:
-        #     #user = User.objects.get(email_confirmation_token=token)
-        #     user = request.user
-        #     if user.email_confirmation_token == token:
-        #         user.email_confirmed = True
-        #         user.email_confirmation_token = None
-        #         user.save()
-        #         return Response({'message': 'Email successfully confirmed.'}, status=status.HTTP_200_OK)
-        #     return Response({'detail': 'Provided token doesnt match with expected one'}, status=status.HTTP_400_BAD_REQUEST)
-        # except User.DoesNotExist:
-        #     return Response({'detail': 'Invalid or expired token'}, status=status.HTTP_400_BAD_REQUEST)
+        user = User.objects.filter(pk=user_id).first()
+        if user is None or not email_matches_token(user, email_digest):
+            return Response({'detail': 'Invalid or expired token'}, status=status.HTTP_400_BAD_REQUEST)
+        if not user.email_confirmed:
+            user.email_confirmed = True
+            user.email_first_confirmed_at = user.email_first_confirmed_at or timezone.now()
+            user.save(update_fields=['email_confirmed', 'email_first_confirmed_at'])
+        return Response({'message': 'Email successfully confirmed.'}, status=status.HTTP_200_OK)
 
 
 class UpdateEmailView(APIView):
@@ -328,9 +557,6 @@ class UpdateEmailView(APIView):
         serializer = EmailUpdateSerializer(user, data=request.data)
         if serializer.is_valid():
             serializer.save()
-            user.email_confirmation_token = uuid.uuid4()
-            user.email_confirmed = False
-            user.save()
             send_email_confirmation(user)
             return Response({'message': 'Email updated. Please confirm your new email.'}, status=status.HTTP_200_OK)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
@@ -363,11 +589,24 @@ class UpdateAvatarView(APIView):
     )
     def post(self, request):
         user = request.user
+        max_size = settings.AVATAR_PIPELINE['MAX_UPLOAD_SIZE']
+        too_large = Response({'avatar': f'The file exceeds the {filesizeformat(max_size)} limit.'},
+                             status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+        # Refuse obviously oversized bodies before reading them at all; the
+        # upload handler enforces the exact limit while streaming.
+        if int(request.META.get('CONTENT_LENGTH') or 0) > max_size + 64 * 1024:
+            return too_large
+        upload_handler = AvatarUploadHandler(request)
+        request.upload_handlers.insert(0, upload_handler)
         if 'avatar' not in request.FILES:
+            if upload_handler.too_large:
+                return too_large
             return Response({'avatar': 'This field is required.'}, status=status.HTTP_400_BAD_REQUEST)
         serializer = AvatarUpdateSerializer(user, data=request.data, partial=True)
         if serializer.is_valid():
-            serializer.save()
+            # The upload is only staged here; resizing happens off the request.
+            original_name = stage_original(request.FILES['avatar'], upload_handler.digest)
+            schedule_avatar_processing(user.pk, upload_handler.digest, original_name)
             return Response({'message': 'Avatar updated successfully.'}, status=status.HTTP_200_OK)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
@@ -394,6 +633,8 @@ class MessageHistoryView(APIView):
             )
         }
     )
+    @cached_response(MESSAGE_HISTORY, key_kwargs=('user_id',))
+    @replica_reads
     def get(self, request, user_id):
         messages = PrivateMessage.objects.filter(
             (models.Q(sender=request.user) & models.Q(receiver_id=user_id)) |
@@ -403,6 +644,19 @@ class MessageHistoryView(APIView):
         return Response(serializer.data, status=status.HTTP_200_OK)
 
 
+class AsyncMessageHistoryView(AsyncAPIView):
+    @cached_response(MESSAGE_HISTORY, key_kwargs=('user_id',))
+    @replica_reads
+    async def get(self, request, user_id):
+        messages = PrivateMessage.objects.filter(
+            (models.Q(sender=request.user) & models.Q(receiver_id=user_id)) |
+            (models.Q(sender_id=user_id) & models.Q(receiver=request.user))
+        ).order_by('timestamp')
+        # The serializer iterates synchronously, so fetch the rows first.
+        serializer = PrivateMessageSerializer([message async for message in messages], many=True)
+        return DataResponse(serializer.data)
+
+
 class SendMessageView(APIView):
     permission_classes = [IsAuthenticated]
 
@@ -495,6 +749,8 @@ class DeleteActivityView(APIView):
 class GetActivitiesListView(APIView):
     permission_classes = [IsAuthenticated]
 
+    @cached_response(ACTIVITIES)
+    @replica_reads
     def get(self, request):
         user = request.user
         activities = list(Activity.objects.filter(user=user))
@@ -502,7 +758,7 @@ class GetActivitiesListView(APIView):
         for activity in activities:
             dict = {}
             dict['name'] = activity.name
-            dict['username'] = activity.user.username
+            dict['username'] = user.username
             dict['minutes_spent_today'] = activity.minutes_spent_today
             dict['minutes_spent_this_week'] = activity.minutes_spent_this_week
             dict['minutes_spent_this_month'] = activity.minutes_spent_this_month
@@ -511,6 +767,24 @@ class GetActivitiesListView(APIView):
         return Response(json.loads(json.dumps(all_activities, indent=4)), status=status.HTTP_200_OK)
 
 
+class AsyncGetActivitiesListView(AsyncAPIView):
+    @cached_response(ACTIVITIES)
+    @replica_reads
+    async def get(self, request):
+        user = request.user
+        return DataResponse([
+            {
+                'name': activity.name,
+                'username': user.username,
+                'minutes_spent_today': activity.minutes_spent_today,
+                'minutes_spent_this_week': activity.minutes_spent_this_week,
+                'minutes_spent_this_month': activity.minutes_spent_this_month,
+                'minutes_spent_in_total': activity.minutes_spent_in_total,
+            }
+            async for activity in Activity.objects.filter(user=user)
+        ])
+
+
 class TimerUpdate(APIView):
     permission_classes = [IsAuthenticated]
 
@@ -524,12 +798,63 @@ class TimerUpdate(APIView):
         except:
             return Response(data={'message': 'error occurred during casting added time to integer'}, status=status.HTTP_400_BAD_REQUEST)
 
-        activities = Activity.objects.filter(user=user, name=activity_name)
-
-        if len(activities) == 0:
+        activity = Activity.objects.filter(user=user, name=activity_name).last()
+        if activity is None:
             return Response(data={'message': 'there is no such activity'}, status=status.HTTP_400_BAD_REQUEST)
 
-        activity = activities.last()
         activity.add_time(minutes_spent)
 
-        return Response(data={'message': f'{minutes_spent} minutes have been added for {activity.name} activity'}, status=status.HTTP_200_OK)
\ No newline at end of file
+        return Response(data={'message': f'{minutes_spent} minutes have been added for {activity.name} activity'}, status=status.HTTP_200_OK)
+
+
+class AsyncTimerUpdate(AsyncAPIView):
+    async def post(self, request):
+        activity_name = request.data.get('name')
+        try:
+            minutes_spent = int(request.data.get('time'))
+        except (TypeError, ValueError):
+            return DataResponse({'message': 'error occurred during casting added time to integer'},
+                                status=status.HTTP_400_BAD_REQUEST)
+
+        activity = await Activity.objects.filter(user=request.user, name=activity_name).alast()
+        if activity is None:
+            return DataResponse({'message': 'there is no such activity'}, status=status.HTTP_400_BAD_REQUEST)
+
+        await activity.aadd_time(minutes_spent)
+        return DataResponse({'message': f'{minutes_spent} minutes have been added for {activity.name} activity'})
+
+
+class PomodoroStartView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    @swagger_auto_schema(
+        operation_description='Starts a pomodoro, replacing the one in progress: a "break" event is pushed to all '
+                              'of the user\'s connections to ws/pomodoro/ after work_minutes, and a "work" event '
+                              'break_minutes later.',
+        request_body=PomodoroSerializer,
+        responses={
+            200: openapi.Response(
+                description='Pomodoro started',
+                examples={'application/json': {
+                    'break_at': '2024-11-02T18:25:00+03:00',
+                    'work_at': '2024-11-02T18:30:00+03:00',
+                }},
+            ),
+        },
+    )
+    def post(self, request):
+        serializer = PomodoroSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        timers = pomodoro.start(request.user, **serializer.validated_data)
+        return Response({timer.kind + '_at': timer.fires_at for timer in timers}, status=status.HTTP_200_OK)
+
+
+class PomodoroCancelView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    @swagger_auto_schema(
+        operation_description='Cancels the pomodoro in progress; no more events are pushed for it.',
+    )
+    def post(self, request):
+        return Response({'cancelled': pomodoro.cancel(request.user)}, status=status.HTTP_200_OK)
@@ -8,18 +8,35 @@ https://docs.djangoproject.com/en/5.1/howto/deployment/asgi/
 """
 
 import os
-from channels.auth import AuthMiddlewareStack
-from channels.routing import ProtocolTypeRouter, URLRouter
+
 from django.core.asgi import get_asgi_application
-from clock.routing import websocket_urlpatterns
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'study_clock.settings')
 
-application = ProtocolTypeRouter({
-    'http': get_asgi_application(),
+# Sets Django up, once, before anything below imports models or reads settings.
+django_application = get_asgi_application()
+
+from channels.auth import AuthMiddlewareStack
+from channels.routing import ProtocolTypeRouter, URLRouter
+from django.conf import settings
+from django.urls import get_resolver
+from clock.pomodoro import PomodoroSchedulerMiddleware
+from clock.routing import websocket_urlpatterns
+
+application = PomodoroSchedulerMiddleware(ProtocolTypeRouter({
+    'http': django_application,
     'websocket': AuthMiddlewareStack(
         URLRouter(
             websocket_urlpatterns
         )
     ),
-})
+}))
+
+# Load the URLconf (and the views behind it) now rather than in the first
+# request; `manage.py profile_startup` shows where the time goes.
+get_resolver().url_patterns
+
+if settings.API_DOCS and settings.API_SCHEMA['WARM_ON_STARTUP']:
+    from clock.schema import warm_schema_cache
+
+    warm_schema_cache()
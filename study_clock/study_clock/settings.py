@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 from django.conf.global_settings import AUTH_USER_MODEL, MEDIA_URL, MEDIA_ROOT, EMAIL_BACKEND, EMAIL_HOST, EMAIL_PORT, \
@@ -19,6 +20,9 @@ from django.conf.global_settings import AUTH_USER_MODEL, MEDIA_URL, MEDIA_ROOT,
 BASE_DIR = Path(__file__).resolve().parent.parent
 
 AUTH_USER_MODEL = 'clock.User'
+# User.username is unique through a lower(username) constraint, which the
+# check for a unique USERNAME_FIELD does not recognise.
+SILENCED_SYSTEM_CHECKS = ['auth.E003']
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/5.1/howto/deployment/checklist/
 
@@ -32,6 +36,10 @@ ALLOWED_HOSTS = ['172.19.0.4', '127.0.0.1', 'localhost', '26.191.80.219', '26.12
 
 # Application definition
 
+# API-only workers can run with API_DOCS=0: drf_yasg is then never imported
+# and the schema, Swagger and ReDoc routes are not mounted.
+API_DOCS = os.environ.get('API_DOCS', '1') != '0'
+
 INSTALLED_APPS = [
     'django.contrib.admin',
     'django.contrib.auth',
@@ -44,20 +52,46 @@ INSTALLED_APPS = [
     'clock',
     'rest_framework',
     'rest_framework_simplejwt',
-    'drf_yasg',
+    *(['drf_yasg'] if API_DOCS else []),
     'corsheaders',
 ]
 
 ASGI_APPLICATION = 'study_clock.asgi.application'
-CHANNEL_LAYERS = {
-    'default': {
+# Channel layer behind the WebSocket consumers, picked with CHANNEL_LAYER.
+# unix shares channels and groups between the workers of one host through
+# `manage.py channel_broker`, which `manage.py serve` starts by itself; use
+# redis when the workers span several hosts.
+CHANNEL_LAYER_BACKENDS = {
+    'redis': {
         'BACKEND': 'channels_redis.core.RedisChannelLayer',
         'CONFIG': {
-            'hosts': [('study_clock_redis', 6379)],
+            'hosts': [(os.environ.get('REDIS_HOST', 'study_clock_redis'), int(os.environ.get('REDIS_PORT', '6379')))],
+        },
+    },
+    'unix': {
+        'BACKEND': 'clock.channel_layers.UnixSocketChannelLayer',
+        'CONFIG': {
+            'path': os.environ.get('CHANNEL_BROKER_SOCKET', '/tmp/study_clock/channels.sock'),
         },
     },
+    'memory': {
+        'BACKEND': 'channels.layers.InMemoryChannelLayer',
+    },
 }
 
+CHANNEL_LAYERS = {
+    'default': CHANNEL_LAYER_BACKENDS[os.environ.get('CHANNEL_LAYER', 'redis')],
+}
+
+# Unless CHANNEL_LAYER_FANOUT is 0, each worker joins a group once and hands
+# group messages to its own members, so a broadcast to a large group such as
+# support_chat costs one message per worker instead of one per member.
+if os.environ.get('CHANNEL_LAYER', 'redis') != 'memory' and os.environ.get('CHANNEL_LAYER_FANOUT', '1') != '0':
+    CHANNEL_LAYERS['default'] = {
+        'BACKEND': 'clock.channel_layers.LocalFanOutChannelLayer',
+        'CONFIG': {'layer': CHANNEL_LAYERS['default']},
+    }
+
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
         'rest_framework_simplejwt.authentication.JWTAuthentication',
@@ -74,12 +108,29 @@ SIMPLE_JWT = {
     'ALGORITHM': 'HS256',
     'SIGNING_KEY': 'HomeWork',
     'AUTH_HEADER_TYPES': ('Bearer',),
+    'TOKEN_REFRESH_SERIALIZER': 'clock.serializers.RevocableTokenRefreshSerializer',
+}
+
+# Password checks on the async login path run in a bounded thread pool.
+# Requests beyond WORKERS + QUEUE_SIZE in flight get a 503.
+LOGIN_HASHER = {
+    'WORKERS': os.cpu_count() or 1,
+    'QUEUE_SIZE': 64,
+}
+
+# Revoked refresh tokens are kept until they expire. Other workers see a
+# revocation after at most REBUILD_INTERVAL seconds.
+TOKEN_REVOCATION = {
+    'REBUILD_INTERVAL': 60,
+    'ERROR_RATE': 0.01,
+    'MIN_CAPACITY': 1024,
 }
 
 MIDDLEWARE = [
+    'clock.metrics.RequestTimingMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
-    'whitenoise.middleware.WhiteNoiseMiddleware',
+    'clock.staticfiles.AsyncWhiteNoiseMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -133,6 +184,33 @@ DATABASES = {
     }
 }
 
+# Read replicas of the primary, one alias per host. TEST MIRROR points them at
+# the test database so the test runner does not try to create them.
+DATABASE_REPLICA_HOSTS = [host for host in os.environ.get('DATABASE_REPLICA_HOSTS', '').split(',') if host]
+for index, host in enumerate(DATABASE_REPLICA_HOSTS, 1):
+    DATABASES[f'replica{index}'] = {**DATABASES['default'], 'HOST': host, 'TEST': {'MIRROR': 'default'}}
+
+# Local stand-in for a primary/replica pair: two SQLite files, kept in sync
+# with a lag by `manage.py replicate_sqlite --lag 2`.
+if os.environ.get('DATABASE_SQLITE_REPLICA') == '1':
+    DATABASES = {
+        'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': BASE_DIR / 'db.sqlite3'},
+        'replica': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': BASE_DIR / 'db-replica.sqlite3',
+                    'TEST': {'MIRROR': 'default'}},
+    }
+
+DATABASE_ROUTERS = ['clock.routers.ReplicaRouter']
+
+# Views marked with clock.routers.replica_reads read from a random replica,
+# except for users who wrote in the last STICKY_SECONDS (kept in CACHE, which
+# must be shared between workers: a check refuses LocMemCache when there are
+# replicas). The window has to exceed replication lag.
+DATABASE_ROUTING = {
+    'REPLICAS': [alias for alias in DATABASES if alias != 'default'],
+    'STICKY_SECONDS': 5,
+    'CACHE': 'responses',
+}
+
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
 
@@ -175,9 +253,37 @@ STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 # Logging
-import logging
-import logging.handlers
-from concurrent_log_handler import ConcurrentRotatingFileHandler
+# LOG_MODE=file writes records from the calling thread through the locking
+# ConcurrentRotatingFileHandler. LOG_MODE=queue only enqueues them there; a
+# listener thread per process writes them out as JSON lines, and DEBUG
+# records of the loggers in LOG_SAMPLING are kept one in N.
+LOG_MODE = os.environ.get('LOG_MODE', 'file')
+LOG_SAMPLING = {
+    'clock': 10,
+    'django': 10,
+}
+
+LOG_FILE_HANDLER = {
+    'class': 'concurrent_log_handler.ConcurrentRotatingFileHandler',
+    'filename': BASE_DIR / 'logs/study_clock.log',
+    'maxBytes': 1024 * 1024 * 5,
+    'backupCount': 5,
+}
+
+LOG_HANDLERS = {
+    'file': {
+        **LOG_FILE_HANDLER,
+        'level': 'DEBUG',
+        'formatter': 'standard',
+    },
+    'queue': {
+        '()': 'clock.log.QueueListenerHandler',
+        'level': 'DEBUG',
+        'filters': ['sampling'],
+        'target': {**LOG_FILE_HANDLER, 'formatter': 'json'},
+        'queue_size': 10000,
+    },
+}
 
 LOGGING = {
     'version': 1,
@@ -188,28 +294,27 @@ LOGGING = {
             'datefmt': '%Y-%m-%d %H:%M:%S',
         },
     },
-    'handlers': {
-        'file': {
-            'level': 'DEBUG',
-            'class': 'concurrent_log_handler.ConcurrentRotatingFileHandler',
-            'filename': BASE_DIR / 'logs/study_clock.log',
-            'maxBytes': 1024 * 1024 * 5,
-            'backupCount': 5,
-            'formatter': 'standard',
+    'filters': {
+        'sampling': {
+            '()': 'clock.log.SamplingFilter',
+            'rates': LOG_SAMPLING,
         },
     },
+    'handlers': {
+        LOG_MODE: LOG_HANDLERS[LOG_MODE],
+    },
     'root': {
-        'handlers': ['file'],
+        'handlers': [LOG_MODE],
         'level': 'DEBUG',
     },
     'loggers': {
         'django': {
-            'handlers': ['file'],
+            'handlers': [LOG_MODE],
             'level': 'DEBUG',
             'propagate': False,
         },
         'clock': {
-            'handlers': ['file'],
+            'handlers': [LOG_MODE],
             'level': 'DEBUG',
             'propagate': False,
         },
@@ -218,12 +323,126 @@ LOGGING = {
 
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
+# When set, media responses hand the file to nginx via X-Accel-Redirect
+# under this internal location instead of streaming it from Python.
+MEDIA_ACCEL_REDIRECT_PREFIX = os.environ.get('MEDIA_ACCEL_REDIRECT_PREFIX')
+
+# Uploaded avatars are rendered off the request into square WebP and JPEG
+# renditions stored under avatars/<sha256>/<size>.<ext>.
+AVATAR_PIPELINE = {
+    'MAX_UPLOAD_SIZE': 10 * 1024 * 1024,
+    'SIZES': (64, 128, 256, 512),
+    'QUALITY': 82,
+    'WORKERS': 2,
+    'ASYNC': True,
+}
+
+# Per-user cache for the polled read endpoints (clock/caching.py). Pick the
+# backend with RESPONSE_CACHE_BACKEND; locmem is per process, so deployments
+# running several workers must share invalidations through redis (or file, on
+# one host): `manage.py serve` refuses locmem with more than one worker. With
+# replicas it also holds the read-your-writes pins, and defaults to file.
+RESPONSE_CACHE_BACKENDS = {
+    'locmem': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'responses',
+    },
+    'file': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': BASE_DIR / 'cache/responses',
+    },
+    'redis': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': 'redis://{}:{}/1'.format(os.environ.get('REDIS_HOST', 'study_clock_redis'),
+                                             os.environ.get('REDIS_PORT', '6379')),
+    },
+}
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'responses': RESPONSE_CACHE_BACKENDS[
+        os.environ.get('RESPONSE_CACHE_BACKEND', 'file' if DATABASE_ROUTING['REPLICAS'] else 'locmem')],
+}
+
+RESPONSE_CACHE = {
+    'ALIAS': 'responses',
+    'TIMEOUT': 120,
+}
+
+# Study heatmaps (clock/heatmap.py) are cached per user and range in the
+# response cache until the user's next timer write, or CACHE_TIMEOUT. The
+# write moves on a generation token kept in the same cache, so it must be
+# shared between workers too.
+STUDY_HEATMAP = {
+    'MAX_DAYS': 3660,
+    'CACHE_TIMEOUT': 3600,
+}
+
+# Server-pushed pomodoro events (clock/pomodoro.py). Each ASGI worker picks
+# up timers started elsewhere within POLL_INTERVAL seconds, and drops those
+# found more than MAX_LATENESS seconds overdue, e.g. after a long outage.
+# The workers of `manage.py serve` fire timers; under another ASGI server,
+# set POMODORO_SCHEDULER=1.
+POMODORO = {
+    'WORK_MINUTES': 25,
+    'BREAK_MINUTES': 5,
+    'POLL_INTERVAL': 30,
+    'MAX_LATENESS': 300,
+    'SCHEDULER': os.environ.get('POMODORO_SCHEDULER') == '1',
+}
+
+# The OpenAPI document is generated once per process (or read from the files
+# written by `manage.py generate_api_schema`) and served from memory. Workers
+# load those files at startup but never generate the document there.
+API_SCHEMA = {
+    'DIR': BASE_DIR / 'openapi',
+    'WARM_ON_STARTUP': True,
+}
+
+# Swagger UI and ReDoc load the precomputed document instead of asking their
+# own view to regenerate it.
+SWAGGER_SETTINGS = {
+    'SPEC_URL': ('schema-json', {'format': '.json'}),
+}
+REDOC_SETTINGS = {
+    'SPEC_URL': ('schema-json', {'format': '.json'}),
+}
+
+# Per-endpoint request timing (clock/metrics.py), served to admins in the
+# Prometheus text format at /metrics/. Latency buckets are in seconds. Each
+# process counts its own requests; with DIRECTORY set, serve workers write
+# their totals there every FLUSH_INTERVAL seconds and on exit, and /metrics/
+# adds up all of them. `manage.py serve --workers N` (N > 1) uses a temporary
+# directory when none is set, so its /metrics/ covers every worker.
+REQUEST_METRICS = {
+    'BUCKETS': (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0),
+    'SERVER_TIMING': True,
+    'DIRECTORY': os.environ.get('REQUEST_METRICS_DIR') or None,
+    'FLUSH_INTERVAL': 5,
+}
 
 SITE_URL = 'http://26.191.80.219:8000'
 
+# Email verification links are signed and expire after this many seconds.
+EMAIL_VERIFICATION_TOKEN_MAX_AGE = 60 * 60 * 24 * 3
+# `manage.py purge_unconfirmed_users` deletes accounts left unconfirmed for
+# longer than this many days.
+UNCONFIRMED_ACCOUNT_MAX_AGE_DAYS = 14
+
 EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
 EMAIL_HOST = 'smtp.gmail.com'
 EMAIL_PORT = 587
 EMAIL_USE_TLS = True
 EMAIL_HOST_USER = 'a@gmail.com'
 EMAIL_HOST_PASSWORD = 'aaaaaaaaaaaaaaaa'
+
+# Outgoing mail is queued in the outgoing_email table and sent by
+# `manage.py send_queued_mail --loop`. Failed sends are retried after
+# RETRY_BACKOFF * 2**(attempt - 1) seconds, up to MAX_ATTEMPTS times.
+EMAIL_OUTBOX = {
+    'BATCH_SIZE': 50,
+    'MAX_ATTEMPTS': 5,
+    'RETRY_BACKOFF': 30,
+}